@@ -0,0 +1,4 @@
+"""
+Support modules for the A/B test detector tools in api/heavy.py
+(browser management, capture scheduling and screenshot analysis).
+"""
@@ -0,0 +1,168 @@
+"""
+Screenshot analysis functions executed in the analysis worker processes.
+
+Every public function here takes shared-memory references (see
+shared_frames.py) and returns small, picklable results. Keep this module free
+of FastAPI and Playwright imports: it is imported by every worker process.
+"""
+
+import base64
+import hashlib
+import io
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import imagehash
+import numpy as np
+from PIL import Image
+
+from api.ab_detector.masking import Rect, apply_masks
+from api.ab_detector.shared_frames import AnyFrameRef, BlobRef, FrameRef, attach, detach, frame_view, open_frame
+
+
+# Every hash is derived from one shared thumbnail of the grayscale frame. phash
+# uses this size itself, so its value is unchanged from hashing the full image.
+HASH_THUMBNAIL_SIZE = 32
+
+
+def _hash_thumbnail(thumbnail: Image.Image, hash_type: str) -> int:
+    if hash_type == "phash":
+        value = imagehash.phash(thumbnail)
+    elif hash_type == "dhash":
+        value = imagehash.dhash(thumbnail)
+    elif hash_type == "whash":
+        value = imagehash.whash(thumbnail, image_scale=HASH_THUMBNAIL_SIZE)
+    else:
+        raise ValueError(f"Unknown hash type '{hash_type}'")
+    return int(str(value), 16)
+
+
+def _decode(data: bytes, crop: Optional[Rect]) -> Tuple[Image.Image, Image.Image]:
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    if crop is not None:
+        x, y, width, height = crop
+        img = img.crop((x, y, x + width, y + height))
+    return img, img.convert('L')
+
+
+def _hash_and_digest(pixels: np.ndarray, gray_pixels: np.ndarray, hash_types: Sequence[str]) -> Tuple[Dict[str, int], str]:
+    digest = hashlib.blake2b(pixels.data, digest_size=16).hexdigest()
+    # Calculate perceptual hashes for quick comparison
+    thumbnail = Image.fromarray(gray_pixels).resize((HASH_THUMBNAIL_SIZE, HASH_THUMBNAIL_SIZE), Image.Resampling.LANCZOS)
+    return {hash_type: _hash_thumbnail(thumbnail, hash_type) for hash_type in hash_types}, digest
+
+
+def decode_and_hash(
+    blob: BlobRef,
+    frame: FrameRef,
+    hash_types: Sequence[str] = ("phash",),
+    masks: Sequence[Rect] = (),
+    crop: Optional[Rect] = None
+) -> Tuple[Dict[str, int], str]:
+    """
+    Decode a PNG once into its RGB and grayscale frame buffers, cropped to
+    `crop` and with the `masks` regions blanked (see masking.py).
+    Returns the requested perceptual hashes as integers and a digest of the
+    decoded pixels, which identifies bit-identical captures.
+    """
+    blob_shm = attach(blob.name)
+    frame_shm = attach(frame.name)
+    gray_shm = attach(frame.gray_name)
+    try:
+        img, gray = _decode(bytes(blob_shm.buf[:blob.size]), crop)
+        pixels = frame_view(frame_shm, frame.shape)
+        pixels[:] = np.asarray(img)
+        gray_pixels = frame_view(gray_shm, frame.shape[:2])
+        gray_pixels[:] = np.asarray(gray)
+        if masks:
+            apply_masks(pixels, gray_pixels, masks, crop[:2] if crop is not None else (0, 0))
+        try:
+            return _hash_and_digest(pixels, gray_pixels, hash_types)
+        finally:
+            del pixels, gray_pixels
+    finally:
+        detach(blob_shm, frame_shm, gray_shm)
+
+
+def hash_png(
+    blob: BlobRef,
+    hash_types: Sequence[str] = ("phash",),
+    masks: Sequence[Rect] = (),
+    crop: Optional[Rect] = None
+) -> Tuple[Dict[str, int], str]:
+    """
+    Like decode_and_hash, but the decoded pixels are dropped afterwards: for
+    screenshots that are only compared by hash unless they turn out to differ.
+    """
+    blob_shm = attach(blob.name)
+    try:
+        img, gray = _decode(bytes(blob_shm.buf[:blob.size]), crop)
+    finally:
+        detach(blob_shm)
+    pixels, gray_pixels = np.array(img), np.array(gray)
+    if masks:
+        apply_masks(pixels, gray_pixels, masks, crop[:2] if crop is not None else (0, 0))
+    return _hash_and_digest(pixels, gray_pixels, hash_types)
+
+
+def slice_png(blob: BlobRef, offsets: Sequence[Tuple[int, int]]) -> List[bytes]:
+    """PNG tiles of (top, height) rows of a full-page screenshot, decoded once."""
+    blob_shm = attach(blob.name)
+    try:
+        page = Image.open(io.BytesIO(bytes(blob_shm.buf[:blob.size])))
+        page.load()
+    finally:
+        detach(blob_shm)
+    tiles = []
+    for top, height in offsets:
+        buffer = io.BytesIO()
+        # Tiles are decoded again shortly, favour encoding speed over size
+        page.crop((0, top, page.width, top + height)).save(buffer, format='PNG', compress_level=1)
+        tiles.append(buffer.getvalue())
+    return tiles
+
+
+def stitch_png(tiles: Sequence[bytes]) -> bytes:
+    """One PNG of tile screenshots stacked top to bottom (full-page samples)."""
+    images = [Image.open(io.BytesIO(tile)).convert('RGB') for tile in tiles]
+    page = Image.new('RGB', (max(img.width for img in images), sum(img.height for img in images)), (255, 255, 255))
+    top = 0
+    for img in images:
+        page.paste(img, (0, top))
+        top += img.height
+    buffer = io.BytesIO()
+    page.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def preview_png(data: bytes, size: Tuple[int, int] = (800, 600)) -> str:
+    """encode_preview for a PNG that was never decoded into a frame."""
+    return _encode_preview(np.asarray(Image.open(io.BytesIO(data)).convert('RGB')), size)
+
+
+def _encode_preview(frame: np.ndarray, size: Tuple[int, int]) -> str:
+    # Resize for manageable size
+    img_thumb = Image.fromarray(frame).resize(size, Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    img_thumb.save(buffer, format='PNG')
+    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+
+def encode_preview(frame: AnyFrameRef, size: Tuple[int, int] = (800, 600)) -> str:
+    """Resized PNG preview of a frame as a base64 data URI."""
+    with open_frame(frame) as (rgb, _):
+        return _encode_preview(rgb, size)
+
+
+def hash_frame(frame: AnyFrameRef, hash_types: Sequence[str]) -> Dict[str, int]:
+    """Perceptual hashes of an already decoded frame, as decode_and_hash computes them."""
+    with open_frame(frame) as (_, gray):
+        thumbnail = Image.fromarray(gray).resize((HASH_THUMBNAIL_SIZE, HASH_THUMBNAIL_SIZE), Image.Resampling.LANCZOS)
+        return {hash_type: _hash_thumbnail(thumbnail, hash_type) for hash_type in hash_types}
+
+
+def encode_png(frame: AnyFrameRef) -> bytes:
+    """Full-size PNG of a frame (for stored frames whose screenshot artifact was evicted)."""
+    with open_frame(frame) as (rgb, _):
+        buffer = io.BytesIO()
+        Image.fromarray(rgb).save(buffer, format='PNG')
+        return buffer.getvalue()
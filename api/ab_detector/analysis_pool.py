@@ -0,0 +1,96 @@
+"""
+Process pool for CPU-bound screenshot analysis.
+
+Hashing, pixel diffs, SSIM and heatmaps hold the GIL for long stretches, so
+running them inline in a tool coroutine stalls every other request on the
+uvicorn event loop. They run here instead, in worker processes sized to the
+CPUs available to the container.
+
+Configuration (environment variables):
+    AB_ANALYSIS_WORKERS    number of worker processes (default: available CPUs)
+"""
+
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> int:
+    """CPUs this process may run on (respects container CPU affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+ANALYSIS_WORKERS = int(os.environ.get("AB_ANALYSIS_WORKERS", "0")) or available_cpus()
+
+
+def timed(fn, *args, **kwargs):
+    """Worker task: (fn(*args, **kwargs), CPU seconds the worker spent on it)."""
+    started = time.process_time()
+    result = fn(*args, **kwargs)
+    return result, time.process_time() - started
+
+
+# Modules the worker tasks live in, imported with their heavy dependencies once per worker
+_WARM_UP_MODULES = ("api.ab_detector.analysis", "api.ab_detector.compare", "api.ab_detector.heatmap")
+
+
+def _warm_up():
+    for module in _WARM_UP_MODULES:
+        importlib.import_module(module)
+
+
+class AnalysisPool:
+    """
+    Async front end for a ProcessPoolExecutor.
+
+    Workers are spawned rather than forked: the parent runs an event loop and
+    Playwright driver threads, which must not be duplicated into children.
+    """
+
+    def __init__(self, max_workers: int = ANALYSIS_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        if self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_warm_up
+        )
+        logger.info("Analysis pool started with %d workers", self.max_workers)
+
+    def stop(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = None
+
+    async def run(self, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` in a worker process and await its result."""
+        if self._executor is None:
+            self.start()
+        executor = self._executor
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, partial(fn, *args, **kwargs))
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); replace the executor so later jobs still run
+            if self._executor is executor:
+                logger.error("Analysis pool broken, restarting workers")
+                self._executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise
@@ -0,0 +1,221 @@
+"""
+Content-addressed artifact store for screenshots.
+
+detect_ab_test responses reference screenshots by artifact ID instead of
+inlining base64 images. An artifact is the original PNG captured by
+Playwright, stored on disk under the SHA-256 of its bytes, so identical
+screenshots are stored once and an ID always names the same image.
+Renditions (a resized thumbnail, WebP/JPEG encodings) are produced on
+first request and cached next to the original.
+
+The store is bounded by AB_ARTIFACT_MAX_MB; the least recently used files
+are evicted first. Its index is rebuilt from the directory on startup, so
+artifacts survive restarts of the same container.
+
+Configuration (environment variables):
+    AB_ARTIFACT_DIR         directory for stored artifacts (default: <tmp>/opal-ab-artifacts)
+    AB_ARTIFACT_MAX_MB      total size cap in megabytes (default: 512)
+    AB_ARTIFACT_BASE_URL    prefix for artifact URLs in responses, e.g. https://host (default: relative URLs)
+"""
+
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_DIR = os.environ.get("AB_ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "opal-ab-artifacts"))
+ARTIFACT_MAX_BYTES = int(os.environ.get("AB_ARTIFACT_MAX_MB", "512")) * 1024 * 1024
+ARTIFACT_BASE_URL = os.environ.get("AB_ARTIFACT_BASE_URL", "").rstrip("/")
+
+ARTIFACT_ROUTE = "/artifacts"
+
+# Variants served by the GET endpoint: name -> maximum size (None = original size)
+VARIANTS = {"full": None, "thumbnail": (800, 600)}
+
+# Output formats: name -> (PIL format, media type)
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+DEFAULT_QUALITY = 80
+
+# Bytes per chunk when streaming a stored file
+STREAM_CHUNK_BYTES = 64 * 1024
+
+_ARTIFACT_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_artifact_id(value: str) -> bool:
+    return bool(_ARTIFACT_ID.match(value))
+
+
+def artifact_url(artifact_id: str, variant: str = "full", format: str = "png") -> str:
+    """URL of an artifact rendition on the heavy app."""
+    url = f"{ARTIFACT_BASE_URL}{ARTIFACT_ROUTE}/{artifact_id}"
+    query = [f"{key}={value}" for key, value, default in (("variant", variant, "full"), ("format", format, "png")) if value != default]
+    return url + ("?" + "&".join(query) if query else "")
+
+
+def render(source: bytes, variant: str, format: str, quality: int = DEFAULT_QUALITY) -> bytes:
+    """Encode a rendition of a PNG artifact. CPU-bound: run it in the analysis pool."""
+    img = Image.open(io.BytesIO(source)).convert('RGB')
+    size = VARIANTS[variant]
+    if size is not None:
+        # Resize for manageable size
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    pil_format, _ = FORMATS[format]
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        img.save(buffer, format=pil_format)
+    else:
+        img.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue()
+
+
+def iter_file(f: BinaryIO, chunk_size: int = STREAM_CHUNK_BYTES) -> Iterator[bytes]:
+    """Chunks of an open file (see ArtifactStore.open), closing it at the end."""
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class ArtifactStore:
+    """
+    Size-capped, LRU-evicted store of content-addressed files. Methods do
+    blocking file I/O; call them through asyncio.to_thread from handlers.
+    """
+
+    def __init__(self, root: str = ARTIFACT_DIR, max_bytes: int = ARTIFACT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # file name -> size, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        self._loaded = False
+
+    def _load(self):
+        # Rebuild the index from disk, oldest access first
+        if self._loaded:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(".tmp"):
+                os.unlink(path)
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total += size
+        self._loaded = True
+
+    @staticmethod
+    def _file_name(artifact_id: str, variant: str = "full", format: str = "png") -> str:
+        return f"{artifact_id}.png" if (variant, format) == ("full", "png") else f"{artifact_id}.{variant}.{format}"
+
+    def _write(self, name: str, data: bytes):
+        path = os.path.join(self.root, name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        self._entries[name] = len(data)
+        self._entries.move_to_end(name)
+        self._total += len(data)
+        self._evict(keep=name)
+
+    def _evict(self, keep: str):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            name, size = next(iter(self._entries.items()))
+            if name == keep:
+                self._entries.move_to_end(name)
+                continue
+            del self._entries[name]
+            self._total -= size
+            try:
+                os.unlink(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+
+    def put(self, data: bytes) -> str:
+        """Store a PNG screenshot and return its artifact ID."""
+        artifact_id = hashlib.sha256(data).hexdigest()
+        name = self._file_name(artifact_id)
+        with self._lock:
+            self._load()
+            if name in self._entries:
+                self._entries.move_to_end(name)
+            else:
+                self._write(name, data)
+        return artifact_id
+
+    def put_rendition(self, artifact_id: str, variant: str, format: str, data: bytes):
+        with self._lock:
+            self._load()
+            name = self._file_name(artifact_id, variant, format)
+            if name not in self._entries:
+                self._write(name, data)
+
+    def path(self, artifact_id: str, variant: str = "full", format: str = "png") -> Optional[str]:
+        """
+        Path of a stored rendition (marking it recently used), or None. A
+        concurrent put may evict the file; use open() to read it.
+        """
+        name = self._file_name(artifact_id, variant, format)
+        with self._lock:
+            self._load()
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        return os.path.join(self.root, name)
+
+    def open(self, artifact_id: str, variant: str = "full", format: str = "png") -> Optional[BinaryIO]:
+        """
+        A stored rendition opened for reading (marking it recently used), or
+        None. The file is opened under the store lock, so evicting it later
+        only unlinks the name and the open file stays readable.
+        """
+        name = self._file_name(artifact_id, variant, format)
+        with self._lock:
+            self._load()
+            if name not in self._entries:
+                return None
+            try:
+                f = open(os.path.join(self.root, name), "rb")
+            except FileNotFoundError:
+                # Removed behind the store's back
+                self._total -= self._entries.pop(name)
+                return None
+            self._entries.move_to_end(name)
+        return f
+
+    def read(self, artifact_id: str) -> Optional[bytes]:
+        f = self.open(artifact_id)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def stats(self) -> Tuple[int, int]:
+        """(number of files, total bytes)."""
+        with self._lock:
+            self._load()
+            return len(self._entries), self._total
@@ -0,0 +1,244 @@
+"""
+Warm Chromium browser pool shared by the A/B test detector.
+
+Launching Chromium is the slowest part of a short capture job, so the heavy
+app starts a few browser processes when it boots and leases them to requests.
+Each capture still gets its own fresh `new_context`, so requests never share
+cookies or storage - only the browser process is reused.
+
+Browsers are recycled after a number of contexts or once their process tree
+grows past a memory limit, and a background task replaces browsers that have
+crashed or disconnected (see api/shared/warm_pool.py for the lifecycle shared
+with the Lighthouse Chrome pool).
+
+Configuration (environment variables):
+    AB_BROWSER_POOL_SIZE          number of warm browsers (default 2)
+    AB_BROWSER_MAX_LEASES         concurrent leases per browser (default 4)
+    AB_BROWSER_MAX_CONTEXTS       contexts before a browser is recycled (default 200)
+    AB_BROWSER_MAX_MEMORY_MB      process tree RSS before recycling (default 1500, 0 = off)
+    AB_BROWSER_HEALTH_INTERVAL    seconds between health checks (default 30)
+    AB_BROWSER_ACQUIRE_TIMEOUT    seconds a capture waits for a browser lease (default 60)
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from playwright.async_api import Browser
+
+from api.shared.warm_pool import WarmPool
+
+logger = logging.getLogger(__name__)
+
+# Container-friendly Chromium flags
+BROWSER_ARGS = [
+    '--no-sandbox',
+    '--disable-setuid-sandbox',
+    '--disable-dev-shm-usage',
+    '--disable-gpu',
+    '--disable-software-rasterizer',
+    '--disable-extensions'
+]
+
+POOL_SIZE = int(os.environ.get("AB_BROWSER_POOL_SIZE", "2"))
+MAX_LEASES_PER_BROWSER = int(os.environ.get("AB_BROWSER_MAX_LEASES", "4"))
+MAX_CONTEXTS_PER_BROWSER = int(os.environ.get("AB_BROWSER_MAX_CONTEXTS", "200"))
+MAX_BROWSER_MEMORY_MB = int(os.environ.get("AB_BROWSER_MAX_MEMORY_MB", "1500"))
+HEALTH_CHECK_INTERVAL = float(os.environ.get("AB_BROWSER_HEALTH_INTERVAL", "30"))
+ACQUIRE_TIMEOUT = float(os.environ.get("AB_BROWSER_ACQUIRE_TIMEOUT", "60"))
+
+# Switch added to every pooled browser so its process tree can be found in /proc
+_MARKER_SWITCH = "--opal-browser-pool-id"
+
+
+@dataclass
+class PooledBrowser:
+    """A warm browser process owned by the pool."""
+    browser: Browser
+    marker: str
+    launched_at: float
+    contexts_created: int = 0
+    active_leases: int = 0
+    retired: bool = False
+
+    async def new_context(self, **kwargs):
+        """Create a fresh, isolated browser context on this browser."""
+        self.contexts_created += 1
+        return await self.browser.new_context(**kwargs)
+
+    @property
+    def healthy(self) -> bool:
+        return not self.retired and self.browser.is_connected()
+
+
+def _process_tree_rss_bytes(marker: str) -> Optional[int]:
+    """
+    Total resident memory of the browser process tagged with `marker` and all
+    of its descendants (renderers, GPU and utility processes).
+    Returns None where /proc is not available.
+    """
+    if not os.path.isdir('/proc'):
+        return None
+
+    parents: Dict[int, int] = {}
+    rss_pages: Dict[int, int] = {}
+    root_pid = None
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        pid = int(entry)
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                # The command name may contain spaces, fields resume after ')'
+                fields = f.read().rsplit(b')', 1)[1].split()
+            parents[pid] = int(fields[1])
+            rss_pages[pid] = int(fields[21])
+            if root_pid is None:
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    if marker.encode() in f.read():
+                        root_pid = pid
+        except (OSError, IndexError, ValueError):
+            continue
+
+    if root_pid is None:
+        return None
+
+    # Walk descendants of the browser process
+    children: Dict[int, List[int]] = {}
+    for pid, ppid in parents.items():
+        children.setdefault(ppid, []).append(pid)
+
+    total_pages = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        total_pages += rss_pages.get(pid, 0)
+        stack.extend(children.get(pid, []))
+
+    return total_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class BrowserPool(WarmPool):
+    """
+    Pool of warm Chromium browsers leased to requests.
+
+    Usage:
+        pool = BrowserPool()
+        await pool.start()
+        async with pool.lease() as pooled:
+            context = await pooled.new_context(viewport=...)
+        await pool.stop()
+
+    A lease is not exclusive: up to `max_leases_per_browser` requests can hold
+    the same browser, each working in its own context. Captures wait at most
+    `acquire_timeout` seconds for a lease, so an empty pool whose relaunches
+    keep failing fails them instead of hanging.
+    """
+
+    pool_name = "Browser pool"
+    instance_name = "browser"
+
+    def __init__(
+        self,
+        size: int = POOL_SIZE,
+        max_leases_per_browser: int = MAX_LEASES_PER_BROWSER,
+        max_contexts_per_browser: int = MAX_CONTEXTS_PER_BROWSER,
+        max_memory_mb: int = MAX_BROWSER_MEMORY_MB,
+        health_check_interval: float = HEALTH_CHECK_INTERVAL,
+        launch_args: Optional[List[str]] = None,
+        acquire_timeout: float = ACQUIRE_TIMEOUT
+    ):
+        super().__init__(size, health_check_interval)
+        self.max_leases_per_browser = max(1, max_leases_per_browser)
+        self.max_contexts_per_browser = max_contexts_per_browser
+        self.max_memory_mb = max_memory_mb
+        self.launch_args = launch_args if launch_args is not None else BROWSER_ARGS
+        self.acquire_timeout = acquire_timeout
+
+    async def _launch(self) -> PooledBrowser:
+        marker = uuid.uuid4().hex
+        browser = await self._playwright.chromium.launch(
+            headless=True,
+            args=[*self.launch_args, f'{_MARKER_SWITCH}={marker}']
+        )
+        self._launches += 1
+        return PooledBrowser(browser=browser, marker=marker, launched_at=time.monotonic())
+
+    async def _close(self, pooled: PooledBrowser):
+        try:
+            await pooled.browser.close()
+        except Exception as e:
+            logger.warning("Error closing pooled browser: %s", e)
+
+    # ------------------------------------------------------------------
+    # Leasing
+    # ------------------------------------------------------------------
+
+    def _lease(self) -> Optional[PooledBrowser]:
+        # The least loaded healthy browser with a free lease slot
+        candidates = [
+            b for b in self._instances
+            if b.healthy and b.active_leases < self.max_leases_per_browser
+        ]
+        if not candidates:
+            return None
+        pooled = min(candidates, key=lambda b: b.active_leases)
+        pooled.active_leases += 1
+        return pooled
+
+    def _in_use(self, pooled: PooledBrowser) -> bool:
+        return pooled.active_leases > 0
+
+    async def release(self, pooled: PooledBrowser):
+        """Return a lease; recycles the browser if it is due for replacement."""
+        async with self._condition:
+            pooled.active_leases -= 1
+            if pooled.contexts_created >= self.max_contexts_per_browser:
+                pooled.retired = True
+            self._condition.notify_all()
+
+        if pooled.retired or not pooled.browser.is_connected():
+            await self._replace_if_idle(pooled)
+
+    @asynccontextmanager
+    async def lease(self, timeout: Optional[float] = None):
+        """Async context manager around acquire()/release()."""
+        pooled = await self.acquire(timeout=timeout)
+        try:
+            yield pooled
+        finally:
+            await self.release(pooled)
+
+    # ------------------------------------------------------------------
+    # Health checks
+    # ------------------------------------------------------------------
+
+    def _over_memory_limit(self, pooled: PooledBrowser) -> bool:
+        if self.max_memory_mb <= 0:
+            return False
+        rss = _process_tree_rss_bytes(pooled.marker)
+        return rss is not None and rss > self.max_memory_mb * 1024 * 1024
+
+    async def _needs_replacing(self, pooled: PooledBrowser) -> bool:
+        # Disconnected or oversized browsers are retired
+        if not pooled.browser.is_connected():
+            pooled.retired = True
+        elif not pooled.retired:
+            over_limit = await asyncio.to_thread(self._over_memory_limit, pooled)
+            if over_limit:
+                pooled.retired = True
+        return pooled.retired
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "browsers": len(self._instances),
+            "active_leases": sum(b.active_leases for b in self._instances),
+            "launches": self._launches,
+            "recycled": self._recycled
+        }
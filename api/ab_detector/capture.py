@@ -0,0 +1,347 @@
+"""
+Concurrent screenshot capture for the A/B test detector.
+
+Captures run in fresh browser contexts at the same time, up to a concurrency
+limit, with an optional minimum spacing between navigation starts. Instead of
+a fixed sleep after navigation, each capture waits for a readiness condition
+(network idle or a quiet DOM) capped by a timeout.
+
+Schedulers of several jobs can share one CaptureLimits, which caps captures
+in flight overall and per host. A job waiting out its navigation spacing
+holds no shared slot, so other jobs' captures fill the gap.
+
+A capture can also screenshot a single element or the whole page as tiles
+(see tiles.py) instead of the viewport, and record the boxes of elements to
+ignore (see masking.py).
+"""
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+from api.ab_detector.browser_pool import BrowserPool
+from api.ab_detector.masking import INVALID_SELECTORS_JS, MASK_RECTS_JS, Rect, normalize
+from api.ab_detector.network import JobNetwork
+from api.ab_detector.structure import LAYOUT_GRID_PX, MAX_ELEMENTS, SNAPSHOT_JS
+from api.ab_detector.tiles import PAGE_HEIGHT_JS, tile_offsets
+
+# Rotate user agents to simulate different users
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+]
+
+READINESS_MODES = ("networkidle", "dom_stable", "load")
+
+# A DOM is considered stable after this long without mutations
+DOM_QUIET_MS = 500
+
+# Resolves true once the DOM has been quiet for quietMs, false if capMs elapses first
+_DOM_STABLE_JS = """
+([quietMs, capMs]) => new Promise(resolve => {
+    let quietTimer = null;
+    let capTimer = null;
+    const finish = (stable) => {
+        observer.disconnect();
+        clearTimeout(quietTimer);
+        clearTimeout(capTimer);
+        resolve(stable);
+    };
+    const observer = new MutationObserver(() => {
+        clearTimeout(quietTimer);
+        quietTimer = setTimeout(() => finish(true), quietMs);
+    });
+    observer.observe(document.documentElement, {
+        childList: true, subtree: true, attributes: true, characterData: true
+    });
+    quietTimer = setTimeout(() => finish(true), quietMs);
+    capTimer = setTimeout(() => finish(false), capMs);
+})
+"""
+
+
+@dataclass
+class CaptureSpec:
+    """What to capture and how to decide that the page is ready."""
+    url: str
+    viewport_width: int = 1920
+    viewport_height: int = 1080
+    readiness: str = "networkidle"
+    readiness_timeout: float = 5.0
+    navigation_timeout: float = 60.0
+    user_agents: List[str] = field(default_factory=lambda: list(USER_AGENTS))
+    # Request routing shared by every context of the job (blocking and resource cache)
+    network: Optional[JobNetwork] = None
+    # Also record a structural snapshot of the viewport (see structure.py)
+    structure: bool = False
+    # Elements whose boxes are recorded as regions to ignore (see masking.py)
+    mask_selectors: List[str] = field(default_factory=list)
+    # Screenshot only the first element matching this selector instead of the viewport
+    capture_selector: Optional[str] = None
+    # Screenshot the whole page as tiles of this height instead of the viewport (see tiles.py)
+    tile_height: Optional[int] = None
+    max_tiles: int = 10
+
+
+@dataclass
+class CaptureResult:
+    """Outcome of one capture; `screenshot` is PNG bytes or None on failure or when skipped."""
+    index: int
+    screenshot: Optional[bytes] = None
+    error: Optional[str] = None
+    ready: bool = False
+    duration: float = 0.0
+    # Not started because the caller stopped sampling early
+    skipped: bool = False
+    # Raw structural snapshot when CaptureSpec.structure is set; None if it could not be read
+    structure: Optional[Dict[str, list]] = None
+    # Boxes of the CaptureSpec.mask_selectors elements, in screenshot pixels
+    mask_rects: List[Rect] = field(default_factory=list)
+    # PNG tiles from the top of the page down, sliced from the full-page screenshot of a
+    # CaptureSpec.tile_height capture by TiledCaptures
+    tiles: List[bytes] = field(default_factory=list)
+    # CaptureSpec.mask_selectors the browser cannot parse; the capture fails before navigating
+    invalid_selectors: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.screenshot is not None or bool(self.tiles)
+
+
+class NavigationGate:
+    """Enforces a minimum spacing between navigation starts."""
+
+    def __init__(self, min_spacing: float = 0.0):
+        self.min_spacing = max(0.0, min_spacing)
+        self._lock = asyncio.Lock()
+        self._next_allowed = 0.0
+
+    async def wait(self):
+        if self.min_spacing <= 0:
+            return
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            delay = self._next_allowed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_allowed = loop.time() + self.min_spacing
+
+
+class CaptureLimits:
+    """Concurrency limits shared by several capture schedulers: overall and per host."""
+
+    def __init__(self, max_concurrency: int, max_per_host: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_per_host = max(1, max_per_host)
+        self._global = asyncio.Semaphore(self.max_concurrency)
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        host = (urlsplit(url).hostname or "").lower()
+        host_semaphore = self._hosts.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        # Always host first, then global, so waiters never deadlock
+        async with host_semaphore:
+            async with self._global:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+                try:
+                    yield
+                finally:
+                    self.in_flight -= 1
+
+
+async def wait_until_ready(page, readiness: str, timeout: float) -> bool:
+    """
+    Wait for the page to settle after navigation. Returns True if the
+    readiness condition was met, False if the timeout cap was hit first.
+    """
+    if readiness == "networkidle":
+        try:
+            await page.wait_for_load_state('networkidle', timeout=timeout * 1000)
+            return True
+        except PlaywrightTimeoutError:
+            return False
+    if readiness == "dom_stable":
+        try:
+            return bool(await page.evaluate(_DOM_STABLE_JS, [DOM_QUIET_MS, timeout * 1000]))
+        except Exception:
+            # Navigations triggered by the page itself destroy the evaluation context
+            return False
+    if readiness == "load":
+        try:
+            await page.wait_for_load_state('load', timeout=timeout * 1000)
+            return True
+        except PlaywrightTimeoutError:
+            return False
+    raise ValueError(f"Unknown readiness mode '{readiness}', expected one of {', '.join(READINESS_MODES)}")
+
+
+async def _capture_target(page, spec: CaptureSpec) -> Tuple[Optional[object], Tuple[float, float]]:
+    """
+    The element to screenshot (None for the viewport) and the screenshot's
+    origin in viewport coordinates, which mask boxes are made relative to.
+    """
+    if not spec.capture_selector:
+        return None, (0.0, 0.0)
+    target = page.locator(spec.capture_selector).first
+    await target.scroll_into_view_if_needed(timeout=spec.readiness_timeout * 1000)
+    box = await target.bounding_box()
+    if box is None:
+        raise ValueError(f"Element '{spec.capture_selector}' is not visible")
+    return target, (box['x'], box['y'])
+
+
+async def _capture_in_context(pooled_browser, spec: CaptureSpec, result: CaptureResult):
+    """Capture into `result` in a fresh context of a leased browser."""
+    # Create new context for each capture (fresh session with no cookies/storage)
+    context = await pooled_browser.new_context(
+        viewport={'width': spec.viewport_width, 'height': spec.viewport_height},
+        user_agent=random.choice(spec.user_agents),
+        ignore_https_errors=True,
+        storage_state=None,
+        # Service workers would fetch resources behind the router's back
+        service_workers='block' if spec.network is not None else 'allow'
+    )
+    try:
+        if spec.network is not None:
+            await spec.network.install(context)
+        page = await context.new_page()
+        if spec.mask_selectors:
+            result.invalid_selectors = await page.evaluate(INVALID_SELECTORS_JS, spec.mask_selectors)
+            if result.invalid_selectors:
+                raise ValueError(f"Invalid CSS selectors: {', '.join(result.invalid_selectors)}")
+        await page.goto(spec.url, wait_until='domcontentloaded', timeout=spec.navigation_timeout * 1000)
+        result.ready = await wait_until_ready(page, spec.readiness, spec.readiness_timeout)
+        target, origin = await _capture_target(page, spec)
+        if spec.mask_selectors:
+            rects = await page.evaluate(MASK_RECTS_JS, [spec.mask_selectors, *origin])
+            result.mask_rects = [normalize(rect) for rect in rects]
+        if spec.structure:
+            try:
+                result.structure = await page.evaluate(
+                    SNAPSHOT_JS, [LAYOUT_GRID_PX, MAX_ELEMENTS, spec.mask_selectors, spec.capture_selector]
+                )
+            except Exception:
+                # The caller falls back to pixel analysis
+                result.structure = None
+        if spec.tile_height:
+            # One full-page screenshot of the tiled height: the viewport is resized to the
+            # document once, so every tile comes from the same layout (tiles.py slices it)
+            page_height = int(await page.evaluate(PAGE_HEIGHT_JS))
+            top, height = tile_offsets(page_height, spec.tile_height, spec.max_tiles)[-1]
+            result.screenshot = await page.screenshot(
+                full_page=True,
+                clip={'x': 0, 'y': 0, 'width': spec.viewport_width, 'height': top + height}
+            )
+        elif target is not None:
+            result.screenshot = await target.screenshot(timeout=spec.readiness_timeout * 1000)
+        else:
+            result.screenshot = await page.screenshot(full_page=False)
+    except Exception as e:
+        result.error = str(e)
+    finally:
+        await context.close()
+
+
+async def capture_page(pool: BrowserPool, spec: CaptureSpec, index: int) -> CaptureResult:
+    """
+    Capture one screenshot in a fresh context leased from the pool. Waiting
+    longer than the pool's acquire_timeout for a lease is a capture error.
+    """
+    started = time.monotonic()
+    result = CaptureResult(index=index)
+
+    try:
+        async with pool.lease(timeout=pool.acquire_timeout) as pooled_browser:
+            await _capture_in_context(pooled_browser, spec, result)
+    except asyncio.TimeoutError:
+        result.error = f"No browser became available within {pool.acquire_timeout:g} seconds"
+
+    result.duration = time.monotonic() - started
+    return result
+
+
+class CaptureScheduler:
+    """
+    Runs captures concurrently, bounded by `max_concurrency`, and returns
+    the results in index order regardless of completion order.
+
+    `on_capture` is awaited as soon as each capture finishes, so callers can
+    start analysing a screenshot while later captures are still in flight.
+    Captures that have not started when `should_stop()` returns true, or
+    once a capture has found invalid mask selectors, are skipped.
+
+    `pool` is a BrowserPool, or any object with an async
+    `capture(spec, index)` that captures elsewhere (see capture_shards.py).
+    """
+
+    def __init__(
+        self,
+        pool: BrowserPool,
+        max_concurrency: int = 4,
+        min_spacing: float = 0.0,
+        limits: Optional[CaptureLimits] = None
+    ):
+        self.pool = pool
+        self._capture = (
+            partial(capture_page, pool) if isinstance(pool, BrowserPool) else pool.capture
+        )
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_spacing = min_spacing
+        self.limits = limits
+
+    async def run(
+        self,
+        spec: CaptureSpec,
+        num_captures: int,
+        on_capture: Optional[Callable[[CaptureResult], Awaitable[None]]] = None,
+        should_stop: Optional[Callable[[], bool]] = None
+    ) -> List[CaptureResult]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        gate = NavigationGate(self.min_spacing)
+        # Invalid selectors fail every capture the same way
+        invalid_selectors = False
+
+        def _stopped() -> bool:
+            return invalid_selectors or (should_stop is not None and should_stop())
+
+        async def _run_one(index: int) -> CaptureResult:
+            nonlocal invalid_selectors
+            async with semaphore:
+                if _stopped():
+                    return CaptureResult(index=index, skipped=True)
+                try:
+                    await gate.wait()
+                    # Sampling may have stopped while this capture waited out the spacing
+                    if _stopped():
+                        return CaptureResult(index=index, skipped=True)
+                    if self.limits is not None:
+                        async with self.limits.slot(spec.url):
+                            result = await self._capture(spec, index)
+                    else:
+                        result = await self._capture(spec, index)
+                except Exception as e:
+                    result = CaptureResult(index=index, error=str(e))
+                invalid_selectors = invalid_selectors or bool(result.invalid_selectors)
+                # When stopping depends on on_capture, the next capture waits for it
+                if on_capture is not None and should_stop is not None:
+                    await on_capture(result)
+            if on_capture is not None and should_stop is None:
+                await on_capture(result)
+            return result
+
+        # gather() keeps results in index order
+        return list(await asyncio.gather(*[_run_one(i) for i in range(num_captures)]))
@@ -0,0 +1,375 @@
+"""
+Multi-process capture sharding for many-core hosts.
+
+With one process driving every browser, Playwright's CDP message handling,
+the network routing callbacks and the screenshot transfers of all captures
+share one core. With AB_CAPTURE_SHARDS set, the heavy app instead starts
+that many shard processes, each running its own event loop, Playwright
+driver and BrowserPool (AB_BROWSER_POOL_SIZE browsers per shard), and the
+app process only coordinates: CaptureScheduler hands each capture to a
+shard and awaits the result.
+
+* A job's captures go to a shard already serving the job while it has free
+  leases (so its resource cache keeps hitting), otherwise to the least
+  loaded shard.
+* A CaptureSpec crosses the process boundary without its JobNetwork: each
+  shard builds one JobNetwork per job from the same NetworkPolicy, and the
+  shards' NetworkStats are added into the job's own JobNetwork.stats as
+  results arrive. A shard forgets a job once the coordinator's JobNetwork
+  is garbage collected.
+* Screenshots come back in a shared memory segment created by the shard;
+  the coordinator copies the PNG bytes out and unlinks it, so they never
+  go through the pipe.
+
+A shard that dies fails its captures in flight and is started again on the
+next capture.
+
+Configuration (environment variables):
+    AB_CAPTURE_SHARDS    number of capture processes; 0 captures in the app process (default: 0)
+"""
+
+import asyncio
+import dataclasses
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import weakref
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from api.ab_detector.browser_pool import MAX_LEASES_PER_BROWSER, POOL_SIZE, BrowserPool
+from api.ab_detector.capture import CaptureResult, CaptureSpec, capture_page
+from api.ab_detector.network import JobNetwork
+from api.ab_detector.shared_frames import attach
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_SHARDS = int(os.environ.get("AB_CAPTURE_SHARDS", "0"))
+
+# Seconds to wait for a shard to close its browsers before it is killed
+_STOP_TIMEOUT = 30
+
+
+# ----------------------------------------------------------------------
+# Shard process
+# ----------------------------------------------------------------------
+
+def _shard_main(conn, pool_size: int):
+    """Entry point of a shard process."""
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_serve(conn, pool_size))
+
+
+def _pump(conn, loop: asyncio.AbstractEventLoop, inbox: asyncio.Queue):
+    # Blocking reads from the coordinator, handed to the shard's event loop
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            message = ("stop",)
+        loop.call_soon_threadsafe(inbox.put_nowait, message)
+        if message[0] == "stop":
+            return
+
+
+def _export(result: CaptureResult) -> Tuple[Dict[str, Any], Optional[str], List[int]]:
+    """Result fields for the pipe, plus the shared memory segment holding its PNGs and their sizes."""
+    fields = {f.name: getattr(result, f.name) for f in dataclasses.fields(result) if f.name not in ("screenshot", "tiles")}
+    pngs = [result.screenshot] if result.screenshot is not None else result.tiles
+    if not pngs:
+        return fields, None, []
+    sizes = [len(png) for png in pngs]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(sizes)))
+    offset = 0
+    for png in pngs:
+        shm.buf[offset:offset + len(png)] = png
+        offset += len(png)
+    # The coordinator unlinks the segment after copying it
+    shm.close()
+    return fields, shm.name, sizes
+
+
+async def _serve(conn, pool_size: int):
+    loop = asyncio.get_running_loop()
+    inbox: asyncio.Queue = asyncio.Queue()
+    threading.Thread(target=_pump, args=(conn, loop, inbox), daemon=True).start()
+
+    pool = BrowserPool(size=pool_size)
+    try:
+        await pool.start()
+    except Exception as e:
+        # Not fatal: the pool retries lazily on the first capture
+        logger.error("Capture shard %d: browser pool failed to start: %s", os.getpid(), e)
+    conn.send(("ready", os.getpid()))
+
+    networks: Dict[int, JobNetwork] = {}
+    tasks: Set[asyncio.Task] = set()
+
+    async def run_capture(request_id, job, spec, policy, cache, index):
+        network = None
+        if policy is not None:
+            network = networks.get(job)
+            if network is None:
+                network = networks[job] = JobNetwork(policy, cache=cache)
+        try:
+            result = await capture_page(pool, dataclasses.replace(spec, network=network), index)
+        except Exception as e:
+            result = CaptureResult(index=index, error=str(e))
+        fields, segment, sizes = _export(result)
+        stats = network.stats.to_dict() if network is not None else None
+        conn.send(("result", request_id, fields, segment, sizes, result.screenshot is None, stats))
+
+    while True:
+        message = await inbox.get()
+        kind = message[0]
+        if kind == "stop":
+            break
+        if kind == "end_job":
+            networks.pop(message[1], None)
+        elif kind == "capture":
+            task = asyncio.ensure_future(run_capture(*message[1:]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await pool.stop()
+
+
+# ----------------------------------------------------------------------
+# Coordinator
+# ----------------------------------------------------------------------
+
+class _Shard:
+    def __init__(self, number: int, process, conn):
+        self.number = number
+        self.process = process
+        self.conn = conn
+        self.in_flight = 0
+        self.captures = 0
+        self.jobs: Set[int] = set()
+        # Job IDs' latest cumulative NetworkStats from this shard
+        self.network_stats: Dict[int, Dict[str, int]] = {}
+        # GC finalizers may send from another thread
+        self.send_lock = threading.Lock()
+        self.ready = asyncio.get_running_loop().create_future()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+
+class CaptureShards:
+    """
+    Coordinator of the capture shard processes. Pass it to CaptureScheduler
+    in place of a BrowserPool.
+    """
+
+    def __init__(
+        self,
+        num_shards: int = CAPTURE_SHARDS,
+        browsers_per_shard: int = POOL_SIZE,
+        max_leases_per_browser: int = MAX_LEASES_PER_BROWSER
+    ):
+        self.num_shards = max(1, num_shards)
+        self.browsers_per_shard = max(1, browsers_per_shard)
+        # In-flight captures a shard takes before the next job's captures go elsewhere
+        self.shard_capacity = self.browsers_per_shard * max(1, max_leases_per_browser)
+        self._shards: List[Optional[_Shard]] = [None] * self.num_shards
+        self._pending: Dict[int, Tuple[asyncio.Future, _Shard]] = {}
+        self._request_ids = itertools.count()
+        self._job_ids = itertools.count()
+        self._jobs: "weakref.WeakKeyDictionary[JobNetwork, int]" = weakref.WeakKeyDictionary()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._context = multiprocessing.get_context('spawn')
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    def _spawn(self, number: int) -> _Shard:
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_shard_main,
+            args=(child_conn, self.browsers_per_shard),
+            name=f"capture-shard-{number}",
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        shard = _Shard(number, process, parent_conn)
+        threading.Thread(target=self._read, args=(shard,), daemon=True).start()
+        self._shards[number] = shard
+        return shard
+
+    async def start(self):
+        """Start every shard and wait until their browsers are up (idempotent)."""
+        self._loop = asyncio.get_running_loop()
+        started = [self._spawn(n) for n, shard in enumerate(self._shards) if shard is None or not shard.alive]
+        await asyncio.gather(*[shard.ready for shard in started], return_exceptions=True)
+        if started:
+            logger.info("Capture shards started: %d processes x %d browsers", self.num_shards, self.browsers_per_shard)
+
+    async def stop(self):
+        """Stop every shard, closing its browsers."""
+        shards = [shard for shard in self._shards if shard is not None]
+        self._shards = [None] * self.num_shards
+        for shard in shards:
+            try:
+                shard.send(("stop",))
+            except (OSError, ValueError):
+                pass
+        for shard in shards:
+            await asyncio.to_thread(shard.process.join, _STOP_TIMEOUT)
+            if shard.process.is_alive():
+                shard.process.kill()
+            shard.conn.close()
+
+    # ------------------------------------------------------------------
+    # Results from the shards
+    # ------------------------------------------------------------------
+
+    def _read(self, shard: _Shard):
+        while True:
+            try:
+                message = shard.conn.recv()
+            except (EOFError, OSError):
+                message = None
+            try:
+                if message is None:
+                    self._loop.call_soon_threadsafe(self._exited, shard)
+                    return
+                self._loop.call_soon_threadsafe(self._dispatch, shard, message)
+            except RuntimeError:
+                # The event loop has closed (app shutdown)
+                return
+
+    def _dispatch(self, shard: _Shard, message):
+        if message[0] == "ready":
+            if not shard.ready.done():
+                shard.ready.set_result(message[1])
+            return
+        _, request_id, fields, segment, sizes, tiled, stats = message
+        pngs = _collect(segment, sizes)
+        pending = self._pending.pop(request_id, None)
+        if pending is None or pending[0].done():
+            # The capture was cancelled meanwhile
+            return
+        future, _ = pending
+        shard.in_flight -= 1
+        shard.captures += 1
+        result = CaptureResult(**fields)
+        if tiled:
+            result.tiles = pngs
+        elif pngs:
+            result.screenshot = pngs[0]
+        future.set_result((result, stats))
+
+    def _exited(self, shard: _Shard):
+        if not shard.ready.done():
+            shard.ready.set_exception(RuntimeError(f"Capture shard {shard.number} exited during startup"))
+        for request_id, (future, owner) in list(self._pending.items()):
+            if owner is shard:
+                del self._pending[request_id]
+                if not future.done():
+                    future.set_exception(RuntimeError(f"Capture shard {shard.number} exited"))
+        shard.in_flight = 0
+        if self._shards[shard.number] is shard:
+            logger.error("Capture shard %d exited; it is restarted on the next capture", shard.number)
+
+    # ------------------------------------------------------------------
+    # Captures
+    # ------------------------------------------------------------------
+
+    def _end_job(self, job: int):
+        for shard in self._shards:
+            if shard is not None and job in shard.jobs:
+                shard.jobs.discard(job)
+                shard.network_stats.pop(job, None)
+                try:
+                    shard.send(("end_job", job))
+                except (OSError, ValueError):
+                    pass
+
+    def _job_id(self, network: Optional[JobNetwork]) -> Optional[int]:
+        if network is None:
+            return None
+        job = self._jobs.get(network)
+        if job is None:
+            job = self._jobs[network] = next(self._job_ids)
+            weakref.finalize(network, self._end_job, job)
+        return job
+
+    def _choose(self, job: Optional[int]) -> _Shard:
+        for number, shard in enumerate(self._shards):
+            if shard is None or not shard.alive:
+                self._spawn(number)
+        shards = [shard for shard in self._shards if shard is not None]
+        warm = [shard for shard in shards if job in shard.jobs and shard.in_flight < self.shard_capacity]
+        return min(warm or shards, key=lambda shard: (shard.in_flight, shard.captures))
+
+    async def capture(self, spec: CaptureSpec, index: int) -> CaptureResult:
+        """Capture one screenshot on a shard (the sharded counterpart of capture.capture_page)."""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        network = spec.network
+        job = self._job_id(network)
+        shard = self._choose(job)
+        request_id = next(self._request_ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = (future, shard)
+        shard.in_flight += 1
+        if job is not None:
+            shard.jobs.add(job)
+        try:
+            shard.send((
+                "capture", request_id, job, dataclasses.replace(spec, network=None),
+                network.policy if network is not None else None,
+                network.cache_enabled if network is not None else False,
+                index
+            ))
+            result, stats = await future
+        except BaseException:
+            if self._pending.pop(request_id, None) is not None:
+                shard.in_flight -= 1
+            raise
+
+        if network is not None and stats is not None:
+            # Shards report cumulative stats per job; add what changed since this shard's last report
+            previous = shard.network_stats.get(job, {})
+            for name, value in stats.items():
+                setattr(network.stats, name, getattr(network.stats, name) + value - previous.get(name, 0))
+            shard.network_stats[job] = stats
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        shards = [shard for shard in self._shards if shard is not None]
+        return {
+            "shards": len(shards),
+            "alive": sum(1 for shard in shards if shard.alive),
+            "in_flight": sum(shard.in_flight for shard in shards),
+            "captures": sum(shard.captures for shard in shards)
+        }
+
+
+def _collect(segment: Optional[str], sizes: List[int]) -> List[bytes]:
+    """Copy the PNGs out of a shard's segment and unlink it."""
+    if segment is None:
+        return []
+    shm = attach(segment)
+    try:
+        pngs, offset = [], 0
+        for size in sizes:
+            pngs.append(bytes(shm.buf[offset:offset + size]))
+            offset += size
+        return pngs
+    finally:
+        shm.close()
+        shm.unlink()
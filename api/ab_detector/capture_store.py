@@ -0,0 +1,226 @@
+"""
+Stored captures of detect_ab_test jobs, for re-analysis without recapturing.
+
+Each job is a directory named by its job ID holding:
+
+* one file per distinct decoded frame, named by the frame's pixel digest:
+  the uint8 RGB array followed by its uint8 grayscale, read by the analysis
+  workers through np.memmap (see shared_frames.MappedFrameRef);
+* job.json: the job's settings, the frame each capture maps to, perceptual
+  hashes per frame and structural snapshots, plus the capture, sampling and
+  network blocks of the original response.
+
+Jobs expire AB_CAPTURE_TTL_HOURS after they were stored (or after the
+retention requested for the job), and the store is kept under
+AB_CAPTURE_MAX_MB by deleting the least recently used jobs first. Reading a
+job marks it as used. Expired and evicted jobs are swept whenever a job is
+stored, except jobs pinned by a running re-analysis (see pin());
+partial jobs left behind by a failed save are swept an hour later.
+
+Configuration (environment variables):
+    AB_CAPTURE_DIR          directory for stored jobs (default: <tmp>/opal-ab-captures)
+    AB_CAPTURE_MAX_MB       total size cap in megabytes (default: 2048)
+    AB_CAPTURE_TTL_HOURS    default retention of a job in hours (default: 24)
+"""
+
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from api.ab_detector.shared_frames import MappedFrameRef
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_DIR = os.environ.get("AB_CAPTURE_DIR", os.path.join(tempfile.gettempdir(), "opal-ab-captures"))
+CAPTURE_MAX_BYTES = int(os.environ.get("AB_CAPTURE_MAX_MB", "2048")) * 1024 * 1024
+CAPTURE_TTL_HOURS = float(os.environ.get("AB_CAPTURE_TTL_HOURS", "24"))
+
+_METADATA = "job.json"
+_JOB_ID = re.compile(r"^[0-9a-f]{32}$")
+_FRAME_KEY = re.compile(r"^[0-9a-f]{32}$")
+# Seconds after which a `<job_id>.tmp` directory is taken as left behind by a crashed save,
+# not one another job is still writing (saves run concurrently, outside the lock)
+_TMP_GRACE_SECONDS = 3600
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+def is_job_id(value: str) -> bool:
+    return bool(_JOB_ID.match(value))
+
+
+class CaptureStore:
+    """
+    Size-capped, TTL- and LRU-evicted store of capture jobs. Methods do
+    blocking file I/O; call them through asyncio.to_thread from handlers.
+    """
+
+    def __init__(self, root: str = CAPTURE_DIR, max_bytes: int = CAPTURE_MAX_BYTES, ttl_hours: float = CAPTURE_TTL_HOURS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_hours * 3600
+        self._lock = threading.Lock()
+        # job ID -> re-analyses reading it, which sweep() leaves alone
+        self._pins: Dict[str, int] = {}
+
+    def _job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def frame_ref(self, job_id: str, frame_key: str, shape) -> MappedFrameRef:
+        return MappedFrameRef(os.path.join(self._job_dir(job_id), f"{frame_key}.u8"), tuple(shape))
+
+    def save(
+        self,
+        job_id: str,
+        metadata: Dict[str, Any],
+        frames: Dict[str, Tuple[np.ndarray, np.ndarray]],
+        retention_hours: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Store a job: `frames` maps frame keys to (rgb, gray) arrays. Returns
+        the metadata as stored, with created/expires timestamps and size.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        tmp_dir = self._job_dir(job_id) + ".tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            size = 0
+            for key, (rgb, gray) in frames.items():
+                if not _FRAME_KEY.match(key):
+                    raise ValueError(f"Invalid frame key '{key}'")
+                with open(os.path.join(tmp_dir, f"{key}.u8"), "wb") as f:
+                    f.write(memoryview(np.ascontiguousarray(rgb)).cast("B"))
+                    f.write(memoryview(np.ascontiguousarray(gray)).cast("B"))
+                size += rgb.nbytes + gray.nbytes
+
+            created = time.time()
+            retention = self.ttl_seconds if retention_hours is None else retention_hours * 3600
+            metadata = {**metadata, "job_id": job_id, "created": created, "expires": created + retention, "size_bytes": size}
+            with open(os.path.join(tmp_dir, _METADATA), "w") as f:
+                json.dump(metadata, f)
+            # Jobs appear complete or not at all
+            os.replace(tmp_dir, self._job_dir(job_id))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self.sweep(keep=job_id)
+        return metadata
+
+    def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Metadata of a stored job (marking it recently used), or None if unknown or expired."""
+        if not is_job_id(job_id):
+            return None
+        path = os.path.join(self._job_dir(job_id), _METADATA)
+        try:
+            with open(path) as f:
+                metadata = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if metadata.get("expires", 0) < time.time():
+            self.delete(job_id)
+            return None
+        os.utime(path)
+        return metadata
+
+    def update(self, job_id: str, changes: Dict[str, Any]):
+        """Merge `changes` into a job's metadata (e.g. hashes computed on re-analysis)."""
+        path = os.path.join(self._job_dir(job_id), _METADATA)
+        with self._lock:
+            try:
+                with open(path) as f:
+                    metadata = json.load(f)
+            except (FileNotFoundError, ValueError):
+                return
+            metadata.update(changes)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(metadata, f)
+            os.replace(tmp_path, path)
+
+    @contextmanager
+    def pin(self, job_id: str) -> Iterator[None]:
+        """Keep sweep() from deleting a job while the block runs."""
+        with self._lock:
+            self._pins[job_id] = self._pins.get(job_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[job_id] -= 1
+                if not self._pins[job_id]:
+                    del self._pins[job_id]
+
+    def delete(self, job_id: str):
+        if is_job_id(job_id):
+            shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+
+    def _jobs(self):
+        # (last used, job ID, size, expires) for every complete job
+        jobs = []
+        now = time.time()
+        for name in os.listdir(self.root):
+            if not is_job_id(name):
+                if name.endswith(".tmp"):
+                    self._remove_stale_tmp(os.path.join(self.root, name), now)
+                continue
+            path = os.path.join(self.root, name, _METADATA)
+            try:
+                with open(path) as f:
+                    metadata = json.load(f)
+                jobs.append((os.stat(path).st_mtime, name, metadata.get("size_bytes", 0), metadata.get("expires", 0)))
+            except (FileNotFoundError, ValueError):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        return jobs
+
+    @staticmethod
+    def _remove_stale_tmp(path: str, now: float):
+        try:
+            if now - os.stat(path).st_mtime < _TMP_GRACE_SECONDS:
+                return
+        except FileNotFoundError:
+            return
+        shutil.rmtree(path, ignore_errors=True)
+
+    def sweep(self, keep: Optional[str] = None):
+        """Delete expired jobs, then the least recently used ones until the store fits its cap."""
+        with self._lock:
+            if not os.path.isdir(self.root):
+                return
+            now = time.time()
+            total = 0
+            live = []
+            for last_used, job_id, size, expires in sorted(self._jobs()):
+                if expires < now and job_id != keep and job_id not in self._pins:
+                    self.delete(job_id)
+                    continue
+                live.append((job_id, size))
+                total += size
+            for job_id, size in live:
+                if total <= self.max_bytes:
+                    break
+                if job_id == keep or job_id in self._pins:
+                    continue
+                logger.info("Evicting stored captures of job %s", job_id)
+                self.delete(job_id)
+                total -= size
+
+    def stats(self) -> Tuple[int, int]:
+        """(number of jobs, total bytes)."""
+        with self._lock:
+            if not os.path.isdir(self.root):
+                return 0, 0
+            jobs = self._jobs()
+            return len(jobs), sum(size for _, _, size, _ in jobs)
@@ -0,0 +1,129 @@
+"""
+Hamming-distance clustering of perceptual hashes.
+
+Grouping captures by exact hash equality turns one flipped bit (a blinking
+cursor, a rotating ad) into a new "variation". Here two captures are linked
+when every selected hash type differs by at most `radius` bits, and
+variations are the connected components of that graph (single linkage,
+via union-find). Neighbours are found with a BK-tree over the distinct hash
+signatures, so hundreds of captures do not need all pairs compared.
+
+The distance between two signatures is the maximum Hamming distance over
+their hash types, which is itself a metric, so the BK-tree's triangle
+inequality pruning holds. A radius of 0 reproduces exact grouping and is the
+default. Single linkage chains: with a radius above 0, captures further
+apart than the radius share a variation when captures between them link
+them (max_internal_distance reports the spread).
+
+Configuration (environment variables):
+    AB_HASH_RADIUS    default Hamming radius for linking captures (default: 0)
+"""
+
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+HASH_TYPES = ("phash", "dhash", "whash")
+
+HASH_RADIUS = int(os.environ.get("AB_HASH_RADIUS", "0"))
+
+Signature = Tuple[int, ...]
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def signature_distance(a: Signature, b: Signature) -> int:
+    """Largest per-hash-type Hamming distance between two signatures."""
+    return max(hamming(x, y) for x, y in zip(a, b))
+
+
+class BKTree:
+    """Burkhard-Keller tree over signatures for radius queries."""
+
+    def __init__(self):
+        # Each node is (signature, {distance: child node})
+        self._root: Optional[Tuple[Signature, Dict[int, tuple]]] = None
+
+    def add(self, signature: Signature):
+        if self._root is None:
+            self._root = (signature, {})
+            return
+        node = self._root
+        while True:
+            distance = signature_distance(signature, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (signature, {})
+                return
+            node = child
+
+    def search(self, signature: Signature, radius: int) -> List[Signature]:
+        """Every stored signature within `radius` of `signature`."""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node_signature, children = stack.pop()
+            distance = signature_distance(signature, node_signature)
+            if distance <= radius:
+                found.append(node_signature)
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return found
+
+
+class UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, item: int) -> int:
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a: int, b: int):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            # Keep the smaller index as root so clusters are labelled by first appearance
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def cluster_hashes(signatures: Sequence[Signature], radius: int = HASH_RADIUS) -> List[List[int]]:
+    """
+    Group capture indices whose signatures are linked within `radius`.
+    Clusters are ordered by their first capture, members by capture index.
+    """
+    # Identical signatures share one tree node and one union-find entry
+    distinct: Dict[Signature, int] = {}
+    for signature in signatures:
+        distinct.setdefault(signature, len(distinct))
+
+    keys = list(distinct)
+    components = UnionFind(len(keys))
+    if radius > 0:
+        tree = BKTree()
+        for key in keys:
+            tree.add(key)
+        for key in keys:
+            for neighbour in tree.search(key, radius):
+                components.union(distinct[key], distinct[neighbour])
+
+    clusters: Dict[int, List[int]] = {}
+    for index, signature in enumerate(signatures):
+        clusters.setdefault(components.find(distinct[signature]), []).append(index)
+    return list(clusters.values())
+
+
+def max_internal_distance(signatures: Sequence[Signature], members: Sequence[int]) -> int:
+    """Largest signature distance between two members of a cluster."""
+    distinct = list({signatures[i] for i in members})
+    return max(
+        (signature_distance(a, b) for k, a in enumerate(distinct) for b in distinct[k + 1:]),
+        default=0
+    )
@@ -0,0 +1,327 @@
+"""
+Pairwise screenshot comparison engine.
+
+Builds the full N x N pixel-difference and SSIM matrices for a job's frames,
+so variants that never appear in the first capture are characterised as well
+as the ones that do.
+
+* Frames are decoded once (see analysis.decode_and_hash) into shared uint8 RGB
+  and grayscale buffers, or read from a job's stored frame files. Nothing is
+  re-converted per pair.
+* Pixel differences use uint8 arithmetic (|a - b| = max(a, b) - min(a, b)),
+  so no float copies of the frames are made.
+* SSIM reproduces skimage's default `structural_similarity` (7x7 uniform
+  window, sample covariance, mean over the window-cropped image). The window
+  sums are exact integer sliding sums, which replaces five float filters per
+  pair. Per-frame sums are computed once per row of the matrix.
+* Scratch buffers are allocated once per worker and frame size, then reused
+  for every pair.
+* Bit-identical frames are compared once and their rows copied.
+* SSIM_MODES: "exact" computes every SSIM at full resolution, "fast" uses
+  the multi-resolution early exit in fast_ssim.py around an SSIM threshold.
+  A pair decided at a coarse level has no full-resolution SSIM: it is NaN in
+  the SSIM matrix and its coarse score is kept apart (coarse_matrix).
+"""
+
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from api.ab_detector.fast_ssim import SSIM_DATA_RANGE, SSIM_K1, SSIM_K2, SSIM_WIN, multires_ssim, pyramid
+from api.ab_detector.shared_frames import AnyFrameRef, open_frame
+
+# Pixels whose channel values differ by more than this count as changed
+DIFF_INTENSITY_THRESHOLD = 10
+
+SSIM_MODES = ("exact", "fast")
+
+_N = SSIM_WIN * SSIM_WIN
+_C1N2 = (SSIM_K1 * SSIM_DATA_RANGE) ** 2 * _N * _N
+_C2NN1 = (SSIM_K2 * SSIM_DATA_RANGE) ** 2 * _N * (_N - 1)
+
+
+class _Workspace:
+    """Scratch buffers for one frame size, reused across pairs."""
+
+    def __init__(self, shape: Tuple[int, int, int]):
+        height, width = shape[:2]
+        out_h, out_w = height - SSIM_WIN + 1, width - SSIM_WIN + 1
+        self.shape = shape
+
+        # Pixel difference
+        self.diff_a = np.empty(shape, dtype=np.uint8)
+        self.diff_b = np.empty(shape, dtype=np.uint8)
+        self.changed = np.empty(shape, dtype=bool)
+
+        # Window sums. Every window sum and SSIM numerator fits in int32
+        # (at most 49 * 255^2 * 98 < 2^31)
+        self.product = np.empty((height, width), dtype=np.uint16)
+        self.row_sums = np.empty((height, out_w), dtype=np.int32)
+        self.sum_x = np.empty((out_h, out_w), dtype=np.int32)
+        self.sum_xx = np.empty((out_h, out_w), dtype=np.int32)
+        self.sum_y = np.empty((out_h, out_w), dtype=np.int32)
+        self.sum_yy = np.empty((out_h, out_w), dtype=np.int32)
+        self.sum_xy = np.empty((out_h, out_w), dtype=np.int32)
+
+        # SSIM map
+        self.num = np.empty((out_h, out_w), dtype=np.float64)
+        self.den = np.empty((out_h, out_w), dtype=np.float64)
+        self.luminance = np.empty((out_h, out_w), dtype=np.float64)
+        self.tmp = np.empty((out_h, out_w), dtype=np.int32)
+
+
+_workspaces: Dict[Tuple[int, int, int], _Workspace] = {}
+
+
+def _workspace(shape: Tuple[int, int, int]) -> _Workspace:
+    # Keep only the most recent size, frames within a job share one size
+    ws = _workspaces.get(shape)
+    if ws is None:
+        _workspaces.clear()
+        ws = _workspaces[shape] = _Workspace(shape)
+    return ws
+
+
+def _window_sums(src: np.ndarray, ws: _Workspace, out: np.ndarray):
+    """Exact SSIM_WIN x SSIM_WIN box sums of `src` over every valid window."""
+    out_h, out_w = out.shape
+    # Horizontal then vertical sliding sums; shifted adds beat running sums
+    # here because they stay in int32
+    rows = ws.row_sums
+    np.add(src[:, 0:out_w], src[:, 1:out_w + 1], out=rows, dtype=np.int32)
+    for k in range(2, SSIM_WIN):
+        np.add(rows, src[:, k:out_w + k], out=rows, dtype=np.int32)
+    np.add(rows[0:out_h], rows[1:out_h + 1], out=out)
+    for k in range(2, SSIM_WIN):
+        np.add(out, rows[k:out_h + k], out=out)
+
+
+def _frame_sums(gray: np.ndarray, ws: _Workspace, sum_out: np.ndarray, sq_out: np.ndarray):
+    _window_sums(gray, ws, sum_out)
+    np.multiply(gray, gray, out=ws.product, dtype=np.uint16)
+    _window_sums(ws.product, ws, sq_out)
+
+
+def _ssim_from_sums(ws: _Workspace) -> float:
+    """Mean SSIM from the window sums currently held in the workspace."""
+    sx, sy, sxx, syy, sxy = ws.sum_x, ws.sum_y, ws.sum_xx, ws.sum_yy, ws.sum_xy
+    num, den, tmp = ws.num, ws.den, ws.tmp
+
+    # Luminance term: (2 sx sy + C1 N^2) / (sx^2 + sy^2 + C1 N^2)
+    np.multiply(sx, sy, out=tmp)
+    np.multiply(tmp, 2, out=num, casting='unsafe')
+    num += _C1N2
+    np.multiply(sx, sx, out=tmp)
+    np.copyto(den, tmp, casting='unsafe')
+    np.multiply(sy, sy, out=tmp)
+    den += tmp
+    den += _C1N2
+    np.divide(num, den, out=ws.luminance)
+
+    # Contrast/structure term, numerators are exact integers:
+    # (2 (N sxy - sx sy) + C2 N (N-1)) / ((N sxx - sx^2) + (N syy - sy^2) + C2 N (N-1))
+    np.multiply(sx, sy, out=tmp)
+    np.multiply(sxy, _N, out=ws.sum_xy)
+    ws.sum_xy -= tmp
+    np.multiply(ws.sum_xy, 2, out=num, casting='unsafe')
+    num += _C2NN1
+
+    np.multiply(sx, sx, out=tmp)
+    np.multiply(sxx, _N, out=ws.sum_xy)
+    ws.sum_xy -= tmp
+    np.copyto(den, ws.sum_xy, casting='unsafe')
+    np.multiply(sy, sy, out=tmp)
+    np.multiply(syy, _N, out=ws.sum_xy)
+    ws.sum_xy -= tmp
+    den += ws.sum_xy
+    den += _C2NN1
+
+    np.divide(num, den, out=num)
+    num *= ws.luminance
+    return float(num.mean())
+
+
+def _pixel_difference(a: np.ndarray, b: np.ndarray, ws: _Workspace) -> float:
+    """Share of channel values differing by more than DIFF_INTENSITY_THRESHOLD."""
+    np.maximum(a, b, out=ws.diff_a)
+    np.minimum(a, b, out=ws.diff_b)
+    ws.diff_a -= ws.diff_b
+    np.greater(ws.diff_a, DIFF_INTENSITY_THRESHOLD, out=ws.changed)
+    return np.count_nonzero(ws.changed) / ws.changed.size
+
+
+def _resized_difference(base: np.ndarray, other: np.ndarray) -> float:
+    # Frames of a different size are resized to the base frame, as before
+    resized = np.asarray(Image.fromarray(other).resize((base.shape[1], base.shape[0])))
+    diff = np.maximum(base, resized) - np.minimum(base, resized)
+    return np.count_nonzero(diff > DIFF_INTENSITY_THRESHOLD) / diff.size
+
+
+def _compare_block(
+    rgb: Dict[int, np.ndarray],
+    gray: Dict[int, np.ndarray],
+    pairs: Sequence[Tuple[int, int]],
+    ssim_mode: str,
+    ssim_threshold: float
+):
+    results = []
+    current_row = None
+    pyramids = {}
+    for i, j in pairs:
+        if rgb[i].shape != rgb[j].shape:
+            results.append((i, j, _resized_difference(rgb[i], rgb[j]), None, None))
+            continue
+
+        ws = _workspace(rgb[i].shape)
+        difference = _pixel_difference(rgb[i], rgb[j], ws)
+
+        if ssim_mode == "fast":
+            for index in (i, j):
+                if index not in pyramids:
+                    pyramids[index] = pyramid(gray[index])
+            score, level = multires_ssim(pyramids[i], pyramids[j], ssim_threshold)
+            results.append((i, j, difference, score, level))
+            continue
+
+        if current_row != (i, rgb[i].shape):
+            # Window sums of the row frame are shared by every pair in the row
+            _frame_sums(gray[i], ws, ws.sum_x, ws.sum_xx)
+            current_row = (i, rgb[i].shape)
+
+        _frame_sums(gray[j], ws, ws.sum_y, ws.sum_yy)
+        np.multiply(gray[i], gray[j], out=ws.product, dtype=np.uint16)
+        _window_sums(ws.product, ws, ws.sum_xy)
+        # _ssim_from_sums reuses sum_xy as scratch space
+        score = _ssim_from_sums(ws)
+
+        results.append((i, j, difference, score, 0))
+    return results
+
+
+def compare_block(
+    frames: List[AnyFrameRef],
+    pairs: Sequence[Tuple[int, int]],
+    ssim_mode: str = "exact",
+    ssim_threshold: float = 0.95
+) -> List[Tuple[int, int, float, Optional[float], Optional[int]]]:
+    """
+    Worker task: (i, j, difference ratio, SSIM, pyramid level that decided
+    the SSIM) for each requested pair of frame indices. Level is 0 (full
+    resolution) in exact mode. SSIM and level are None for frames of
+    different sizes. Pairs should be grouped by their first index.
+    """
+    needed = sorted({index for pair in pairs for index in pair})
+    with ExitStack() as stack:
+        views = {index: stack.enter_context(open_frame(frames[index])) for index in needed}
+        rgb = {index: rgb_view for index, (rgb_view, _) in views.items()}
+        gray = {index: gray_view for index, (_, gray_view) in views.items()}
+        try:
+            return _compare_block(rgb, gray, pairs, ssim_mode, ssim_threshold)
+        finally:
+            # Drop the views before the segments are closed
+            views = rgb = gray = None
+
+
+def plan_blocks(num_frames: int, num_blocks: int) -> List[List[Tuple[int, int]]]:
+    """Split the upper triangle into row-contiguous blocks of similar size."""
+    pairs = [(i, j) for i in range(num_frames) for j in range(i + 1, num_frames)]
+    if not pairs:
+        return []
+    num_blocks = max(1, min(num_blocks, len(pairs)))
+    target = -(-len(pairs) // num_blocks)
+    return [pairs[k:k + target] for k in range(0, len(pairs), target)]
+
+
+def expand_matrices(
+    unique_of: List[int],
+    num_unique: int,
+    block_results: List[List[Tuple[int, int, float, Optional[float], Optional[int]]]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Assemble the full N x N difference and SSIM matrices from results over
+    unique frames. `unique_of[k]` is the unique frame index of frame k.
+    SSIM is NaN for frames of different sizes and for pairs decided at a
+    coarse pyramid level, which have no full-resolution score.
+    """
+    diff_u = np.zeros((num_unique, num_unique))
+    ssim_u = np.ones((num_unique, num_unique))
+    for block in block_results:
+        for i, j, difference, score, level in block:
+            diff_u[i, j] = diff_u[j, i] = difference
+            ssim_u[i, j] = ssim_u[j, i] = np.nan if score is None or level else score
+
+    index = np.asarray(unique_of)
+    return diff_u[np.ix_(index, index)], ssim_u[np.ix_(index, index)]
+
+
+def coarse_matrix(
+    unique_of: List[int],
+    num_unique: int,
+    block_results: List[List[Tuple[int, int, float, Optional[float], Optional[int]]]]
+) -> np.ndarray:
+    """
+    N x N matrix of the coarse SSIM of the pairs that fast mode decided
+    below full resolution, NaN for every other pair. Coarse scores only
+    tell which side of the threshold a pair is on.
+    """
+    coarse_u = np.full((num_unique, num_unique), np.nan)
+    for block in block_results:
+        for i, j, _, score, level in block:
+            if score is not None and level:
+                coarse_u[i, j] = coarse_u[j, i] = score
+
+    index = np.asarray(unique_of)
+    return coarse_u[np.ix_(index, index)]
+
+
+def decision_levels(block_results: List[List[Tuple[int, int, float, Optional[float], Optional[int]]]]) -> Dict[str, int]:
+    """Number of compared pairs whose SSIM was decided at each pyramid level."""
+    counts: Dict[str, int] = {}
+    for block in block_results:
+        for *_, level in block:
+            if level is not None:
+                counts[str(level)] = counts.get(str(level), 0) + 1
+    return dict(sorted(counts.items()))
+
+
+def upper_triangle(matrix: np.ndarray) -> np.ndarray:
+    """Values for each unordered pair of distinct frames."""
+    rows, cols = np.triu_indices(matrix.shape[0], k=1)
+    return matrix[rows, cols]
+
+
+def _summary(values: np.ndarray) -> Dict[str, Optional[float]]:
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return {"mean": None, "min": None, "max": None}
+    return {"mean": float(values.mean()), "min": float(values.min()), "max": float(values.max())}
+
+
+def cluster_statistics(diff: np.ndarray, ssim_matrix: np.ndarray, clusters: List[List[int]]) -> Dict[str, object]:
+    """
+    Per-cluster cohesion (differences and SSIM within a cluster) and
+    separation between every pair of clusters, read from the matrices.
+    """
+    within = []
+    for members in clusters:
+        idx = np.asarray(members)
+        sub_diff = upper_triangle(diff[np.ix_(idx, idx)])
+        sub_ssim = upper_triangle(ssim_matrix[np.ix_(idx, idx)])
+        within.append({
+            "difference_percentage": {k: (None if v is None else v * 100) for k, v in _summary(sub_diff).items()},
+            "ssim": _summary(sub_ssim)
+        })
+
+    between = []
+    for a in range(len(clusters)):
+        for b in range(a + 1, len(clusters)):
+            block = np.ix_(np.asarray(clusters[a]), np.asarray(clusters[b]))
+            between.append({
+                "clusters": [a, b],
+                "difference_percentage": {k: (None if v is None else v * 100) for k, v in _summary(diff[block].ravel()).items()},
+                "ssim": _summary(ssim_matrix[block].ravel())
+            })
+
+    return {"within": within, "between": between}
@@ -0,0 +1,176 @@
+"""
+Multi-resolution float32 SSIM with early exit.
+
+Most screenshot pairs are either near-identical or obviously different, and
+for those a low-resolution SSIM already tells which side of the decision
+threshold a pair falls on. This module computes SSIM on a 2x box-downsampled
+pyramid of the grayscale frames, starting at the coarsest level, and only
+moves to a finer level while the score is within a margin of the threshold.
+
+Windows are the same 7x7 uniform windows as skimage's default, computed as
+separable float32 box filters (sliding sums). Running sums over a whole
+float32 integral image would lose precision at 1080p, sliding sums of at
+most 49 values do not.
+
+Tolerance:
+    * Scores decided at level 0 (full resolution) match the exact SSIM of
+      compare.py / skimage within FAST_SSIM_TOLERANCE (1e-4 absolute).
+    * Scores decided at a coarser level are SSIM at that resolution, which
+      can be well below the full-resolution score (0.27 lower for a layout
+      shift in benchmarks/ssim_benchmark.py). They are only accepted when
+      further than FAST_SSIM_MARGIN from the threshold and are meant for
+      the similar/dissimilar decision alone: callers must not report them
+      as the pair's SSIM (compare.expand_matrices leaves those pairs out of
+      the SSIM matrix and coarse_matrix reports them separately).
+
+Configuration (environment variables):
+    AB_FAST_SSIM_LEVELS    number of downsampled levels above full resolution (default: 2)
+    AB_FAST_SSIM_MARGIN    distance from the threshold below which a level is ambiguous (default: 0.05)
+"""
+
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# skimage structural_similarity defaults for uint8 input (shared with compare.py)
+SSIM_WIN = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+SSIM_DATA_RANGE = 255
+
+FAST_SSIM_LEVELS = int(os.environ.get("AB_FAST_SSIM_LEVELS", "2"))
+FAST_SSIM_MARGIN = float(os.environ.get("AB_FAST_SSIM_MARGIN", "0.05"))
+
+# Documented maximum absolute deviation of level 0 scores from exact SSIM
+FAST_SSIM_TOLERANCE = 1e-4
+
+_N = SSIM_WIN * SSIM_WIN
+_C1N2 = np.float32((SSIM_K1 * SSIM_DATA_RANGE) ** 2 * _N * _N)
+_C2NN1 = np.float32((SSIM_K2 * SSIM_DATA_RANGE) ** 2 * _N * (_N - 1))
+
+
+class _LevelWorkspace:
+    """float32 scratch buffers for one pyramid level, reused across pairs."""
+
+    def __init__(self, shape: Tuple[int, int]):
+        height, width = shape
+        out_h, out_w = height - SSIM_WIN + 1, width - SSIM_WIN + 1
+        self.product = np.empty((height, width), dtype=np.float32)
+        self.row_sums = np.empty((height, out_w), dtype=np.float32)
+        self.sum_x = np.empty((out_h, out_w), dtype=np.float32)
+        self.sum_xx = np.empty((out_h, out_w), dtype=np.float32)
+        self.sum_y = np.empty((out_h, out_w), dtype=np.float32)
+        self.sum_yy = np.empty((out_h, out_w), dtype=np.float32)
+        self.sum_xy = np.empty((out_h, out_w), dtype=np.float32)
+        self.num = np.empty((out_h, out_w), dtype=np.float32)
+        self.den = np.empty((out_h, out_w), dtype=np.float32)
+        self.tmp = np.empty((out_h, out_w), dtype=np.float32)
+
+
+_workspaces: Dict[Tuple[int, int], _LevelWorkspace] = {}
+
+
+def _workspace(shape: Tuple[int, int]) -> _LevelWorkspace:
+    ws = _workspaces.get(shape)
+    if ws is None:
+        # One entry per pyramid level of the current frame size
+        if len(_workspaces) > 2 * (FAST_SSIM_LEVELS + 1):
+            _workspaces.clear()
+        ws = _workspaces[shape] = _LevelWorkspace(shape)
+    return ws
+
+
+def pyramid(gray: np.ndarray, levels: int = FAST_SSIM_LEVELS) -> List[np.ndarray]:
+    """
+    The frame itself (level 0) followed by successive 2x2 box averages in
+    float32. Stops early once a level would be too small for the window.
+    """
+    result = [gray]
+    current = gray
+    for _ in range(levels):
+        height, width = current.shape[0] // 2 * 2, current.shape[1] // 2 * 2
+        if height // 2 < 2 * SSIM_WIN or width // 2 < 2 * SSIM_WIN:
+            break
+        down = np.add(current[0:height:2, 0:width:2], current[1:height:2, 0:width:2], dtype=np.float32)
+        down += current[0:height:2, 1:width:2]
+        down += current[1:height:2, 1:width:2]
+        down *= 0.25
+        result.append(down)
+        current = down
+    return result
+
+
+def _box(src: np.ndarray, ws: _LevelWorkspace, out: np.ndarray):
+    """SSIM_WIN x SSIM_WIN window sums of `src` over every valid window."""
+    out_h, out_w = out.shape
+    rows = ws.row_sums
+    np.add(src[:, 0:out_w], src[:, 1:out_w + 1], out=rows, dtype=np.float32)
+    for k in range(2, SSIM_WIN):
+        np.add(rows, src[:, k:out_w + k], out=rows, dtype=np.float32)
+    np.add(rows[0:out_h], rows[1:out_h + 1], out=out)
+    for k in range(2, SSIM_WIN):
+        np.add(out, rows[k:out_h + k], out=out)
+
+
+def ssim_f32(x: np.ndarray, y: np.ndarray) -> float:
+    """Mean SSIM of two equally sized 2-D arrays, computed in float32."""
+    ws = _workspace(x.shape)
+    sx, sy, sxx, syy, sxy = ws.sum_x, ws.sum_y, ws.sum_xx, ws.sum_yy, ws.sum_xy
+    num, den, tmp = ws.num, ws.den, ws.tmp
+
+    _box(x, ws, sx)
+    _box(y, ws, sy)
+    np.multiply(x, x, out=ws.product, dtype=np.float32)
+    _box(ws.product, ws, sxx)
+    np.multiply(y, y, out=ws.product, dtype=np.float32)
+    _box(ws.product, ws, syy)
+    np.multiply(x, y, out=ws.product, dtype=np.float32)
+    _box(ws.product, ws, sxy)
+
+    # Contrast/structure term first, it needs sx * sy before sxx/syy are reused:
+    # (2 (N sxy - sx sy) + C2 N (N-1)) / ((N sxx - sx^2) + (N syy - sy^2) + C2 N (N-1))
+    np.multiply(sx, sy, out=tmp)
+    sxy *= _N
+    sxy -= tmp
+    np.multiply(sxy, 2, out=num)
+    num += _C2NN1
+    sxx *= _N
+    np.multiply(sx, sx, out=den)
+    sxx -= den
+    syy *= _N
+    np.multiply(sy, sy, out=sxy)
+    syy -= sxy
+    np.add(sxx, syy, out=den)
+    den += _C2NN1
+    num /= den
+
+    # Luminance term: (2 sx sy + C1 N^2) / (sx^2 + sy^2 + C1 N^2); den holds sx^2 + sy^2
+    np.multiply(sx, sx, out=den)
+    den += sxy
+    den += _C1N2
+    tmp *= 2
+    tmp += _C1N2
+    tmp /= den
+    num *= tmp
+    return float(num.mean(dtype=np.float64))
+
+
+def multires_ssim(
+    pyramid_x: List[np.ndarray],
+    pyramid_y: List[np.ndarray],
+    threshold: float,
+    margin: float = FAST_SSIM_MARGIN
+) -> Tuple[float, int]:
+    """
+    SSIM from the coarsest level that is clearly on one side of `threshold`.
+    Returns (score, level), where level 0 is full resolution. A score from
+    level > 0 decides which side of the threshold the pair is on; it is not
+    the pair's full-resolution SSIM.
+    """
+    levels = min(len(pyramid_x), len(pyramid_y))
+    for level in range(levels - 1, 0, -1):
+        score = ssim_f32(pyramid_x[level], pyramid_y[level])
+        if abs(score - threshold) > margin:
+            return score, level
+    return ssim_f32(pyramid_x[0], pyramid_y[0]), 0
@@ -0,0 +1,153 @@
+"""
+Streaming variance heatmap over every capture of a job.
+
+Instead of stacking a few frames and calling np.var, each decoded frame is
+folded into a running per-pixel mean and sum of squared deviations
+(Welford's algorithm) as soon as it arrives. Memory stays at two float32
+frames per job however many captures are taken. The per-pixel variance is
+then reduced to grid cells with np.add.reduceat instead of a Python loop.
+
+The worker functions follow analysis.py's rules (shared-memory references
+in, small results out). StreamingVariance is the parent-side driver.
+"""
+
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from api.ab_detector.shared_frames import AnyFrameRef, StatsRef, attach, detach, frame_view, open_frame
+
+HEATMAP_GRID_SIZE = 10
+
+
+class _UpdateWorkspace:
+    def __init__(self, shape: Tuple[int, int, int]):
+        self.delta = np.empty(shape, dtype=np.float32)
+        self.step = np.empty(shape, dtype=np.float32)
+
+
+_workspaces: Dict[Tuple[int, int, int], _UpdateWorkspace] = {}
+
+
+def _workspace(shape: Tuple[int, int, int]) -> _UpdateWorkspace:
+    ws = _workspaces.get(shape)
+    if ws is None:
+        _workspaces.clear()
+        ws = _workspaces[shape] = _UpdateWorkspace(shape)
+    return ws
+
+
+def _welford_update(mean: np.ndarray, m2: np.ndarray, frame: np.ndarray, count: int):
+    if count == 1:
+        mean[:] = frame
+        m2.fill(0)
+        return
+    ws = _workspace(frame.shape)
+    np.subtract(frame, mean, out=ws.delta, dtype=np.float32)
+    np.multiply(ws.delta, 1.0 / count, out=ws.step)
+    mean += ws.step
+    np.subtract(frame, mean, out=ws.step, dtype=np.float32)
+    ws.step *= ws.delta
+    m2 += ws.step
+
+
+def accumulate_frame(stats: StatsRef, frame: AnyFrameRef, count: int):
+    """Worker task: fold `frame` into the running statistics as sample number `count`."""
+    segments = [attach(stats.mean_name), attach(stats.m2_name)]
+    try:
+        with open_frame(frame) as (rgb, _):
+            _welford_update(
+                frame_view(segments[0], stats.shape, np.float32),
+                frame_view(segments[1], stats.shape, np.float32),
+                rgb,
+                count
+            )
+            rgb = None
+    finally:
+        detach(*segments)
+
+
+def _grid_cells(m2: np.ndarray, count: int, grid_size: int) -> Tuple[np.ndarray, int, int]:
+    # Population variance averaged across RGB channels, as np.var(frames, axis=0).mean(axis=2)
+    variance = m2.mean(axis=2, dtype=np.float64)
+    variance /= count
+
+    # Cells of height // grid_size by width // grid_size pixels; a remainder forms a smaller last row/column
+    height, width = variance.shape
+    cell_height, cell_width = max(1, height // grid_size), max(1, width // grid_size)
+    row_starts = np.arange(0, height, cell_height)
+    col_starts = np.arange(0, width, cell_width)
+    sums = np.add.reduceat(np.add.reduceat(variance, row_starts, axis=0), col_starts, axis=1)
+    row_sizes = np.diff(np.append(row_starts, height))
+    col_sizes = np.diff(np.append(col_starts, width))
+    return sums / np.outer(row_sizes, col_sizes), cell_height, cell_width
+
+
+def variance_grid(stats: StatsRef, count: int, grid_size: int = HEATMAP_GRID_SIZE) -> Tuple[np.ndarray, int, int]:
+    """Worker task: (mean variance per cell as a rows x cols array, cell height, cell width)."""
+    shm = attach(stats.m2_name)
+    try:
+        return _grid_cells(frame_view(shm, stats.shape, np.float32), count, grid_size)
+    finally:
+        detach(shm)
+
+
+def hot_spots(cells: np.ndarray, cell_height: int, cell_width: int, limit: Optional[int] = None) -> List[Dict[str, float]]:
+    """Grid cells sorted by variance, highest first, as {"x", "y", "variance"} dicts."""
+    order = np.argsort(-cells, axis=None, kind='stable')[:limit]
+    rows, cols = np.unravel_index(order, cells.shape)
+    return [
+        {"x": int(col * cell_width), "y": int(row * cell_height), "variance": float(cells[row, col])}
+        for row, col in zip(rows, cols)
+    ]
+
+
+def compact_heatmap(cells: np.ndarray, cell_height: int, cell_width: int, top_k: int = 0) -> Dict[str, object]:
+    """
+    Heatmap for the response: every cell as a rows x cols array, or with
+    top_k > 0 only the top_k cells as [x, y, variance] rows.
+    """
+    heatmap = {
+        "rows": cells.shape[0],
+        "cols": cells.shape[1],
+        "cell_width": cell_width,
+        "cell_height": cell_height
+    }
+    if top_k > 0:
+        heatmap["top_cells"] = [
+            [spot["x"], spot["y"], round(spot["variance"], 3)] for spot in hot_spots(cells, cell_height, cell_width, top_k)
+        ]
+    else:
+        heatmap["cells"] = np.round(cells, 3).tolist()
+    return heatmap
+
+
+class StreamingVariance:
+    """
+    Parent-side driver: allocates the running statistics for a job and
+    serialises updates, which must not run concurrently on the same buffers.
+    Frames whose size differs from the first frame added are skipped.
+    """
+
+    def __init__(self, pool, store):
+        self._pool = pool
+        self._store = store
+        self._lock = asyncio.Lock()
+        self.stats: Optional[StatsRef] = None
+        self.count = 0
+
+    async def add(self, frame: AnyFrameRef):
+        async with self._lock:
+            if self.stats is None:
+                self.stats = self._store.create_stats(frame.shape)
+            if frame.shape != self.stats.shape:
+                return
+            await self._pool.run(accumulate_frame, self.stats, frame, self.count + 1)
+            self.count += 1
+
+    async def grid(self, grid_size: int = HEATMAP_GRID_SIZE) -> Optional[Tuple[np.ndarray, int, int]]:
+        async with self._lock:
+            if not self.count:
+                return None
+            return await self._pool.run(variance_grid, self.stats, self.count, grid_size)
@@ -0,0 +1,141 @@
+"""
+Ignore regions for the A/B test detector.
+
+Carousels, cookie banners and ad slots change between captures without
+being part of a test. Regions to ignore come from two sources:
+
+* fixed rectangles given with the request, the same for every capture;
+* CSS selectors, whose elements' boxes are read from each page right before
+  its screenshot (MASK_RECTS_JS).
+
+Masks are applied once, when a screenshot is decoded (see
+analysis.decode_and_hash): masked pixels are set to MASK_VALUE in the RGB
+and grayscale frames, so hashes, digests, differences, SSIM and the heatmap
+all see the same constant there. Fixed rectangles that span the full width
+at the top or bottom (or the full height at a side) are cropped away
+instead, so later stages also process fewer pixels.
+
+Rectangles are (x, y, width, height) in screenshot pixels.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+Rect = Tuple[int, int, int, int]
+
+MASK_VALUE = 0
+
+# The selectors the browser cannot parse (querySelector throws a SyntaxError
+# for them on any document, so this runs before navigation)
+INVALID_SELECTORS_JS = """
+(selectors) => selectors.filter(selector => {
+    try {
+        document.createDocumentFragment().querySelector(selector);
+        return false;
+    } catch (e) {
+        return true;
+    }
+})
+"""
+
+# Boxes of the elements matching any of the selectors, relative to the
+# screenshot origin [originX, originY] (the viewport or the captured element);
+# selectors that do not parse are skipped
+MASK_RECTS_JS = """
+([selectors, originX, originY]) => {
+    const rects = [];
+    for (const selector of selectors) {
+        let matches;
+        try {
+            matches = document.querySelectorAll(selector);
+        } catch (e) {
+            continue;
+        }
+        for (const el of matches) {
+            const r = el.getBoundingClientRect();
+            if (r.width > 0 && r.height > 0) {
+                rects.push([r.left - originX, r.top - originY, r.width, r.height]);
+            }
+        }
+    }
+    return rects;
+}
+"""
+
+
+def normalize(rect: Sequence[float]) -> Rect:
+    """Round a rectangle outwards to whole pixels."""
+    x, y, width, height = rect
+    left, top = int(np.floor(x)), int(np.floor(y))
+    return left, top, int(np.ceil(x + width)) - left, int(np.ceil(y + height)) - top
+
+
+def clip(rect: Rect, width: int, height: int) -> Optional[Rect]:
+    """The part of `rect` inside a width x height image, or None."""
+    x, y, w, h = rect
+    left, top = max(0, x), max(0, y)
+    right, bottom = min(width, x + w), min(height, y + h)
+    if right <= left or bottom <= top:
+        return None
+    return left, top, right - left, bottom - top
+
+
+def crop_box(width: int, height: int, regions: Sequence[Rect]) -> Rect:
+    """
+    Bounding box left after cropping away regions that cover whole rows at
+    the top or bottom or whole columns at the left or right edge.
+    """
+    clipped = [r for r in (clip(region, width, height) for region in regions) if r is not None]
+    left, top, right, bottom = 0, 0, width, height
+    changed = True
+    while changed:
+        changed = False
+        for x, y, w, h in clipped:
+            spans_rows = x <= left and x + w >= right
+            spans_cols = y <= top and y + h >= bottom
+            if spans_rows and y <= top < y + h:
+                top, changed = y + h, True
+            if spans_rows and y < bottom <= y + h:
+                bottom, changed = y, True
+            if spans_cols and x <= left < x + w:
+                left, changed = x + w, True
+            if spans_cols and x < right <= x + w:
+                right, changed = x, True
+            if right <= left or bottom <= top:
+                # Everything is ignored; keep a single pixel so frames stay valid
+                return 0, 0, 1, 1
+    return left, top, right - left, bottom - top
+
+
+def mask_array(shape: Tuple[int, int], rects: Sequence[Rect], origin: Tuple[int, int] = (0, 0)) -> np.ndarray:
+    """
+    Boolean mask of a (height, width) frame. `rects` are in uncropped
+    screenshot coordinates, `origin` is the crop's top-left corner.
+    """
+    height, width = shape
+    mask = np.zeros((height, width), dtype=bool)
+    for rect in rects:
+        x, y, w, h = rect
+        clipped = clip((x - origin[0], y - origin[1], w, h), width, height)
+        if clipped is not None:
+            cx, cy, cw, ch = clipped
+            mask[cy:cy + ch, cx:cx + cw] = True
+    return mask
+
+
+def apply_masks(rgb: np.ndarray, gray: np.ndarray, rects: Sequence[Rect], origin: Tuple[int, int] = (0, 0)):
+    """Worker side: set the masked pixels of a decoded frame to MASK_VALUE in place."""
+    mask = mask_array(gray.shape, rects, origin)
+    rgb[mask] = MASK_VALUE
+    gray[mask] = MASK_VALUE
+
+
+def parse_regions(regions: Sequence[Sequence[float]]) -> List[Rect]:
+    """Validate [x, y, width, height] regions from a request; raises ValueError."""
+    parsed = []
+    for region in regions:
+        if len(region) != 4 or region[2] <= 0 or region[3] <= 0:
+            raise ValueError(f"Invalid region {list(region)}: expected [x, y, width, height] with positive size")
+        parsed.append(normalize(region))
+    return parsed
@@ -0,0 +1,519 @@
+"""
+Scheduled A/B test monitoring.
+
+Watched URLs are re-sampled in the background with a few captures per run.
+Each capture is only decoded and perceptually hashed (no pairwise SSIM or
+heatmap) and assigned to the nearest stored variant of its URL:
+
+* a variant's centroid is the bitwise majority of its members' hashes,
+  kept as per-bit counts so it updates incrementally;
+* a capture joins the nearest centroid within the watch's hash radius,
+  otherwise it starts a new variant.
+
+After every run the URL's active variant set is recomputed from its most
+recent `window_captures` captures: a variant is active once it appears at
+least ACTIVE_MIN_CAPTURES times in that window, so a single odd capture does
+not count. Comparing the active set with the previous one records events:
+
+* test_started: one variant (or none) became two or more;
+* variants_changed: still two or more, but a different set;
+* test_ended: two or more became one.
+
+Everything lives in one SQLite database indexed by URL and time. Only the
+captures of the current window are kept (variants keep their centroid
+counts), and at most MONITOR_MAX_EVENTS events per URL.
+
+Configuration (environment variables):
+    AB_MONITOR_DB                   SQLite database path (default: <tmp>/opal-ab-monitor.sqlite3)
+    AB_MONITOR_POLL_SECONDS         how often the scheduler looks for due watches (default: 30)
+    AB_MONITOR_MAX_CONCURRENT_RUNS  watches sampled at the same time (default: 2)
+    AB_MONITOR_HASH_RADIUS          default Hamming radius from a variant's centroid (default: 1)
+    AB_MONITOR_MAX_EVENTS           most recent events kept per URL (default: 100)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+from api.ab_detector.analysis import decode_and_hash
+from api.ab_detector.capture import CaptureScheduler, CaptureSpec
+from api.ab_detector.clustering import Signature, signature_distance
+from api.ab_detector.network import JobNetwork, NetworkPolicy
+from api.ab_detector.shared_frames import FrameStore
+
+logger = logging.getLogger(__name__)
+
+MONITOR_DB = os.environ.get("AB_MONITOR_DB", os.path.join(tempfile.gettempdir(), "opal-ab-monitor.sqlite3"))
+MONITOR_POLL_SECONDS = float(os.environ.get("AB_MONITOR_POLL_SECONDS", "30"))
+MONITOR_MAX_CONCURRENT_RUNS = int(os.environ.get("AB_MONITOR_MAX_CONCURRENT_RUNS", "2"))
+# Captures are matched to one centroid each, so unlike cluster_hashes a radius cannot chain
+MONITOR_HASH_RADIUS = int(os.environ.get("AB_MONITOR_HASH_RADIUS", "1"))
+MONITOR_MAX_EVENTS = int(os.environ.get("AB_MONITOR_MAX_EVENTS", "100"))
+
+# Captures of a variant within the window before it counts as active
+ACTIVE_MIN_CAPTURES = 2
+
+HASH_BITS = 64
+
+EVENT_TEST_STARTED = "test_started"
+EVENT_VARIANTS_CHANGED = "variants_changed"
+EVENT_TEST_ENDED = "test_ended"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS watches (
+    url TEXT PRIMARY KEY,
+    interval_seconds REAL NOT NULL,
+    captures_per_run INTEGER NOT NULL,
+    window_captures INTEGER NOT NULL,
+    hash_types TEXT NOT NULL,
+    hash_radius INTEGER NOT NULL,
+    viewport_width INTEGER NOT NULL,
+    viewport_height INTEGER NOT NULL,
+    created REAL NOT NULL,
+    next_run REAL NOT NULL,
+    last_run REAL,
+    last_error TEXT,
+    active_variants TEXT
+);
+CREATE INDEX IF NOT EXISTS watches_next_run ON watches (next_run);
+
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    captured_at REAL NOT NULL,
+    signature TEXT NOT NULL,
+    variant INTEGER NOT NULL,
+    distance INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS captures_url_time ON captures (url, captured_at);
+
+CREATE TABLE IF NOT EXISTS variants (
+    url TEXT NOT NULL,
+    variant INTEGER NOT NULL,
+    bit_counts TEXT NOT NULL,
+    captures INTEGER NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (url, variant)
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    variants TEXT NOT NULL,
+    previous_variants TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_url_time ON events (url, at);
+"""
+
+
+@dataclass
+class Watch:
+    url: str
+    interval_seconds: float = 3600
+    captures_per_run: int = 3
+    window_captures: int = 12
+    hash_types: Sequence[str] = ("phash",)
+    hash_radius: int = MONITOR_HASH_RADIUS
+    viewport_width: int = 1920
+    viewport_height: int = 1080
+
+
+def format_signature(signature: Signature) -> str:
+    return ":".join(format(value, "016x") for value in signature)
+
+
+def parse_signature(text: str) -> Signature:
+    return tuple(int(part, 16) for part in text.split(":"))
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    return None if timestamp is None else datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def _bits(value: int) -> List[int]:
+    return [value >> bit & 1 for bit in range(HASH_BITS)]
+
+
+def centroid(bit_counts: List[List[int]], count: int) -> Signature:
+    """Bitwise majority of a variant's members, per hash type."""
+    return tuple(
+        sum(1 << bit for bit, ones in enumerate(counts) if ones * 2 > count)
+        for counts in bit_counts
+    )
+
+
+def active_set(recent_variants: Sequence[int]) -> List[int]:
+    """Variants that appear at least ACTIVE_MIN_CAPTURES times in the recent captures."""
+    counts: Dict[int, int] = {}
+    for variant in recent_variants:
+        counts[variant] = counts.get(variant, 0) + 1
+    return sorted(variant for variant, count in counts.items() if count >= ACTIVE_MIN_CAPTURES)
+
+
+def transition(previous: Optional[List[int]], current: List[int]) -> Optional[str]:
+    """Event kind for a change of active variant set, or None."""
+    was_test = previous is not None and len(previous) > 1
+    if len(current) > 1:
+        if not was_test:
+            return EVENT_TEST_STARTED
+        return EVENT_VARIANTS_CHANGED if current != previous else None
+    return EVENT_TEST_ENDED if was_test else None
+
+
+class MonitorStore:
+    """
+    SQLite history of watched URLs. Methods block; call them through
+    asyncio.to_thread from handlers.
+    """
+
+    def __init__(self, path: str = MONITOR_DB, max_events: int = MONITOR_MAX_EVENTS):
+        self.path = path
+        self.max_events = max(1, max_events)
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def upsert_watch(self, watch: Watch, run_now: bool = True) -> Dict[str, Any]:
+        """
+        Add or update a watch. Changing its hash settings discards the URL's
+        variants, whose centroids would no longer be comparable.
+        """
+        now = time.time()
+        hash_types = json.dumps(list(watch.hash_types))
+        with self._lock:
+            db = self._db()
+            with db:
+                existing = db.execute("SELECT * FROM watches WHERE url = ?", (watch.url,)).fetchone()
+                if existing is not None and (existing["hash_types"], existing["hash_radius"]) != (hash_types, watch.hash_radius):
+                    db.execute("DELETE FROM variants WHERE url = ?", (watch.url,))
+                    db.execute("DELETE FROM captures WHERE url = ?", (watch.url,))
+                    db.execute("UPDATE watches SET active_variants = NULL WHERE url = ?", (watch.url,))
+                if run_now or existing is None or existing["last_run"] is None:
+                    next_run = now
+                else:
+                    next_run = existing["last_run"] + watch.interval_seconds
+                db.execute(
+                    """
+                    INSERT INTO watches (url, interval_seconds, captures_per_run, window_captures, hash_types,
+                                         hash_radius, viewport_width, viewport_height, created, next_run)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (url) DO UPDATE SET
+                        interval_seconds = excluded.interval_seconds,
+                        captures_per_run = excluded.captures_per_run,
+                        window_captures = excluded.window_captures,
+                        hash_types = excluded.hash_types,
+                        hash_radius = excluded.hash_radius,
+                        viewport_width = excluded.viewport_width,
+                        viewport_height = excluded.viewport_height,
+                        next_run = excluded.next_run
+                    """,
+                    (watch.url, watch.interval_seconds, watch.captures_per_run, watch.window_captures, hash_types,
+                     watch.hash_radius, watch.viewport_width, watch.viewport_height, now, next_run)
+                )
+        return self.watch_status(watch.url)
+
+    def delete_watch(self, url: str, keep_history: bool = True) -> bool:
+        with self._lock:
+            db = self._db()
+            with db:
+                deleted = db.execute("DELETE FROM watches WHERE url = ?", (url,)).rowcount
+                if not keep_history:
+                    for table in ("captures", "variants", "events"):
+                        db.execute(f"DELETE FROM {table} WHERE url = ?", (url,))
+        return bool(deleted)
+
+    @staticmethod
+    def _watch(row: sqlite3.Row) -> Watch:
+        return Watch(
+            url=row["url"],
+            interval_seconds=row["interval_seconds"],
+            captures_per_run=row["captures_per_run"],
+            window_captures=row["window_captures"],
+            hash_types=json.loads(row["hash_types"]),
+            hash_radius=row["hash_radius"],
+            viewport_width=row["viewport_width"],
+            viewport_height=row["viewport_height"]
+        )
+
+    def due_watches(self, now: float) -> List[Watch]:
+        with self._lock:
+            rows = self._db().execute("SELECT * FROM watches WHERE next_run <= ? ORDER BY next_run", (now,)).fetchall()
+        return [self._watch(row) for row in rows]
+
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            row = self._db().execute("SELECT MIN(next_run) AS next_run FROM watches").fetchone()
+        return row["next_run"]
+
+    def record_failure(self, url: str, error: str, now: float):
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute(
+                    "UPDATE watches SET last_run = ?, last_error = ?, next_run = ? + interval_seconds WHERE url = ?",
+                    (now, error, now, url)
+                )
+
+    def record_run(self, watch: Watch, signatures: List[Signature], now: float) -> List[Dict[str, Any]]:
+        """
+        Assign new captures to the nearest variant centroids, update the
+        centroids and the URL's active variant set, and return any events.
+        """
+        with self._lock:
+            db = self._db()
+            with db:
+                variants = {
+                    row["variant"]: {"bit_counts": json.loads(row["bit_counts"]), "captures": row["captures"]}
+                    for row in db.execute("SELECT * FROM variants WHERE url = ?", (watch.url,))
+                }
+                for signature in signatures:
+                    nearest, nearest_distance = None, None
+                    for variant, state in sorted(variants.items()):
+                        distance = signature_distance(signature, centroid(state["bit_counts"], state["captures"]))
+                        if distance <= watch.hash_radius and (nearest_distance is None or distance < nearest_distance):
+                            nearest, nearest_distance = variant, distance
+                    if nearest is None:
+                        nearest, nearest_distance = max(variants, default=0) + 1, 0
+                        variants[nearest] = {"bit_counts": [[0] * HASH_BITS for _ in signature], "captures": 0}
+                        db.execute(
+                            "INSERT INTO variants (url, variant, bit_counts, captures, first_seen, last_seen) VALUES (?, ?, '[]', 0, ?, ?)",
+                            (watch.url, nearest, now, now)
+                        )
+                    state = variants[nearest]
+                    for counts, value in zip(state["bit_counts"], signature):
+                        for bit, set_bit in enumerate(_bits(value)):
+                            counts[bit] += set_bit
+                    state["captures"] += 1
+                    db.execute(
+                        "UPDATE variants SET bit_counts = ?, captures = ?, last_seen = ? WHERE url = ? AND variant = ?",
+                        (json.dumps(state["bit_counts"]), state["captures"], now, watch.url, nearest)
+                    )
+                    db.execute(
+                        "INSERT INTO captures (url, captured_at, signature, variant, distance) VALUES (?, ?, ?, ?, ?)",
+                        (watch.url, now, format_signature(signature), nearest, nearest_distance)
+                    )
+
+                recent = [
+                    row["variant"] for row in db.execute(
+                        "SELECT variant FROM captures WHERE url = ? ORDER BY captured_at DESC, id DESC LIMIT ?",
+                        (watch.url, watch.window_captures)
+                    )
+                ]
+                current = active_set(recent)
+                row = db.execute("SELECT active_variants FROM watches WHERE url = ?", (watch.url,)).fetchone()
+                previous = json.loads(row["active_variants"]) if row is not None and row["active_variants"] else None
+                events = []
+                kind = transition(previous, current)
+                if kind is not None:
+                    db.execute(
+                        "INSERT INTO events (url, at, kind, variants, previous_variants) VALUES (?, ?, ?, ?, ?)",
+                        (watch.url, now, kind, json.dumps(current), json.dumps(previous or []))
+                    )
+                    events.append({"url": watch.url, "at": now, "kind": kind, "variants": current, "previous_variants": previous or []})
+                    db.execute(
+                        "DELETE FROM events WHERE url = ? AND id NOT IN "
+                        "(SELECT id FROM events WHERE url = ? ORDER BY at DESC, id DESC LIMIT ?)",
+                        (watch.url, watch.url, self.max_events)
+                    )
+                # Captures older than the window no longer decide anything; the centroids keep their counts
+                db.execute(
+                    "DELETE FROM captures WHERE url = ? AND id NOT IN "
+                    "(SELECT id FROM captures WHERE url = ? ORDER BY captured_at DESC, id DESC LIMIT ?)",
+                    (watch.url, watch.url, watch.window_captures)
+                )
+                db.execute(
+                    "UPDATE watches SET last_run = ?, last_error = NULL, next_run = ? + interval_seconds, active_variants = ? WHERE url = ?",
+                    (now, now, json.dumps(current), watch.url)
+                )
+        return events
+
+    def watch_status(self, url: str, events_limit: int = 20) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT * FROM watches WHERE url = ?", (url,)).fetchone()
+            variants = db.execute("SELECT * FROM variants WHERE url = ? ORDER BY variant", (url,)).fetchall()
+            events = db.execute(
+                "SELECT * FROM events WHERE url = ? ORDER BY at DESC, id DESC LIMIT ?", (url, events_limit)
+            ).fetchall()
+            total = db.execute("SELECT COUNT(*) AS n FROM captures WHERE url = ?", (url,)).fetchone()["n"]
+        if row is None and not variants and not events:
+            return None
+
+        status: Dict[str, Any] = {"url": url, "watched": row is not None, "captures_stored": total}
+        if row is not None:
+            active = json.loads(row["active_variants"]) if row["active_variants"] else []
+            status.update({
+                "interval_seconds": row["interval_seconds"],
+                "captures_per_run": row["captures_per_run"],
+                "window_captures": row["window_captures"],
+                "hash_types": json.loads(row["hash_types"]),
+                "hash_radius": row["hash_radius"],
+                "last_run": _iso(row["last_run"]),
+                "next_run": _iso(row["next_run"]),
+                "last_error": row["last_error"],
+                "active_variants": active,
+                "test_running": len(active) > 1
+            })
+        status["variants"] = [
+            {
+                "variant": variant["variant"],
+                "centroid": format_signature(centroid(json.loads(variant["bit_counts"]), variant["captures"])),
+                "captures": variant["captures"],
+                "first_seen": _iso(variant["first_seen"]),
+                "last_seen": _iso(variant["last_seen"])
+            }
+            for variant in variants
+        ]
+        status["events"] = [
+            {
+                "at": _iso(event["at"]),
+                "kind": event["kind"],
+                "variants": json.loads(event["variants"]),
+                "previous_variants": json.loads(event["previous_variants"])
+            }
+            for event in events
+        ]
+        return status
+
+    def watched_urls(self) -> List[str]:
+        with self._lock:
+            return [row["url"] for row in self._db().execute("SELECT url FROM watches ORDER BY url")]
+
+
+class Monitor:
+    """
+    Background scheduler that samples due watches with the shared browser
+    and analysis pools and records the results in a MonitorStore.
+    """
+
+    def __init__(
+        self,
+        store: MonitorStore,
+        browser_pool,
+        analysis_pool,
+        poll_seconds: float = MONITOR_POLL_SECONDS,
+        max_concurrent_runs: int = MONITOR_MAX_CONCURRENT_RUNS
+    ):
+        self.store = store
+        self.browser_pool = browser_pool
+        self.analysis_pool = analysis_pool
+        self.poll_seconds = poll_seconds
+        self._runs = asyncio.Semaphore(max(1, max_concurrent_runs))
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        for task in list(self._running.values()):
+            task.cancel()
+        await asyncio.gather(self._task, *self._running.values(), return_exceptions=True)
+        self._task = None
+        self._running.clear()
+        await asyncio.to_thread(self.store.close)
+
+    def wake(self):
+        """Look for due watches now (e.g. after a watch was added)."""
+        self._wake.set()
+
+    async def _loop(self):
+        while True:
+            try:
+                now = time.time()
+                for watch in await asyncio.to_thread(self.store.due_watches, now):
+                    if watch.url not in self._running:
+                        task = asyncio.create_task(self._run(watch))
+                        self._running[watch.url] = task
+                        task.add_done_callback(lambda _, url=watch.url: self._running.pop(url, None))
+                next_due = await asyncio.to_thread(self.store.next_due)
+            except Exception as e:
+                logger.error("Monitor scheduling failed: %s", e)
+                next_due = None
+            delay = self.poll_seconds if next_due is None else min(self.poll_seconds, max(0.0, next_due - time.time()))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(delay, 0.1))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, watch: Watch):
+        async with self._runs:
+            now = time.time()
+            try:
+                signatures = await self.sample(watch)
+                if not signatures:
+                    raise RuntimeError("No screenshots captured")
+                events = await asyncio.to_thread(self.store.record_run, watch, signatures, now)
+                for event in events:
+                    logger.info("A/B test monitor: %s on %s (variants %s)", event["kind"], watch.url, event["variants"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Monitoring run for %s failed: %s", watch.url, e)
+                await asyncio.to_thread(self.store.record_failure, watch.url, str(e), now)
+
+    async def sample(self, watch: Watch) -> List[Signature]:
+        """Capture and hash `captures_per_run` screenshots of a watched URL."""
+        spec = CaptureSpec(
+            url=watch.url,
+            viewport_width=watch.viewport_width,
+            viewport_height=watch.viewport_height,
+            network=JobNetwork(NetworkPolicy())
+        )
+        frame_store = FrameStore()
+        tasks = []
+
+        async def start_hashing(capture):
+            if not capture.ok:
+                return
+            blob, frame = frame_store.put_png(capture.screenshot)
+            tasks.append(asyncio.ensure_future(
+                self.analysis_pool.run(decode_and_hash, blob, frame, list(watch.hash_types))
+            ))
+
+        try:
+            scheduler = CaptureScheduler(self.browser_pool, max_concurrency=watch.captures_per_run)
+            await scheduler.run(spec, watch.captures_per_run, on_capture=start_hashing)
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            frame_store.close()
+        return [
+            tuple(hashes[hash_type] for hash_type in watch.hash_types)
+            for result in results if not isinstance(result, BaseException)
+            for hashes, _ in [result]
+        ]
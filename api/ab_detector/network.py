@@ -0,0 +1,295 @@
+"""
+Network layer for detect_ab_test captures, built on Playwright routing.
+
+Every capture runs in a fresh browser context, so without help each one
+downloads the whole page again. JobNetwork is installed on every context
+of one job and:
+
+* aborts requests the layout does not depend on: known analytics, ads and
+  session-recording hosts, and audio/video media;
+* serves static resources (stylesheets, scripts, fonts, images) fetched by
+  an earlier context of the same job from memory. Only explicitly cacheable
+  responses are reused: as they are while Cache-Control max-age/s-maxage,
+  immutable or a future Expires says they are fresh, and after revalidating
+  with the stored ETag / Last-Modified otherwise. Captures rotate their
+  User-Agent, so a response is only reused for requests with the same
+  values of the request headers its `Vary` lists. Replayed responses carry
+  no Set-Cookie, so one context's cookies never leak into another.
+
+Documents, non-GET requests and experiment/feature-flag scripts are never
+cached or blocked, so every capture is still bucketed independently.
+
+Configuration (environment variables):
+    AB_RESOURCE_CACHE_MAX_MB    memory cap for one job's cached responses (default: 64)
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+RESOURCE_CACHE_MAX_BYTES = int(os.environ.get("AB_RESOURCE_CACHE_MAX_MB", "64")) * 1024 * 1024
+
+# Analytics, advertising and session-recording hosts (matched on the host and its parent domains)
+TRACKER_HOSTS = (
+    "google-analytics.com", "analytics.google.com", "doubleclick.net", "googlesyndication.com",
+    "googleadservices.com", "adservice.google.com", "connect.facebook.net", "facebook.com/tr",
+    "bat.bing.com", "clarity.ms", "hotjar.com", "hotjar.io", "fullstory.com", "mouseflow.com",
+    "segment.io", "segment.com", "mixpanel.com", "amplitude.com", "heap.io", "heapanalytics.com",
+    "snap.licdn.com", "px.ads.linkedin.com", "analytics.tiktok.com", "ads-twitter.com",
+    "static.ads-twitter.com", "criteo.com", "criteo.net", "taboola.com", "outbrain.com",
+    "adnxs.com", "quantserve.com", "scorecardresearch.com", "newrelic.com", "nr-data.net",
+)
+
+# Experimentation and feature-flag vendors. Their scripts assign the variant, so
+# they always go to the network and are never blocked (even if a deny pattern matches)
+EXPERIMENT_HOSTS = (
+    "optimizely.com", "abtasty.com", "visualwebsiteoptimizer.com", "vwo.com", "launchdarkly.com",
+    "split.io", "optimize.google.com", "kameleoon.com", "kameleoon.eu", "convertexperiments.com",
+    "tt.omtrdc.net", "dynamicyield.com", "monetate.net", "statsig.com", "growthbook.io",
+    "sitespect.com", "conductrics.com", "eppo.cloud",
+)
+
+# Resource types that never affect a screenshot
+BLOCKED_RESOURCE_TYPES = ("media",)
+
+# Resource types eligible for the shared cache
+CACHEABLE_RESOURCE_TYPES = ("stylesheet", "script", "font", "image")
+
+# Response headers that no longer apply to a body passed on from route.fetch (already decoded)
+_DROPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+# Response headers that belong to the context that fetched a response, not to its replays
+_UNCACHED_HEADERS = ("set-cookie",)
+
+_MAX_AGE = re.compile(r"(?:^|[,\s])(?:s-)?max-age\s*=\s*\"?(\d+)")
+
+
+def _host_matches(host: str, path: str, patterns: Sequence[str]) -> bool:
+    path = path or "/"
+    for pattern in patterns:
+        pattern_host, _, pattern_path = pattern.partition("/")
+        if (host == pattern_host or host.endswith("." + pattern_host)) and path.startswith("/" + pattern_path):
+            return True
+    return False
+
+
+@dataclass
+class NetworkPolicy:
+    """
+    Which requests to block. deny/allow entries are host suffixes
+    (optionally with a path prefix, e.g. "facebook.com/tr") or regular
+    expressions prefixed with "re:". allow wins over deny.
+    """
+    block_trackers: bool = True
+    deny: List[str] = field(default_factory=list)
+    allow: List[str] = field(default_factory=list)
+    blocked_resource_types: Sequence[str] = BLOCKED_RESOURCE_TYPES
+
+    def __post_init__(self):
+        self._deny_hosts = [p for p in self.deny if not p.startswith("re:")]
+        self._deny_regex = [re.compile(p[3:]) for p in self.deny if p.startswith("re:")]
+        self._allow_hosts = [p for p in self.allow if not p.startswith("re:")]
+        self._allow_regex = [re.compile(p[3:]) for p in self.allow if p.startswith("re:")]
+
+    def is_experiment(self, url: str) -> bool:
+        parts = urlsplit(url)
+        return _host_matches(parts.hostname or "", parts.path, EXPERIMENT_HOSTS)
+
+    def blocks(self, url: str, resource_type: str) -> bool:
+        parts = urlsplit(url)
+        host, path = parts.hostname or "", parts.path
+        if _host_matches(host, path, self._allow_hosts) or any(r.search(url) for r in self._allow_regex):
+            return False
+        if self.is_experiment(url):
+            return False
+        if resource_type in self.blocked_resource_types:
+            return True
+        if self.block_trackers and _host_matches(host, path, TRACKER_HOSTS):
+            return True
+        return _host_matches(host, path, self._deny_hosts) or any(r.search(url) for r in self._deny_regex)
+
+
+@dataclass
+class CachedResponse:
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    must_revalidate: bool
+
+
+@dataclass
+class NetworkStats:
+    requests_blocked: int = 0
+    requests_from_cache: int = 0
+    requests_revalidated: int = 0
+    requests_fetched: int = 0
+    bytes_fetched: int = 0
+    bytes_saved: int = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+def _vary(headers: Dict[str, str]) -> Tuple[str, ...]:
+    """The request header names a response's Vary lists, lowercased and sorted."""
+    return tuple(sorted({name.strip().lower() for name in headers.get("vary", "").split(",") if name.strip()}))
+
+
+def _fresh(headers: Dict[str, str], cache_control: str) -> bool:
+    """Whether the response explicitly says it may be reused without revalidation."""
+    if "no-cache" in cache_control or "must-revalidate" in cache_control:
+        return False
+    if "immutable" in cache_control:
+        return True
+    max_ages = [int(age) for age in _MAX_AGE.findall(cache_control)]
+    if max_ages:
+        return min(max_ages) > 0
+    try:
+        return parsedate_to_datetime(headers["expires"]).timestamp() > time.time()
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def _cacheable(headers: Dict[str, str]) -> Optional[bool]:
+    """
+    None if the response must not be reused, else whether it needs
+    revalidation before reuse. Responses without explicit freshness are only
+    reused after revalidation, and not at all without a validator.
+    """
+    cache_control = headers.get("cache-control", "").lower()
+    if "no-store" in cache_control or "private" in cache_control or "*" in _vary(headers):
+        return None
+    if _fresh(headers, cache_control):
+        return False
+    if "etag" not in headers and "last-modified" not in headers:
+        return None
+    return True
+
+
+class JobNetwork:
+    """Routing handler shared by every context of one detect_ab_test job."""
+
+    def __init__(self, policy: NetworkPolicy, cache: bool = True, max_cache_bytes: int = RESOURCE_CACHE_MAX_BYTES):
+        self.policy = policy
+        self.cache_enabled = cache
+        self.max_cache_bytes = max_cache_bytes
+        self.stats = NetworkStats()
+        # Keyed by URL plus the values of the request headers the response varies on (see _key)
+        self._cache: Dict[str, CachedResponse] = {}
+        self._cache_bytes = 0
+        # URL -> request header names its last stored response varies on
+        self._vary: Dict[str, Tuple[str, ...]] = {}
+        # Concurrent contexts requesting the same URL wait for the first fetch
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def install(self, context):
+        await context.route("**/*", self.handle)
+
+    async def handle(self, route, request):
+        try:
+            await self._handle(route, request)
+        except Exception as e:
+            # Fail the request rather than leave it hanging; this also fails quietly
+            # when the context was closed underneath the route
+            logger.debug("Routing %s failed: %s", request.url, e)
+            try:
+                await route.abort("failed")
+            except Exception:
+                pass
+
+    async def _handle(self, route, request):
+        url = request.url
+        if self.policy.blocks(url, request.resource_type):
+            self.stats.requests_blocked += 1
+            await route.abort("blockedbyclient")
+            return
+
+        if (
+            not self.cache_enabled
+            or request.method != "GET"
+            or request.resource_type not in CACHEABLE_RESOURCE_TYPES
+            or self.policy.is_experiment(url)
+        ):
+            await route.continue_()
+            return
+
+        pending = self._in_flight.get(url)
+        if pending is not None:
+            await asyncio.shield(pending)
+
+        request_headers = await request.all_headers()
+        entry = self._cache.get(self._key(url, request_headers))
+        if entry is not None and not entry.must_revalidate:
+            self.stats.requests_from_cache += 1
+            self.stats.bytes_saved += len(entry.body)
+            await route.fulfill(status=entry.status, headers=entry.headers, body=entry.body)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[url] = future
+        try:
+            await self._fetch(route, request, request_headers, entry)
+        finally:
+            self._in_flight.pop(url, None)
+            future.set_result(None)
+
+    def _key(self, url: str, request_headers: Dict[str, str]) -> str:
+        """Cache key of a request: its URL, plus the header values the URL's responses vary on."""
+        names = self._vary.get(url)
+        if not names:
+            return url
+        return url + "".join(f"\n{name}: {request_headers.get(name, '')}" for name in names)
+
+    async def _fetch(self, route, request, request_headers: Dict[str, str], entry: Optional[CachedResponse]):
+        url = request.url
+        headers = dict(request.headers)
+        if entry is not None:
+            if entry.etag:
+                headers["if-none-match"] = entry.etag
+            if entry.last_modified:
+                headers["if-modified-since"] = entry.last_modified
+
+        response = await route.fetch(headers=headers)
+        if response.status == 304 and entry is not None:
+            self.stats.requests_revalidated += 1
+            self.stats.bytes_saved += len(entry.body)
+            await route.fulfill(status=entry.status, headers=entry.headers, body=entry.body)
+            return
+
+        body = await response.body()
+        self.stats.requests_fetched += 1
+        self.stats.bytes_fetched += len(body)
+        response_headers = {k: v for k, v in response.headers.items() if k.lower() not in _DROPPED_HEADERS}
+        await route.fulfill(status=response.status, headers=response_headers, body=body)
+
+        lowered = {k.lower(): v for k, v in response.headers.items()}
+        must_revalidate = _cacheable(lowered)
+        if response.status == 200 and must_revalidate is not None:
+            self._vary[url] = _vary(lowered)
+            self._store(self._key(url, request_headers), CachedResponse(
+                status=response.status,
+                headers={k: v for k, v in response_headers.items() if k.lower() not in _UNCACHED_HEADERS},
+                body=body,
+                etag=lowered.get("etag"),
+                last_modified=lowered.get("last-modified"),
+                must_revalidate=must_revalidate
+            ))
+
+    def _store(self, key: str, entry: CachedResponse):
+        previous = self._cache.pop(key, None)
+        if previous is not None:
+            self._cache_bytes -= len(previous.body)
+        if self._cache_bytes + len(entry.body) > self.max_cache_bytes:
+            return
+        self._cache[key] = entry
+        self._cache_bytes += len(entry.body)
@@ -0,0 +1,375 @@
+"""
+Per-mode capture pipelines of detect_ab_test.
+
+A pipeline starts analysing each capture as the scheduler returns it and,
+once the captures are in, hands the analysis stage (analyse_frames in
+api/heavy.py) one entry per analysed capture: its frame, screenshot, hash
+signature and pixel digest.
+
+    * PixelPipeline: every screenshot is decoded and hashed while the
+      remaining captures are still in flight.
+    * StructuralPipeline: screenshots are decoded after capture, one per
+      distinct structural snapshot (see structure.py); without a snapshot
+      for every capture, every screenshot is decoded as in PixelPipeline.
+    * TiledPipeline: full page; tiles are hashed as captures arrive and
+      compared only where their hashes differ (see tiles.py).
+
+With adaptive sampling, each pipeline feeds the sampler the signature the
+captures are grouped by. A pipeline's shared memory belongs to the job's
+FrameStore; await `pending()` before closing it.
+"""
+
+import asyncio
+import hashlib
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from api.ab_detector.analysis import decode_and_hash, preview_png, stitch_png
+from api.ab_detector.analysis_pool import AnalysisPool, timed
+from api.ab_detector.artifacts import ArtifactStore
+from api.ab_detector.clustering import Signature, cluster_hashes
+from api.ab_detector.heatmap import StreamingVariance
+from api.ab_detector.masking import Rect, crop_box, mask_array
+from api.ab_detector.sampling import AdaptiveSampler
+from api.ab_detector.shared_frames import FrameStore, png_dimensions
+from api.ab_detector.structure import parse_snapshot, structure_signature
+from api.ab_detector.tiles import TiledCaptures
+
+
+class CapturePipeline:
+    """
+    Common state of the pipelines. After `collect`, `captures` holds the
+    analysed captures in capture order and `frames`, `screenshots`,
+    `screenshot_hashes` and `frame_digests` one entry per analysed capture;
+    `frames` is None for a capture that reuses the frame of an earlier one.
+    """
+
+    # Replace analyse_frames' pairwise frame comparison and sample previews (full page)
+    compare = None
+    preview = None
+
+    def __init__(
+        self,
+        pool: AnalysisPool,
+        frame_store: FrameStore,
+        artifact_store: ArtifactStore,
+        hash_types: Sequence[str],
+        variance: StreamingVariance,
+        sampler: Optional[AdaptiveSampler] = None,
+        ignore_regions: Sequence[Rect] = ()
+    ):
+        self.pool = pool
+        self.frame_store = frame_store
+        self.artifact_store = artifact_store
+        self.hash_types = list(hash_types)
+        self.variance = variance
+        self.sampler = sampler
+        self.ignore_regions = list(ignore_regions)
+        # Worker CPU seconds spent decoding (or hashing tiles of) screenshots
+        self.decode_cpu: List[float] = []
+        self.structure_cpu = 0.0
+        self.captures: List[Any] = []
+        self.frames: List[Any] = []
+        self.screenshots: List[Any] = []
+        self.screenshot_hashes: List[Signature] = []
+        self.frame_digests: List[str] = []
+        # Per decoded representative capture (index into the collected captures): (frame, signature, digest)
+        self._decoded: Dict[int, Tuple[Any, Signature, str]] = {}
+        self._collected: List[Any] = []
+
+    async def on_capture(self, capture):
+        """CaptureScheduler callback: start analysing a finished capture."""
+        raise NotImplementedError
+
+    async def collect(self, captured: Sequence[Any]):
+        """Finish analysing the successful captures and fill the per-capture lists."""
+        raise NotImplementedError
+
+    def pending(self) -> List[asyncio.Future]:
+        """Analysis tasks started so far."""
+        return []
+
+    @property
+    def snapshots(self) -> Optional[List[Any]]:
+        """Parsed structural snapshot per analysed capture, when the structural pass decided the grouping."""
+        return None
+
+    @property
+    def frames_decoded(self) -> int:
+        return len(self._decoded)
+
+    def _fill(self, captured: Sequence[Any], representative_of: List[int]):
+        # Only representatives are decoded; other captures reuse their hashes and digest
+        for k, capture in enumerate(captured):
+            if representative_of[k] not in self._decoded:
+                continue
+            frame, signature, digest = self._decoded[representative_of[k]]
+            self.captures.append(capture)
+            self.frames.append(frame if representative_of[k] == k else None)
+            self.screenshots.append(self._screenshot(capture))
+            self.screenshot_hashes.append(signature)
+            self.frame_digests.append(digest)
+
+    def _screenshot(self, capture):
+        return capture.screenshot
+
+    async def variance_grid(self, grid_size: int):
+        """Heatmap cells over every decoded capture (see heatmap.py)."""
+        return await self.variance.grid(grid_size)
+
+    async def store_sample(self, index: int) -> str:
+        """Artifact ID of an analysed capture's screenshot."""
+        return await asyncio.to_thread(self.artifact_store.put, self.screenshots[index])
+
+    def describe_detection(self, mode: str, block_results, compare_cpu) -> Dict[str, Any]:
+        """Which pass decided the result and the decoding and comparisons it took."""
+        return {
+            "mode": mode,
+            "decided_by": "pixel",
+            "frames_decoded": self.frames_decoded,
+            "pairs_compared": sum(len(block) for block in block_results),
+            "cpu_seconds": {
+                "structural": round(self.structure_cpu, 4),
+                "pixel": round(sum(self.decode_cpu) + sum(compare_cpu), 4)
+            }
+        }
+
+    def _masked_pixels(self, decoded_captures) -> List[Tuple[int, int, int]]:
+        raise NotImplementedError
+
+    def describe_masking(self, capture_selector: Optional[str], ignore_selectors: List[str]) -> Dict[str, Any]:
+        """Share of each decoded screenshot that later stages skip (cropped) or see as constant (masked)."""
+        decoded_captures = [self._collected[k] for k in self._decoded]
+        stats = self._masked_pixels(decoded_captures)
+        return {
+            "capture_selector": capture_selector,
+            "ignore_selectors": ignore_selectors,
+            "ignore_regions": [list(region) for region in self.ignore_regions],
+            "selector_regions_per_capture": round(
+                sum(len(c.mask_rects) for c in decoded_captures) / len(decoded_captures), 2
+            ),
+            "cropped_fraction": round(sum(1 - kept / total for total, kept, _ in stats) / len(stats), 4) if stats else 0.0,
+            "masked_fraction": round(sum(masked / kept for _, kept, masked in stats) / len(stats), 4) if stats else 0.0
+        }
+
+
+class PixelPipeline(CapturePipeline):
+    """Decodes and hashes every screenshot as it arrives."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Per capture index: (decode task, frame reference)
+        self._hash_tasks: Dict[int, Tuple[asyncio.Future, Any]] = {}
+        self._variance_tasks: List[asyncio.Future] = []
+        # Per decoded capture index: (screenshot pixels, pixels kept after cropping, pixels masked)
+        self._masked: Dict[int, Tuple[int, int, int]] = {}
+
+    async def _decode(self, blob, frame, masks, crop):
+        result, cpu = await self.pool.run(timed, decode_and_hash, blob, frame, self.hash_types, masks, crop)
+        self.decode_cpu.append(cpu)
+        return result
+
+    async def _add_to_heatmap(self, task, frame):
+        await task
+        await self.variance.add(frame)
+
+    def _start_decoding(self, capture) -> asyncio.Future:
+        # Ignored regions are cropped off or masked once here, before any stage reads the pixels
+        width, height = png_dimensions(capture.screenshot)
+        crop = crop_box(width, height, self.ignore_regions) if self.ignore_regions else None
+        if crop == (0, 0, width, height):
+            crop = None
+        masks = self.ignore_regions + capture.mask_rects
+        blob, frame = self.frame_store.put_png(capture.screenshot, crop)
+        if masks:
+            mask = mask_array(frame.shape[:2], masks, crop[:2] if crop is not None else (0, 0))
+            self._masked[capture.index] = (width * height, mask.size, int(np.count_nonzero(mask)))
+        task = asyncio.ensure_future(self._decode(blob, frame, masks, crop))
+        task.add_done_callback(lambda _: self.frame_store.discard(blob.name))
+        self._hash_tasks[capture.index] = (task, frame)
+        self._variance_tasks.append(asyncio.ensure_future(self._add_to_heatmap(task, frame)))
+        return task
+
+    async def on_capture(self, capture):
+        if not capture.ok:
+            return
+        # Decode and hash each screenshot while the remaining captures are still in flight
+        task = self._start_decoding(capture)
+        if self.sampler is not None:
+            try:
+                hashes, _ = await task
+            except Exception:
+                return
+            self.sampler.add(tuple(hashes[hash_type] for hash_type in self.hash_types))
+
+    def _representatives(self, captured: Sequence[Any]) -> List[int]:
+        """Per capture, the index of the capture whose decoded screenshot stands for it."""
+        return list(range(len(captured)))
+
+    async def collect(self, captured: Sequence[Any]):
+        self._collected = list(captured)
+        representative_of = self._representatives(captured)
+        for k in sorted(set(representative_of)):
+            capture = captured[k]
+            if capture.index not in self._hash_tasks:
+                self._start_decoding(capture)
+            task, frame = self._hash_tasks[capture.index]
+            try:
+                hashes, digest = await task
+            except Exception as e:
+                print(f"Error decoding screenshot {capture.index+1}: {str(e)}")
+                continue
+            self._decoded[k] = (frame, tuple(hashes[hash_type] for hash_type in self.hash_types), digest)
+        self._fill(captured, representative_of)
+
+    def pending(self) -> List[asyncio.Future]:
+        return [task for task, _ in self._hash_tasks.values()] + self._variance_tasks
+
+    async def variance_grid(self, grid_size: int):
+        await asyncio.gather(*self._variance_tasks, return_exceptions=True)
+        return await super().variance_grid(grid_size)
+
+    def _masked_pixels(self, decoded_captures) -> List[Tuple[int, int, int]]:
+        return [self._masked[c.index] for c in decoded_captures if c.index in self._masked]
+
+    def describe_masking(self, capture_selector: Optional[str], ignore_selectors: List[str]) -> Dict[str, Any]:
+        masking = super().describe_masking(capture_selector, ignore_selectors)
+        height, width = self._decoded[next(iter(self._decoded))][0].shape[:2]
+        masking["frame_size"] = [width, height]
+        return masking
+
+
+class StructuralPipeline(PixelPipeline):
+    """
+    Groups captures by structural snapshot first: captures with identical
+    snapshots share the decoded screenshot of the first of them (their
+    representative).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Parsed snapshot per capture index; None when it could not be read
+        self._snapshots: Dict[int, Any] = {}
+        self.structural = False
+        self.structure_groups: List[List[int]] = []
+
+    async def on_capture(self, capture):
+        if not capture.ok:
+            return
+        # Screenshots are decoded after capture, one per distinct snapshot
+        snapshot = self._snapshots[capture.index] = parse_snapshot(capture.structure)
+        if self.sampler is not None and snapshot is not None:
+            self.sampler.add(structure_signature(snapshot))
+
+    def _representatives(self, captured: Sequence[Any]) -> List[int]:
+        # Without a snapshot for every capture, fall back to decoding every screenshot
+        self.structural = all(self._snapshots.get(c.index) is not None for c in captured)
+        representative_of = super()._representatives(captured)
+        if self.structural:
+            structure_started = time.thread_time()
+            signatures = [structure_signature(self._snapshots[c.index]) for c in captured]
+            self.structure_groups = cluster_hashes(signatures, 0)
+            for members in self.structure_groups:
+                for k in members:
+                    representative_of[k] = members[0]
+            self.structure_cpu = time.thread_time() - structure_started
+        return representative_of
+
+    @property
+    def snapshots(self) -> Optional[List[Any]]:
+        if not self.structural:
+            return None
+        return [self._snapshots.get(c.index) for c in self.captures]
+
+    def describe_detection(self, mode: str, block_results, compare_cpu) -> Dict[str, Any]:
+        detection = super().describe_detection(mode, block_results, compare_cpu)
+        if not self.structural:
+            detection["fallback_reason"] = "No structural snapshot for some captures; every screenshot was analyzed"
+            return detection
+        # The decoding and comparisons the structural pass avoided
+        pairs_compared = detection["pairs_compared"]
+        distinct_screenshots = len({hashlib.blake2b(png, digest_size=16).digest() for png in self.screenshots})
+        frames_not_decoded = len(self.frames) - self.frames_decoded
+        pairs_not_compared = max(0, distinct_screenshots * (distinct_screenshots - 1) // 2 - pairs_compared)
+        decode_cost = sum(self.decode_cpu) / len(self.decode_cpu) if self.decode_cpu else 0
+        pair_cost = sum(compare_cpu) / pairs_compared if pairs_compared else 0
+        detection.update({
+            # One structural group: the snapshots alone show the captures are the same
+            "decided_by": "structural" if len(self.structure_groups) == 1 else "structural+pixel",
+            "structural_groups": len(self.structure_groups),
+            "frames_not_decoded": frames_not_decoded,
+            "pairs_not_compared": pairs_not_compared,
+            # Measured per-frame and per-pair worker CPU times this job, applied to the skipped work
+            "estimated_cpu_seconds_saved": round(frames_not_decoded * decode_cost + pairs_not_compared * pair_cost, 4)
+        })
+        return detection
+
+
+class TiledPipeline(CapturePipeline):
+    """
+    Full page: there is no page frame. Each capture's screenshot is an
+    analysed capture's list of PNG tiles; samples are stitched back into
+    one page for storage and previews.
+    """
+
+    def __init__(self, *args, tile_height: int, max_tiles: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tiled = TiledCaptures(
+            self.pool,
+            self.frame_store,
+            self.hash_types,
+            tile_height,
+            max_tiles,
+            self.ignore_regions,
+            cpu_seconds=self.decode_cpu
+        )
+        self._stitched: Dict[int, bytes] = {}
+
+    async def on_capture(self, capture):
+        if not capture.ok:
+            return
+        self.tiled.start(capture)
+        if self.sampler is not None:
+            try:
+                self.sampler.add(await self.tiled.signature(capture))
+            except Exception:
+                return
+
+    async def collect(self, captured: Sequence[Any]):
+        # Tiles are decoded per position when compared; the first capture of each page digest stands for it
+        captured = self._collected = await self.tiled.collect(captured)
+        page_digests = self.tiled.digests()
+        for k, (signature, digest) in enumerate(zip(self.tiled.signatures(), page_digests)):
+            self._decoded[k] = (captured[k].tiles if page_digests.index(digest) == k else None, signature, digest)
+        self._fill(captured, list(range(len(captured))))
+
+    def _screenshot(self, capture):
+        return capture.tiles
+
+    def pending(self) -> List[asyncio.Future]:
+        return self.tiled.pending()
+
+    @property
+    def frames_decoded(self) -> int:
+        return self.tiled.frames_decoded
+
+    @property
+    def report(self) -> Dict[str, Any]:
+        """Per-tile variation, filled by `compare`."""
+        return self.tiled.report
+
+    def compare(self, radius: int):
+        return self.tiled.compare(radius)
+
+    async def store_sample(self, index: int) -> str:
+        self._stitched[index] = await self.pool.run(stitch_png, self.screenshots[index])
+        return await asyncio.to_thread(self.artifact_store.put, self._stitched[index])
+
+    def preview(self, index: int):
+        return self.pool.run(preview_png, self._stitched[index])
+
+    def _masked_pixels(self, decoded_captures) -> List[Tuple[int, int, int]]:
+        # Of each hashed tile
+        return self.tiled.masked_pixels
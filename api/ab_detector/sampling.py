@@ -0,0 +1,88 @@
+"""
+Adaptive sampling for detect_ab_test.
+
+With adaptive sampling, num_captures becomes a budget. After each capture
+is hashed, the captures so far are clustered (see clustering.py) and
+sampling stops as soon as one of these holds:
+
+* no_variation: the first `identical_to_stop` captures all fall in one
+  cluster. The largest variant share that could still have gone unseen
+  (with 95% probability) is reported.
+* distribution_stable: at least `min_captures` were taken, more than one
+  variation was seen, and the Good-Turing estimate of the chance that the
+  next capture shows a new variation (clusters seen exactly once / captures)
+  is at most `new_variant_probability`. While rare variations keep
+  appearing as singletons this estimate stays high, so sampling continues.
+* budget_exhausted: num_captures were taken.
+
+Captures already in flight when sampling stops still complete and are
+analysed, so up to max_concurrency - 1 captures may follow the stop.
+"""
+
+from collections import Counter
+from typing import Dict, List, Optional
+
+from api.ab_detector.clustering import Signature, cluster_hashes
+
+STOP_NO_VARIATION = "no_variation"
+STOP_DISTRIBUTION_STABLE = "distribution_stable"
+STOP_BUDGET_EXHAUSTED = "budget_exhausted"
+
+
+class AdaptiveSampler:
+    def __init__(
+        self,
+        budget: int,
+        radius: int,
+        min_captures: int = 4,
+        identical_to_stop: int = 5,
+        new_variant_probability: float = 0.1
+    ):
+        self.budget = budget
+        self.radius = radius
+        self.min_captures = max(2, min_captures)
+        self.identical_to_stop = max(2, identical_to_stop)
+        self.new_variant_probability = new_variant_probability
+        self.signatures: List[Signature] = []
+        self.stop_reason: Optional[str] = None
+
+    def unseen_probability(self) -> float:
+        """Good-Turing estimate of the chance that the next capture is a new variation."""
+        if not self.signatures:
+            return 1.0
+        sizes = Counter(len(cluster) for cluster in cluster_hashes(self.signatures, self.radius))
+        return sizes[1] / len(self.signatures)
+
+    def add(self, signature: Signature):
+        """Record a hashed capture and decide whether sampling can stop."""
+        self.signatures.append(signature)
+        if self.stop_reason is not None:
+            return
+
+        count = len(self.signatures)
+        clusters = cluster_hashes(self.signatures, self.radius)
+        if len(clusters) == 1 and count >= self.identical_to_stop:
+            self.stop_reason = STOP_NO_VARIATION
+        elif (
+            len(clusters) > 1
+            and count >= self.min_captures
+            and self.unseen_probability() <= self.new_variant_probability
+        ):
+            self.stop_reason = STOP_DISTRIBUTION_STABLE
+
+    def should_stop(self) -> bool:
+        return self.stop_reason is not None
+
+    def summary(self, captures_started: int) -> Dict[str, object]:
+        identical = len(cluster_hashes(self.signatures, self.radius)) == 1
+        return {
+            "mode": "adaptive",
+            "budget": self.budget,
+            "captures_started": captures_started,
+            "captures_saved": self.budget - captures_started,
+            "stopping_reason": self.stop_reason or STOP_BUDGET_EXHAUSTED,
+            "new_variant_probability": round(self.unseen_probability(), 4),
+            # Largest variant share that n identical captures would miss with 5% probability: (1 - p)^n = 0.05
+            "max_unseen_variant_share": round(1 - 0.05 ** (1 / len(self.signatures)), 4)
+            if identical and self.signatures else None
+        }
@@ -0,0 +1,165 @@
+"""
+Shared-memory transport for screenshots between the event loop and the
+analysis worker processes.
+
+The parent process owns every segment: it copies each PNG into shared memory
+and allocates the buffer the worker decodes the RGB frame into, so frames are
+never pickled. Workers only attach to segments by name.
+
+Frames kept after a job (see capture_store.py) live in files instead and are
+memory-mapped by the workers; open_frame() reads either kind.
+"""
+
+import struct
+import sys
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+@dataclass(frozen=True)
+class FrameRef:
+    """
+    A decoded frame in shared memory: uint8 RGB of `shape` in segment `name`
+    and its uint8 grayscale of `shape[:2]` in segment `gray_name`.
+    """
+    name: str
+    shape: Tuple[int, int, int]
+    gray_name: str
+
+
+@dataclass(frozen=True)
+class MappedFrameRef:
+    """A stored frame: uint8 RGB of `shape` followed by its uint8 grayscale in the file at `path`."""
+    path: str
+    shape: Tuple[int, int, int]
+
+
+AnyFrameRef = Union[FrameRef, MappedFrameRef]
+
+
+@dataclass(frozen=True)
+class BlobRef:
+    """Name and length of a byte blob (an encoded PNG) in shared memory."""
+    name: str
+    size: int
+
+
+@dataclass(frozen=True)
+class StatsRef:
+    """Running per-pixel float32 mean and sum of squared deviations of `shape` (see heatmap.py)."""
+    mean_name: str
+    m2_name: str
+    shape: Tuple[int, int, int]
+
+
+def png_dimensions(data: bytes) -> Tuple[int, int]:
+    """Read (width, height) from a PNG's IHDR chunk without decoding it."""
+    if data[:8] != _PNG_SIGNATURE:
+        raise ValueError("Screenshot is not a PNG image")
+    width, height = struct.unpack('>II', data[16:24])
+    return width, height
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """Attach to a segment owned by another process."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Older versions always register with the resource tracker. Spawned workers
+    # share the parent's tracker, which de-duplicates names, so this is harmless.
+    return shared_memory.SharedMemory(name=name)
+
+
+def detach(*segments: shared_memory.SharedMemory):
+    """Close segments attached with attach()."""
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            # A view is still referenced (e.g. by a traceback); the mapping is
+            # released when it is garbage collected.
+            pass
+
+
+def frame_view(shm: shared_memory.SharedMemory, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+    """Numpy view of a frame segment (no copy)."""
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+@contextmanager
+def open_frame(ref: AnyFrameRef):
+    """Worker side: (rgb, gray) views of a shared-memory or file-backed frame, without copying."""
+    if isinstance(ref, MappedFrameRef):
+        # The mapping is released when the views are garbage collected
+        data = np.memmap(ref.path, dtype=np.uint8, mode='r')
+        size = int(np.prod(ref.shape))
+        yield data[:size].reshape(ref.shape), data[size:].reshape(ref.shape[:2])
+        return
+    segments = (attach(ref.name), attach(ref.gray_name))
+    try:
+        yield frame_view(segments[0], ref.shape), frame_view(segments[1], ref.shape[:2])
+    finally:
+        detach(*segments)
+
+
+class FrameStore:
+    """
+    Parent-side owner of the shared memory used by one detection job.
+    Call close() when the job is done to unlink every segment.
+    """
+
+    def __init__(self):
+        self._segments: Dict[str, shared_memory.SharedMemory] = {}
+
+    def _create(self, size: int) -> shared_memory.SharedMemory:
+        shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        self._segments[shm.name] = shm
+        return shm
+
+    def put_png(self, data: bytes, crop: Optional[Tuple[int, int, int, int]] = None) -> Tuple[BlobRef, FrameRef]:
+        """
+        Copy a PNG into shared memory and allocate its decoded frame buffers,
+        sized to `crop` (x, y, width, height) when the frame will be cropped.
+        """
+        width, height = png_dimensions(data) if crop is None else crop[2:]
+        blob = self.put_blob(data)
+        frame = self._create(width * height * 3)
+        gray = self._create(width * height)
+        return blob, FrameRef(frame.name, (height, width, 3), gray.name)
+
+    def put_blob(self, data: bytes) -> BlobRef:
+        """Copy encoded bytes into shared memory."""
+        blob = self._create(len(data))
+        blob.buf[:len(data)] = data
+        return BlobRef(blob.name, len(data))
+
+    def create_stats(self, shape: Tuple[int, int, int]) -> StatsRef:
+        """Allocate running variance buffers for frames of `shape`."""
+        size = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        return StatsRef(self._create(size).name, self._create(size).name, shape)
+
+    def view(self, ref: FrameRef) -> np.ndarray:
+        return frame_view(self._segments[ref.name], ref.shape)
+
+    def gray_view(self, ref: FrameRef) -> np.ndarray:
+        return frame_view(self._segments[ref.gray_name], ref.shape[:2])
+
+    def discard(self, name: str):
+        """Unlink a segment as soon as it is no longer needed."""
+        shm = self._segments.pop(name, None)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        for name in list(self._segments):
+            self.discard(name)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._segments)
@@ -0,0 +1,158 @@
+"""
+Structural snapshots for the A/B test detector's cheap first pass.
+
+Alongside each screenshot, a capture can record what the viewport is made
+of, read from the live page:
+
+* skeleton: the tag path of every visible element in the viewport (ids and
+  classes are left out, they are often generated per build or per session),
+  with image sources reduced to their path;
+* text: the visible text blocks, whitespace-normalised;
+* layout: bounding boxes of key elements (headings, buttons, links, images,
+  form fields, landmarks) rounded to LAYOUT_GRID_PX, with the computed
+  styles A/B tests commonly change (colours, font size and weight).
+
+Elements the caller asked to ignore (see masking.py) are left out, and
+with a selector-scoped capture only the captured element is read.
+
+Each part is reduced to a 64-bit digest, so a snapshot signature can be
+clustered with clustering.cluster_hashes (radius 0) like perceptual hashes.
+Any change to a part changes its digest: a near-duplicate hash would let a
+one-word headline test on a text-heavy page collide. Captures with equal
+signatures look the same as far as the snapshot can tell; captures that
+differ structurally still need pixels to show whether the difference is
+visible (rotating ads or clocks change the text but not the page).
+"""
+
+import hashlib
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from api.ab_detector.clustering import Signature
+
+# "pixel" decodes and compares every screenshot; "structural" decodes one per distinct snapshot
+DETECTION_MODES = ("pixel", "structural")
+
+STRUCTURE_PARTS = ("skeleton", "text", "layout")
+
+# Box coordinates are rounded to this many pixels so sub-pixel layout jitter is ignored
+LAYOUT_GRID_PX = 8
+
+# Snapshots stop after this many elements, so huge pages stay cheap to read
+MAX_ELEMENTS = 3000
+
+# Returns {skeleton: [path...], text: [block...], layout: [[key, x, y, w, h, style]...]}.
+# Elements matching ignoreSelectors are left out with their subtree; with a
+# rootSelector only that element is read, with boxes relative to it.
+SNAPSHOT_JS = """
+([gridPx, maxElements, ignoreSelectors, rootSelector]) => {
+    const skipped = new Set(['SCRIPT', 'STYLE', 'NOSCRIPT', 'TEMPLATE', 'META', 'LINK', 'HEAD']);
+    const key = new Set(['H1', 'H2', 'H3', 'BUTTON', 'A', 'IMG', 'INPUT', 'SELECT', 'TEXTAREA',
+                         'FORM', 'NAV', 'HEADER', 'FOOTER', 'VIDEO', 'PICTURE']);
+    const ignored = ignoreSelectors.join(',');
+    const root = rootSelector ? document.querySelector(rootSelector) : document.body;
+    const bounds = rootSelector && root ? root.getBoundingClientRect()
+        : {left: 0, top: 0, right: window.innerWidth, bottom: window.innerHeight};
+    const round = (v) => Math.round(v / gridPx) * gridPx;
+    const snapshot = {skeleton: [], text: [], layout: []};
+    let seen = 0;
+
+    const visit = (el, path) => {
+        if (seen++ >= maxElements || skipped.has(el.tagName)) return;
+        if (ignored && el.matches(ignored)) return;
+        const style = getComputedStyle(el);
+        if (style.display === 'none' || style.visibility === 'hidden' || style.opacity === '0') return;
+        const rect = el.getBoundingClientRect();
+        const inViewport = rect.width > 0 && rect.height > 0 &&
+            rect.bottom > bounds.top && rect.right > bounds.left &&
+            rect.top < bounds.bottom && rect.left < bounds.right;
+        const tag = el.tagName.toLowerCase();
+        const here = path + '/' + tag;
+
+        if (inViewport) {
+            let entry = here;
+            if (tag === 'img') {
+                try { entry += '[' + new URL(el.currentSrc || el.src, location.href).pathname + ']'; } catch (e) {}
+            }
+            snapshot.skeleton.push(entry);
+
+            const ownText = Array.from(el.childNodes)
+                .filter(n => n.nodeType === Node.TEXT_NODE)
+                .map(n => n.textContent).join(' ').replace(/\\s+/g, ' ').trim();
+            if (ownText) snapshot.text.push(ownText);
+
+            if (key.has(el.tagName) || el.getAttribute('role') === 'button') {
+                snapshot.layout.push([
+                    here, round(rect.left - bounds.left), round(rect.top - bounds.top),
+                    round(rect.width), round(rect.height),
+                    [style.color, style.backgroundColor, style.fontSize, style.fontWeight].join(' ')
+                ]);
+            }
+        }
+        for (const child of el.children) visit(child, here);
+    };
+
+    if (root) visit(root, '');
+    return snapshot;
+}
+"""
+
+
+@dataclass
+class Snapshot:
+    skeleton: List[str]
+    text: List[str]
+    layout: List[Tuple]
+
+    @classmethod
+    def from_page(cls, data: Dict[str, list]) -> "Snapshot":
+        return cls(
+            skeleton=list(data.get("skeleton", [])),
+            text=list(data.get("text", [])),
+            layout=[tuple(box) for box in data.get("layout", [])]
+        )
+
+    def features(self, part: str) -> List[str]:
+        if part == "layout":
+            return ["|".join(str(value) for value in box) for box in self.layout]
+        return getattr(self, part)
+
+
+def digest(tokens: Sequence[str]) -> int:
+    """64-bit digest of an ordered list of tokens."""
+    h = hashlib.blake2b(digest_size=8)
+    for token in tokens:
+        h.update(token.encode("utf-8"))
+        h.update(b"\0")
+    return int.from_bytes(h.digest(), "big")
+
+
+def structure_signature(snapshot: Snapshot) -> Signature:
+    """(skeleton, text, layout) digests, in STRUCTURE_PARTS order."""
+    return tuple(digest(snapshot.features(part)) for part in STRUCTURE_PARTS)
+
+
+def changed_parts(a: Signature, b: Signature) -> List[str]:
+    return [part for part, x, y in zip(STRUCTURE_PARTS, a, b) if x != y]
+
+
+def diff_snapshots(a: Snapshot, b: Snapshot, limit: int = 5) -> Dict[str, object]:
+    """What changed from snapshot `a` to `b`: text blocks added/removed and counts of changed elements."""
+    text_a, text_b = set(a.text), set(b.text)
+    layout_a, layout_b = set(a.features("layout")), set(b.features("layout"))
+    skeleton_a, skeleton_b = set(a.skeleton), set(b.skeleton)
+    return {
+        "text_added": [text for text in b.text if text not in text_a][:limit],
+        "text_removed": [text for text in a.text if text not in text_b][:limit],
+        "elements_changed": len(skeleton_a ^ skeleton_b),
+        "key_elements_moved_or_restyled": len(layout_a ^ layout_b)
+    }
+
+
+def parse_snapshot(data: Optional[Dict[str, list]]) -> Optional[Snapshot]:
+    if not data:
+        return None
+    try:
+        return Snapshot.from_page(data)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,292 @@
+"""
+Tile-based full-page analysis for the A/B test detector.
+
+A full-page screenshot multiplies decode memory and SSIM cost by the page
+height. Instead, a full-page capture takes one full-page screenshot (a
+single layout of the page), an analysis worker slices it into tiles of a
+fixed height (page coordinates, top to bottom, analysis.slice_png), and
+each tile is decoded only long enough to hash it (analysis.hash_png). For every tile position,
+the captures' perceptual tile hashes are clustered like whole screenshots,
+and only positions whose tiles differ (their pixel digests are not all
+equal) are decoded again and compared pixel by pixel, so the expensive work
+scales with the area that changes rather than with the page height. The
+gate is the exact digest rather than the perceptual hash because a small
+change inside a tall tile (a recoloured button) can leave the perceptual
+hash unchanged.
+
+Page-level differences and SSIM are the area-weighted average over tile
+positions: unchanged positions count as identical, and a tile that only one
+of two captures has (the pages differ in height) counts as fully different.
+
+Ignore regions (see masking.py) are in page coordinates and are applied to
+each tile they overlap.
+"""
+
+import asyncio
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from api.ab_detector.analysis import decode_and_hash, hash_png, slice_png
+from api.ab_detector.analysis_pool import AnalysisPool, timed
+from api.ab_detector.clustering import Signature, cluster_hashes
+from api.ab_detector.compare import compare_block, expand_matrices, plan_blocks
+from api.ab_detector.masking import Rect, crop_box, mask_array
+from api.ab_detector.shared_frames import FrameStore, png_dimensions
+
+# Height of the document in CSS pixels
+PAGE_HEIGHT_JS = """
+() => Math.max(
+    document.documentElement.scrollHeight,
+    document.body ? document.body.scrollHeight : 0
+)
+"""
+
+
+def tile_offsets(page_height: int, tile_height: int, max_tiles: int) -> List[Tuple[int, int]]:
+    """(top, height) of each tile covering the page, at most `max_tiles` of them."""
+    tiles = []
+    for top in range(0, max(1, page_height), tile_height):
+        if len(tiles) >= max_tiles:
+            break
+        tiles.append((top, min(tile_height, page_height - top) if page_height > 0 else tile_height))
+    return tiles
+
+
+def shift(rects: Sequence[Rect], top: int) -> List[Rect]:
+    """Page-coordinate rectangles relative to a tile starting at `top`."""
+    return [(x, y - top, w, h) for x, y, w, h in rects]
+
+
+class TiledCaptures:
+    """
+    Hashes the tiles of each full-page capture as it arrives and, once all
+    are in, compares the tile positions that differ. One instance per job;
+    its shared memory belongs to the job's FrameStore.
+    """
+
+    def __init__(
+        self,
+        pool: AnalysisPool,
+        frame_store: FrameStore,
+        hash_types: Sequence[str],
+        tile_height: int,
+        max_tiles: int,
+        ignore_regions: Sequence[Rect] = (),
+        cpu_seconds: Optional[List[float]] = None
+    ):
+        self.pool = pool
+        self.frame_store = frame_store
+        self.hash_types = list(hash_types)
+        self.tile_height = tile_height
+        self.max_tiles = max_tiles
+        self.ignore_regions = list(ignore_regions)
+        # Worker CPU seconds of every tile hashed or decoded
+        self.cpu_seconds = cpu_seconds if cpu_seconds is not None else []
+        self._tasks: Dict[int, asyncio.Future] = {}
+        # Per analysed capture, per tile: (hash signature, digest, pixels kept after cropping)
+        self.tiles: List[List[Tuple[Signature, str, int]]] = []
+        # (screenshot pixels, pixels kept after cropping, pixels masked) per hashed tile
+        self.masked_pixels: List[Tuple[int, int, int]] = []
+        self.frames_decoded = 0
+        self._captures: List[Any] = []
+        self.report: Dict[str, Any] = {}
+
+    def _tile_settings(self, png: bytes, tile: int, mask_rects: Sequence[Rect]):
+        width, height = png_dimensions(png)
+        top = tile * self.tile_height
+        crop = crop_box(width, height, shift(self.ignore_regions, top)) if self.ignore_regions else None
+        if crop == (0, 0, width, height):
+            crop = None
+        masks = shift(self.ignore_regions + list(mask_rects), top)
+        return width, height, crop, masks
+
+    async def _hash_tile(self, png: bytes, tile: int, mask_rects: Sequence[Rect]) -> Tuple[Signature, str, int]:
+        width, height, crop, masks = self._tile_settings(png, tile, mask_rects)
+        kept = crop[2] * crop[3] if crop is not None else width * height
+        if masks:
+            shape = (crop[3], crop[2]) if crop is not None else (height, width)
+            masked = int(np.count_nonzero(mask_array(shape, masks, crop[:2] if crop is not None else (0, 0))))
+            self.masked_pixels.append((width * height, kept, masked))
+        blob = self.frame_store.put_blob(png)
+        try:
+            (hashes, digest), cpu = await self.pool.run(timed, hash_png, blob, self.hash_types, masks, crop)
+        finally:
+            self.frame_store.discard(blob.name)
+        self.cpu_seconds.append(cpu)
+        return tuple(hashes[hash_type] for hash_type in self.hash_types), digest, kept
+
+    async def _slice(self, capture) -> List[bytes]:
+        # The capture's full-page screenshot covers its tiles from the top down
+        _, height = png_dimensions(capture.screenshot)
+        blob = self.frame_store.put_blob(capture.screenshot)
+        try:
+            tiles, cpu = await self.pool.run(
+                timed, slice_png, blob, tile_offsets(height, self.tile_height, self.max_tiles)
+            )
+        finally:
+            self.frame_store.discard(blob.name)
+        self.cpu_seconds.append(cpu)
+        return tiles
+
+    async def _hash_capture(self, capture) -> List[Tuple[Signature, str, int]]:
+        if not capture.tiles:
+            capture.tiles = await self._slice(capture)
+        return list(await asyncio.gather(*[
+            self._hash_tile(png, tile, capture.mask_rects) for tile, png in enumerate(capture.tiles)
+        ]))
+
+    def start(self, capture) -> asyncio.Future:
+        """Start slicing a capture's screenshot into tiles and hashing them in the analysis workers."""
+        task = asyncio.ensure_future(self._hash_capture(capture))
+        self._tasks[capture.index] = task
+        return task
+
+    def pending(self) -> List[asyncio.Future]:
+        """Hashing tasks started so far (to await before the job's shared memory is released)."""
+        return list(self._tasks.values())
+
+    def page_signature(self, tiles: Sequence[Tuple[Signature, str, int]]) -> Signature:
+        """Tile signatures concatenated in page order; tiles past the end of the page hash as 0."""
+        signature = [value for tile_signature, _, _ in tiles for value in tile_signature]
+        return tuple(signature + [0] * (self.max_tiles * len(self.hash_types) - len(signature)))
+
+    async def signature(self, capture) -> Signature:
+        return self.page_signature(await self._tasks[capture.index])
+
+    async def collect(self, captures: Sequence[Any]) -> List[Any]:
+        """Wait for every capture's tiles; returns the captures whose tiles were all hashed."""
+        collected = []
+        for capture in captures:
+            task = self._tasks.get(capture.index) or self.start(capture)
+            try:
+                tiles = await task
+            except Exception as e:
+                print(f"Error hashing screenshot {capture.index+1}: {str(e)}")
+                continue
+            self.tiles.append(list(tiles))
+            collected.append(capture)
+        self._captures = collected
+        return collected
+
+    def signatures(self) -> List[Signature]:
+        return [self.page_signature(tiles) for tiles in self.tiles]
+
+    def digests(self) -> List[str]:
+        """Per capture, a digest of its tile digests (bit-identical pages share it)."""
+        return ["".join(digest for _, digest, _ in tiles) for tiles in self.tiles]
+
+    async def _compare_position(self, tile: int, present: List[int]):
+        # Decode one frame per distinct tile digest and compare every pair of them
+        digests = [self.tiles[k][tile][1] for k in present]
+        unique_digests = list(dict.fromkeys(digests))
+        unique_of = [unique_digests.index(digest) for digest in digests]
+
+        async def decode(digest):
+            capture = self._captures[present[digests.index(digest)]]
+            png = capture.tiles[tile]
+            _, _, crop, masks = self._tile_settings(png, tile, capture.mask_rects)
+            blob, frame = self.frame_store.put_png(png, crop)
+            try:
+                _, cpu = await self.pool.run(timed, decode_and_hash, blob, frame, self.hash_types, masks, crop)
+            finally:
+                self.frame_store.discard(blob.name)
+            self.cpu_seconds.append(cpu)
+            return frame
+
+        frames = list(await asyncio.gather(*[decode(digest) for digest in unique_digests]))
+        self.frames_decoded += len(frames)
+
+        timed_blocks = await asyncio.gather(*[
+            self.pool.run(timed, compare_block, frames, block)
+            for block in plan_blocks(len(frames), self.pool.max_workers * 2)
+        ])
+        for frame in frames:
+            self.frame_store.discard(frame.name)
+            self.frame_store.discard(frame.gray_name)
+        block_results = [block for block, _ in timed_blocks]
+        diff, ssim = expand_matrices(unique_of, len(frames), block_results)
+        return diff, ssim, block_results, [cpu for _, cpu in timed_blocks]
+
+    async def compare(self, radius: int):
+        """
+        Page-level (difference matrix, SSIM matrix, block results, compare
+        CPU seconds) over the collected captures, comparing pixels only at
+        tile positions whose hashes differ. Tiles are compared with exact
+        SSIM, as the page SSIM is an area-weighted mean of full-resolution
+        tile scores. Fills `report` with per-tile variation.
+        """
+        n = len(self.tiles)
+        positions = max(len(tiles) for tiles in self.tiles)
+        diff_sum = np.zeros((n, n))
+        ssim_sum = np.zeros((n, n))
+        ssim_weight = np.zeros((n, n))
+        total_weight = np.zeros((n, n))
+        all_blocks, compare_cpu, tile_reports = [], [], []
+        area_compared = area_total = 0
+
+        # Positions are compared one after another so only one position's frames are decoded at a time
+        for tile in range(positions):
+            present = [k for k in range(n) if tile < len(self.tiles[k])]
+            area = np.zeros(n)
+            area[present] = [self.tiles[k][tile][2] for k in present]
+            # A pair's weight is the larger of its two tiles; a tile only one page has is fully different
+            weight = np.maximum.outer(area, area)
+            has = area > 0
+            one = has[:, None] != has[None, :]
+
+            groups = cluster_hashes([self.tiles[k][tile][0] for k in present], radius)
+            distinct = len({self.tiles[k][tile][1] for k in present})
+            diff = np.zeros((n, n))
+            ssim = np.ones((n, n))
+            entry = {
+                "tile": tile,
+                "top": tile * self.tile_height,
+                "captures": len(present),
+                # Perceptual variations at this position; pages too short to reach it count as one more
+                "variations": len(groups) + (1 if len(present) < n else 0),
+                "distinct_frames": distinct,
+                "compared": False
+            }
+            if distinct > 1:
+                tile_diff, tile_ssim, block_results, cpu = await self._compare_position(tile, present)
+                index = np.ix_(present, present)
+                diff[index], ssim[index] = tile_diff, tile_ssim
+                all_blocks.extend(block_results)
+                compare_cpu.extend(cpu)
+                area_compared += area.sum()
+                # SSIM is None for tiles of different heights (the last tile of pages of different lengths)
+                scores = [score for block in block_results for _, _, _, score, _ in block if score is not None]
+                entry.update({
+                    "compared": True,
+                    "max_difference_percentage": round(float(tile_diff.max()) * 100, 3),
+                    "min_ssim": round(min(scores), 4) if scores else None
+                })
+            area_total += area.sum()
+            tile_reports.append(entry)
+
+            diff[one] = 1.0
+            ssim[one] = 0.0
+            # Pairs where neither page reaches this tile have zero weight
+            diff_sum += weight * diff
+            known = np.isfinite(ssim)
+            ssim_sum += np.where(known, weight * np.nan_to_num(ssim), 0.0)
+            ssim_weight += np.where(known, weight, 0.0)
+            total_weight += weight
+
+        page_diff = diff_sum / np.where(total_weight > 0, total_weight, 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            page_ssim = np.where(ssim_weight > 0, ssim_sum / ssim_weight, np.nan)
+        np.fill_diagonal(page_ssim, 1.0)
+
+        self.report = {
+            "tile_height": self.tile_height,
+            "max_tiles": self.max_tiles,
+            "tiles_per_capture": {"min": min(len(t) for t in self.tiles), "max": positions},
+            "tiles_hashed": sum(len(tiles) for tiles in self.tiles),
+            "tiles_compared": sum(1 for entry in tile_reports if entry["compared"]),
+            "frames_decoded": self.frames_decoded,
+            "pixels_compared_fraction": round(float(area_compared / area_total), 4) if area_total else 0.0,
+            "tiles": tile_reports
+        }
+        return page_diff, page_ssim, all_blocks, compare_cpu
@@ -0,0 +1,4 @@
+"""
+Support modules for the pivot_ab_test_data tool in api/heavy.py
+(the vectorized long-to-report pivot).
+"""
@@ -5,28 +5,133 @@ For lightweight tools, see api/index.py
 """
 
 from opal_tools_sdk import ToolsService, tool
-from pydantic import BaseModel, Field
-from fastapi import FastAPI
+from pydantic import BaseModel, Field, ValidationError
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from typing import List, Dict, Any, Optional
-import subprocess
 import json
-import tempfile
-import os
 import asyncio
-from playwright.async_api import async_playwright
-from PIL import Image
-import io
+import os
+import re
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import time
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
-import imagehash
-import base64
-import random
 import pandas as pd
+from api.ab_detector.analysis import encode_png, encode_preview, hash_frame
+from api.ab_detector.analysis_pool import AnalysisPool, timed
+from api.ab_detector.artifacts import (
+    ARTIFACT_ROUTE, FORMATS, VARIANTS, ArtifactStore, artifact_url, is_artifact_id, iter_file, render
+)
+from api.ab_detector.browser_pool import BrowserPool
+from api.ab_detector.capture import CaptureLimits, CaptureScheduler, CaptureSpec, READINESS_MODES
+from api.ab_detector.capture_shards import CAPTURE_SHARDS, CaptureShards
+from api.ab_detector.capture_store import CaptureStore, is_job_id, new_job_id
+from api.ab_detector.clustering import HASH_RADIUS, HASH_TYPES, cluster_hashes, max_internal_distance
+from api.ab_detector.compare import (
+    SSIM_MODES, cluster_statistics, coarse_matrix, compare_block, decision_levels, expand_matrices, plan_blocks,
+    upper_triangle
+)
+from api.ab_detector.heatmap import HEATMAP_GRID_SIZE, StreamingVariance, compact_heatmap, hot_spots
+from api.ab_detector.masking import parse_regions
+from api.ab_detector.monitor import MONITOR_HASH_RADIUS, Monitor, MonitorStore, Watch
+from api.ab_detector.network import JobNetwork, NetworkPolicy
+from api.ab_detector.pipelines import PixelPipeline, StructuralPipeline, TiledPipeline
+from api.ab_detector.sampling import AdaptiveSampler
+from api.ab_detector.shared_frames import FrameStore
+from api.ab_detector.structure import DETECTION_MODES, diff_snapshots, parse_snapshot
+from api.ab_pivot.pivot import pivot_records
+from api.lighthouse.cache import LighthouseCache
+from api.lighthouse.chrome_pool import POOL_SIZE as LIGHTHOUSE_CHROME_POOL_SIZE, ChromePool
+from api.lighthouse.history import BASELINES as LIGHTHOUSE_BASELINES, LighthouseHistory
+from api.lighthouse.multirun import MAX_RUNS as LIGHTHOUSE_MAX_RUNS, aggregate as aggregate_runs, representative_run
+from api.lighthouse.profiles import ProfileTimings, resolve_profile
+from api.lighthouse.report import (
+    RESPONSE_MODES, accepts_gzip, annotate as annotate_report, full_response as full_report_response,
+    project as project_report, summarize as summarize_report
+)
+from api.lighthouse.runner import LighthouseError, LighthouseRunner, LighthouseTimeout
+
+# Warm Chromium browsers shared by the A/B test detector (see api/ab_detector/browser_pool.py)
+browser_pool = BrowserPool()
+
+# On many-core hosts, captures run in shard processes with their own browsers instead
+# (see api/ab_detector/capture_shards.py); `capture_pool` is what schedulers capture with
+capture_shards = CaptureShards() if CAPTURE_SHARDS > 0 else None
+capture_pool = capture_shards or browser_pool
+
+# Worker processes for screenshot analysis, so CPU-bound work never blocks the event loop
+analysis_pool = AnalysisPool()
+
+# Screenshots referenced by detect_ab_test responses, served from ARTIFACT_ROUTE
+artifact_store = ArtifactStore()
+
+# Decoded frames of finished detect_ab_test jobs, for reanalyze_ab_test
+capture_store = CaptureStore()
+
+# Lighthouse runs as asyncio subprocesses, a bounded number at a time (see api/lighthouse/runner.py)
+# Lighthouse attaches to warm Chrome instances unless LIGHTHOUSE_CHROME_POOL_SIZE is 0 (see api/lighthouse/chrome_pool.py)
+lighthouse_chrome_pool = ChromePool() if LIGHTHOUSE_CHROME_POOL_SIZE > 0 else None
+lighthouse_runner = LighthouseRunner(chrome_pool=lighthouse_chrome_pool)
+
+# Recent Lighthouse results, in memory and compressed on disk
+lighthouse_cache = LighthouseCache()
+
+# Run times of recent Lighthouse runs per profile (see api/lighthouse/profiles.py)
+lighthouse_profile_timings = ProfileTimings()
+
+# Scores and metrics of every Lighthouse run, for trend and regression queries (see api/lighthouse/history.py)
+lighthouse_history = LighthouseHistory()
+
+# Background re-sampling of watched URLs (see api/ab_detector/monitor.py)
+monitor = Monitor(MonitorStore(), capture_pool, analysis_pool)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the browser pool with the app so the first request doesn't pay for browser launches.
+    # A failure here is not fatal: the pool retries lazily on the first capture.
+    try:
+        await capture_pool.start()
+    except Exception as e:
+        print(f"Browser pool failed to start, will retry on first use: {str(e)}")
+    if lighthouse_chrome_pool is not None:
+        try:
+            await lighthouse_chrome_pool.start()
+        except Exception as e:
+            print(f"Lighthouse Chrome pool failed to start, will retry on first use: {str(e)}")
+    analysis_pool.start()
+    monitor.start()
+    try:
+        yield
+    finally:
+        await monitor.stop()
+        await capture_pool.stop()
+        if lighthouse_chrome_pool is not None:
+            await lighthouse_chrome_pool.stop()
+        lighthouse_history.close()
+        analysis_pool.stop()
 
 # Create FastAPI app for heavy tools
-app = FastAPI(title="Opal Tools Service - Heavy (Railway/Render)")
+app = FastAPI(title="Opal Tools Service - Heavy (Railway/Render)", lifespan=lifespan)
 tools_service = ToolsService(app)
 
+# Accept-Encoding of the request being handled: tool handlers only receive their parameters,
+# and analyze_with_lighthouse compresses the full report only for clients that accept gzip
+request_accept_encoding: ContextVar[str] = ContextVar("request_accept_encoding", default="")
+
+class AcceptEncodingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            headers = dict(scope["headers"])
+            request_accept_encoding.set(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        await self.app(scope, receive, send)
+
+app.add_middleware(AcceptEncodingMiddleware)
+
 # ============================================================================
 # PARAMETER MODELS
 # ============================================================================
@@ -35,15 +140,123 @@ tools_service = ToolsService(app)
 class LighthouseParameters(BaseModel):
     url: str = Field(description="The URL to analyze with Lighthouse")
     format: str = Field(default="json", description="Output format: json or html")
+    profile: str = Field(default="default", description="What to audit: 'default' (all categories except the deprecated pwa, so summary.scores.pwa is null; use 'all' for the pwa score as before), 'all', 'performance', 'accessibility', 'best-practices', 'seo', or 'custom' with only_categories/only_audits")
+    only_categories: List[str] = Field(default=[], description="Custom profile: categories to run (e.g. 'performance', 'seo')")
+    only_audits: List[str] = Field(default=[], description="Custom profile: audit ids to run (e.g. 'largest-contentful-paint')")
+    response_mode: str = Field(default="full", description="'summary' returns scores and key metrics only; 'projection' adds the chosen categories, audits and paths; 'full' adds the whole report (streamed, gzip-compressed for clients that accept gzip)")
+    categories: List[str] = Field(default=[], description="Projection mode: category ids to return in full (e.g. 'performance')")
+    audits: List[str] = Field(default=[], description="Projection mode: audit ids to return in full (e.g. 'largest-contentful-paint')")
+    paths: List[str] = Field(default=[], description="Projection mode: dotted JSON paths to return, with 'item' for array elements (e.g. 'audits.network-requests.details.items.item.url')")
+    runs: int = Field(default=1, description="Lighthouse runs to execute in parallel (at most LIGHTHOUSE_MAX_RUNS); with more than one, the response adds the median and spread of each score and metric, and summary and full_report come from the run closest to the medians")
+    max_age_seconds: Optional[float] = Field(default=None, description="Accept a cached result up to this many seconds old (defaults to and is capped by LIGHTHOUSE_CACHE_TTL_SECONDS); 0 forces a fresh run")
+
+# Lighthouse history parameters
+class LighthouseTrendParameters(BaseModel):
+    url: str = Field(description="The URL whose stored Lighthouse results to return")
+    profile: str = Field(default="default", description="Run profile of the results (see analyze_with_lighthouse)")
+    only_categories: List[str] = Field(default=[], description="Custom profile: categories the runs audited")
+    only_audits: List[str] = Field(default=[], description="Custom profile: audit ids the runs audited")
+    days: Optional[float] = Field(default=None, description="Only results from the last this many days (default: all)")
+    limit: int = Field(default=100, description="Maximum number of most recent results")
+
+class LighthouseCompareParameters(BaseModel):
+    url: str = Field(description="The URL whose latest Lighthouse result to compare")
+    profile: str = Field(default="default", description="Run profile of the results (see analyze_with_lighthouse)")
+    only_categories: List[str] = Field(default=[], description="Custom profile: categories the runs audited")
+    only_audits: List[str] = Field(default=[], description="Custom profile: audit ids the runs audited")
+    baseline: str = Field(default="median", description="'median' of the runs before the latest, 'previous' run, or 'first' run stored")
+    baseline_runs: int = Field(default=5, description="Runs before the latest whose median is the 'median' baseline")
+    score_threshold: float = Field(default=5, description="Score drop (points, 0-100) flagged as a regression")
+    metric_threshold_percent: float = Field(default=10, description="Metric increase (percent of the baseline) flagged as a regression")
+
+class LighthouseRegressionsParameters(BaseModel):
+    urls: List[str] = Field(default=[], description="URLs to check (default: every URL audited within `days`)")
+    profile: str = Field(default="default", description="Run profile of the results (see analyze_with_lighthouse)")
+    only_categories: List[str] = Field(default=[], description="Custom profile: categories the runs audited")
+    only_audits: List[str] = Field(default=[], description="Custom profile: audit ids the runs audited")
+    days: float = Field(default=7, description="Without urls: check the URLs audited in the last this many days")
+    baseline: str = Field(default="median", description="'median' of the runs before the latest, 'previous' run, or 'first' run stored")
+    baseline_runs: int = Field(default=5, description="Runs before the latest whose median is the 'median' baseline")
+    score_threshold: float = Field(default=5, description="Score drop (points, 0-100) flagged as a regression")
+    metric_threshold_percent: float = Field(default=10, description="Metric increase (percent of the baseline) flagged as a regression")
 
 # A/B Test Detector parameters
 class ABTestDetectorParameters(BaseModel):
     url: str = Field(description="The URL to analyze for A/B tests")
-    num_captures: int = Field(default=10, description="Number of screenshots to capture")
-    delay_seconds: int = Field(default=3, description="Delay between captures in seconds")
+    num_captures: int = Field(default=10, description="Number of screenshots to capture (the maximum when adaptive is true)")
+    delay_seconds: float = Field(default=3, description="Minimum spacing between page navigations in seconds (captures otherwise run concurrently)")
     viewport_width: int = Field(default=1920, description="Browser viewport width")
     viewport_height: int = Field(default=1080, description="Browser viewport height")
     threshold: float = Field(default=0.05, description="Minimum difference percentage to flag as A/B test (0.05 = 5%)")
+    max_concurrency: int = Field(default=4, description="Maximum number of captures running at the same time")
+    readiness: str = Field(default="networkidle", description="When to take the screenshot after navigation: 'networkidle', 'dom_stable' or 'load'")
+    readiness_timeout: float = Field(default=5.0, description="Maximum seconds to wait for the readiness condition before capturing anyway")
+    ssim_mode: str = Field(default="exact", description="SSIM computation: 'exact' (full resolution) or 'fast' (multi-resolution, refines only pairs near ssim_threshold; pairs it decides at a coarse level report no SSIM)")
+    ssim_threshold: float = Field(default=0.95, description="SSIM below which two screenshots count as visually different")
+    hash_types: List[str] = Field(default=["phash"], description="Perceptual hashes used to group captures into variations: any of 'phash', 'dhash', 'whash'")
+    heatmap_grid: int = Field(default=HEATMAP_GRID_SIZE, description="Variance heatmap resolution: the page is split into heatmap_grid x heatmap_grid cells")
+    heatmap_top_k: int = Field(default=0, description="Return only the k highest-variance heatmap cells as [x, y, variance] rows; 0 returns every cell")
+    block_trackers: bool = Field(default=True, description="Block known analytics, ads and session-recording requests, and audio/video media (experiment scripts are never blocked)")
+    block_patterns: List[str] = Field(default=[], description="Extra requests to block: host suffixes with optional path (e.g. 'ads.example.com', 'example.com/pixel') or regular expressions prefixed with 're:'")
+    allow_patterns: List[str] = Field(default=[], description="Requests never blocked, same syntax as block_patterns")
+    cache_resources: bool = Field(default=True, description="Share static resources (CSS, scripts, fonts, images) between the captures of this job; HTML and experiment scripts are always fetched")
+    adaptive: bool = Field(default=False, description="Stop capturing early once the variation distribution is stable or enough identical captures were seen")
+    min_captures: int = Field(default=4, description="Adaptive mode: minimum captures before stopping on a stable distribution")
+    identical_captures_to_stop: int = Field(default=5, description="Adaptive mode: stop after this many captures if all are the same variation")
+    new_variant_probability: float = Field(default=0.1, description="Adaptive mode: stop once the estimated chance that another capture shows a new variation is at most this")
+    inline_previews: bool = Field(default=False, description="Also embed sample screenshots as base64 PNG data URIs (responses otherwise carry artifact URLs only)")
+    hash_radius: int = Field(default=HASH_RADIUS, description="Maximum Hamming distance (bits, per hash type) for two captures to count as the same variation; 0 (the default) groups identical hashes only, above 0 captures are linked transitively (single linkage)")
+    detection_mode: str = Field(default="pixel", description="'pixel' analyzes every screenshot; 'structural' groups captures by DOM skeleton, visible text and key element layout first and only decodes one screenshot per structural group to confirm the differences visually")
+    store_captures: bool = Field(default=True, description="Keep the decoded frames and hashes under the returned job_id so reanalyze_ab_test can rerun the analysis with other settings")
+    capture_retention_hours: Optional[float] = Field(default=None, description="Hours to keep this job's stored frames (defaults to AB_CAPTURE_TTL_HOURS); the least recently used jobs may be evicted earlier when the store is full")
+    ignore_selectors: List[str] = Field(default=[], description="CSS selectors of elements to ignore (carousels, cookie banners, ad slots): their boxes are masked out of every screenshot and left out of structural snapshots")
+    ignore_regions: List[List[float]] = Field(default=[], description="Rectangles to ignore as [x, y, width, height] in screenshot pixels; regions spanning the full width at the top or bottom (or the full height at a side) are cropped off")
+    capture_selector: Optional[str] = Field(default=None, description="CSS selector of one element to screenshot instead of the whole viewport (the first match is used)")
+    full_page: bool = Field(default=False, description="Capture the whole page as tiles instead of the first viewport; each tile is hashed and only tile positions whose pixels differ between captures are compared (pixel detection mode and exact SSIM only; full-page jobs are not stored for reanalyze_ab_test)")
+    tile_height: Optional[int] = Field(default=None, description="Full-page mode: tile height in pixels (defaults to viewport_height)")
+    max_tiles: int = Field(default=10, description="Full-page mode: maximum tiles per capture, from the top of the page down")
+
+# A/B Test re-analysis parameters
+class ABTestReanalyzeParameters(BaseModel):
+    job_id: str = Field(description="job_id returned by detect_ab_test")
+    threshold: float = Field(default=0.05, description="Minimum difference percentage to flag as A/B test (0.05 = 5%)")
+    ssim_mode: str = Field(default="exact", description="SSIM computation: 'exact' (full resolution) or 'fast' (multi-resolution, refines only pairs near ssim_threshold; pairs it decides at a coarse level report no SSIM)")
+    ssim_threshold: float = Field(default=0.95, description="SSIM below which two screenshots count as visually different")
+    hash_types: List[str] = Field(default=["phash"], description="Perceptual hashes used to group captures into variations: any of 'phash', 'dhash', 'whash'")
+    hash_radius: int = Field(default=HASH_RADIUS, description="Maximum Hamming distance (bits, per hash type) for two captures to count as the same variation; 0 (the default) groups identical hashes only, above 0 captures are linked transitively (single linkage)")
+    heatmap_grid: int = Field(default=HEATMAP_GRID_SIZE, description="Variance heatmap resolution: the page is split into heatmap_grid x heatmap_grid cells")
+    heatmap_top_k: int = Field(default=0, description="Return only the k highest-variance heatmap cells as [x, y, variance] rows; 0 returns every cell")
+    inline_previews: bool = Field(default=False, description="Also embed sample screenshots as base64 PNG data URIs")
+
+# Batch A/B Test Detector parameters
+class ABTestBatchParameters(BaseModel):
+    urls: List[str] = Field(description="URLs to analyze for A/B tests")
+    defaults: Dict[str, Any] = Field(default={}, description="detect_ab_test parameters applied to every URL (e.g. {\"num_captures\": 6})")
+    overrides: Dict[str, Dict[str, Any]] = Field(default={}, description="Per-URL detect_ab_test parameters, keyed by URL; these win over defaults")
+    max_concurrency: int = Field(default=8, description="Maximum captures in flight across all URLs")
+    max_per_host: int = Field(default=2, description="Maximum captures in flight against any one host")
+    max_active_urls: int = Field(default=4, description="Maximum URLs analyzed at the same time (bounds memory use)")
+    stream: bool = Field(default=True, description="Stream one JSON line per URL as it finishes (application/x-ndjson) instead of a single JSON response")
+
+# A/B Test monitoring parameters
+class WatchABTestParameters(BaseModel):
+    url: str = Field(description="The URL to monitor for A/B tests")
+    interval_minutes: float = Field(default=60, description="Minutes between monitoring runs")
+    captures_per_run: int = Field(default=3, description="Screenshots taken per run (each is only hashed and matched against the known variants)")
+    window_captures: int = Field(default=12, description="Most recent captures that decide which variants are currently live")
+    hash_types: List[str] = Field(default=["phash"], description="Perceptual hashes used to match captures to variants: any of 'phash', 'dhash', 'whash'")
+    hash_radius: int = Field(default=MONITOR_HASH_RADIUS, description="Maximum Hamming distance (bits, per hash type) from a variant's centroid for a capture to match it")
+    viewport_width: int = Field(default=1920, description="Browser viewport width")
+    viewport_height: int = Field(default=1080, description="Browser viewport height")
+    run_now: bool = Field(default=True, description="Run the first sample immediately instead of after one interval")
+
+class UnwatchABTestParameters(BaseModel):
+    url: str = Field(description="The monitored URL to stop watching")
+    keep_history: bool = Field(default=True, description="Keep the URL's stored captures, variants and events")
+
+class ABTestMonitorStatusParameters(BaseModel):
+    url: Optional[str] = Field(default=None, description="A monitored URL; omit to list every watched URL")
+    events_limit: int = Field(default=20, description="Maximum number of most recent events to return per URL")
 
 # A/B Test Pivot parameters
 class ABTestPivotParameters(BaseModel):
@@ -54,95 +267,183 @@ class ABTestPivotParameters(BaseModel):
 # TOOL FUNCTIONS - LIGHTHOUSE
 # ============================================================================
 
-@tool("analyze_with_lighthouse", "Runs a Lighthouse performance analysis on the provided URL")
+@tool("analyze_with_lighthouse", "Runs a Lighthouse performance analysis on the provided URL (the default profile skips the pwa category; pass profile='all' for its score)")
 async def analyze_with_lighthouse(parameters: LighthouseParameters):
     """
     Runs Lighthouse on the provided URL and returns the analysis results.
     """
-    try:
-        # Create a temporary file for the output
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as tmp_file:
-            tmp_path = tmp_file.name
-
-        # Build the lighthouse command
-        cmd = [
-            'lighthouse',
-            parameters.url,
-            '--output=json',
-            f'--output-path={tmp_path}',
-            '--form-factor=desktop',
-            '--screenEmulation.disabled',
-            '--throttling-method=provided',
-            '--chrome-flags="--headless --no-sandbox --disable-gpu --disable-dev-shm-usage"',
-            '--quiet'
-        ]
-
-        # Run lighthouse
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            shell=False
-        )
+    if parameters.response_mode not in RESPONSE_MODES:
+        return {"error": f"Invalid response_mode '{parameters.response_mode}'. Use one of: {', '.join(RESPONSE_MODES)}"}
+    if parameters.response_mode == "projection" and not (parameters.categories or parameters.audits or parameters.paths):
+        return {"error": "response_mode 'projection' needs categories, audits or paths"}
+    profile, error = resolve_profile(parameters.profile, parameters.only_categories, parameters.only_audits)
+    if error is not None:
+        return {"error": error}
+    if not 1 <= parameters.runs <= LIGHTHOUSE_MAX_RUNS:
+        return {"error": f"runs must be between 1 and {LIGHTHOUSE_MAX_RUNS}"}
+    flags = profile.flags()
+    options = lighthouse_runner.options(flags)
+    if parameters.runs > 1:
+        # Aggregated results are cached apart from single runs
+        options = options + [f"runs={parameters.runs}"]
+
+    async def run_once():
+        run = await lighthouse_runner.run(parameters.url, flags)
+        lighthouse_profile_timings.record(profile.key(), run.run_seconds)
+        # Adds scorePercentage to the audits and compresses the report once per run, without building it in memory
+        report, summary_fields = await asyncio.to_thread(annotate_report, run.report)
+        return {"timing": run.timing(), "summary_fields": summary_fields}, report
+
+    async def run_lighthouse():
+        if parameters.runs == 1:
+            return await run_once()
+        # The runs execute in parallel, each on its own Chrome, as far as LIGHTHOUSE_MAX_CONCURRENCY allows
+        started = time.monotonic()
+        outcomes = await asyncio.gather(*[run_once() for _ in range(parameters.runs)], return_exceptions=True)
+        completed = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if not completed:
+            raise errors[0]
+        fields = [meta["summary_fields"] for meta, _ in completed]
+        index = representative_run(fields)
+        meta, report = completed[index]
+        meta["timing"]["wall_seconds"] = round(time.monotonic() - started, 3)
+        meta["runs"] = {
+            "requested": parameters.runs,
+            "completed": len(completed),
+            # Fewer runs completed than were requested: not cached, and flagged in the history
+            "partial": len(completed) < parameters.runs,
+            "errors": [str(e) for e in errors],
+            # Position among the completed runs of the run returned as summary and full_report
+            "representative": index,
+            "run_seconds": [m["timing"]["run_seconds"] for m, _ in completed],
+            **aggregate_runs(fields)
+        }
+        return meta, report
 
-        if result.returncode != 0:
+    try:
+        try:
+            # Identical requests within the TTL share one result (see api/lighthouse/cache.py);
+            # a multi-run result missing some of its runs is returned but not cached
+            result = await lighthouse_cache.get_or_run(
+                parameters.url, options, run_lighthouse, parameters.max_age_seconds,
+                cacheable=lambda meta: not meta.get("runs", {}).get("partial", False)
+            )
+        except LighthouseTimeout as e:
             return {
-                "error": "Lighthouse analysis failed",
-                "stderr": result.stderr,
-                "stdout": result.stdout
+                "error": str(e),
+                "timing": e.timing
             }
-
-        # Read the JSON output
-        with open(tmp_path, 'r') as f:
-            lighthouse_data = json.load(f)
-
-        # Clean up the temp file
-        os.unlink(tmp_path)
-
-        # Extract key metrics
-        categories = lighthouse_data.get('categories', {})
-        audits = lighthouse_data.get('audits', {})
-
-        # Build a summary response - convert scores to percentages
-        summary = {
-            "url": lighthouse_data.get('finalUrl', parameters.url),
-            "fetchTime": lighthouse_data.get('fetchTime'),
-            "scores": {
-                "performance": int(categories.get('performance', {}).get('score', 0) * 100) if categories.get('performance', {}).get('score') is not None else None,
-                "accessibility": int(categories.get('accessibility', {}).get('score', 0) * 100) if categories.get('accessibility', {}).get('score') is not None else None,
-                "best-practices": int(categories.get('best-practices', {}).get('score', 0) * 100) if categories.get('best-practices', {}).get('score') is not None else None,
-                "seo": int(categories.get('seo', {}).get('score', 0) * 100) if categories.get('seo', {}).get('score') is not None else None,
-                "pwa": int(categories.get('pwa', {}).get('score', 0) * 100) if categories.get('pwa', {}).get('score') is not None else None
-            },
-            "metrics": {
-                "first-contentful-paint": audits.get('first-contentful-paint', {}).get('displayValue'),
-                "largest-contentful-paint": audits.get('largest-contentful-paint', {}).get('displayValue'),
-                "total-blocking-time": audits.get('total-blocking-time', {}).get('displayValue'),
-                "cumulative-layout-shift": audits.get('cumulative-layout-shift', {}).get('displayValue'),
-                "speed-index": audits.get('speed-index', {}).get('displayValue'),
-                "interactive": audits.get('interactive', {}).get('displayValue')
+        except LighthouseError as e:
+            return {
+                "error": str(e),
+                "stderr": e.stderr,
+                "stdout": e.stdout,
+                "timing": e.timing
             }
+
+        # timing describes the run that produced the report (queue wait separate from the run itself);
+        # cache tells whether it was served from the cache and how old it is;
+        # profile reports what was audited and how long that profile's recent runs took
+        response = {
+            "summary": summarize_report(result.meta["summary_fields"], parameters.url),
+            "profile": {**profile.to_dict(), "median_run_seconds": lighthouse_profile_timings.median(profile.key())},
+            "timing": result.meta["timing"],
+            "cache": result.metadata()
         }
+        if "runs" in result.meta:
+            # Median and spread of every category score and metric over the runs
+            response["runs"] = result.meta["runs"]
+        if result.source == "run":
+            # New results (not cache hits) go into the history for lighthouse_trend and friends
+            try:
+                await asyncio.to_thread(
+                    lighthouse_history.record, parameters.url, profile.key(), result.meta, result.created_at
+                )
+            except Exception as e:
+                print(f"Failed to record Lighthouse history: {str(e)}")
 
-        # Convert all audit scores in the full report to percentages for consistency
-        if 'audits' in lighthouse_data:
-            for audit_id, audit_data in lighthouse_data['audits'].items():
-                if 'score' in audit_data and audit_data['score'] is not None:
-                    # Convert score from 0-1 to 0-100 for better readability
-                    audit_data['scorePercentage'] = int(audit_data['score'] * 100)
+        if parameters.response_mode == "projection":
+            projection = await asyncio.to_thread(
+                project_report, result.open_report(), parameters.categories, parameters.audits, parameters.paths
+            )
+            return {**response, **projection}
+
+        if parameters.response_mode == "full":
+            # The full_report contains all audits, recommendations, and detailed metrics;
+            # it is streamed rather than assembled as one dict, gzip-compressed if the client accepts it
+            compress = accepts_gzip(request_accept_encoding.get())
+            return StreamingResponse(
+                full_report_response(response, result.open_report(), compress),
+                media_type="application/json",
+                headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"} if compress else {"Vary": "Accept-Encoding"}
+            )
 
-        # Always return both summary and full report
-        # The full_report contains all audits, recommendations, and detailed metrics
-        return {
-            "summary": summary,
-            "full_report": lighthouse_data
-        }
+        return response
 
     except Exception as e:
         return {
             "error": f"Failed to run Lighthouse: {str(e)}"
         }
 
+# ============================================================================
+# TOOL FUNCTIONS - LIGHTHOUSE HISTORY
+# ============================================================================
+
+@tool("lighthouse_trend", "Shows how a URL's stored Lighthouse scores and metrics changed over time, without running a new audit")
+async def lighthouse_trend(parameters: LighthouseTrendParameters):
+    """
+    Returns the stored Lighthouse results of a URL, oldest first, with the
+    latest value, median, range and change of every score and metric.
+    """
+    profile, error = resolve_profile(parameters.profile, parameters.only_categories, parameters.only_audits)
+    if error is not None:
+        return {"error": error}
+    since = time.time() - parameters.days * 86400 if parameters.days is not None else None
+    trend = await asyncio.to_thread(
+        lighthouse_history.trend, parameters.url, profile.key(), since, max(1, parameters.limit)
+    )
+    if trend is None:
+        return {"error": f"No Lighthouse history for {parameters.url} with profile '{profile.key()}'"}
+    return trend
+
+@tool("lighthouse_compare", "Compares a URL's latest stored Lighthouse result against a baseline and flags regressions")
+async def lighthouse_compare(parameters: LighthouseCompareParameters):
+    """
+    Compares the latest stored result of a URL with a baseline of earlier
+    results, without running a new audit.
+    """
+    if parameters.baseline not in LIGHTHOUSE_BASELINES:
+        return {"error": f"Invalid baseline '{parameters.baseline}'. Use one of: {', '.join(LIGHTHOUSE_BASELINES)}"}
+    profile, error = resolve_profile(parameters.profile, parameters.only_categories, parameters.only_audits)
+    if error is not None:
+        return {"error": error}
+    comparison = await asyncio.to_thread(
+        lighthouse_history.compare, parameters.url, profile.key(), parameters.baseline,
+        parameters.baseline_runs, parameters.score_threshold, parameters.metric_threshold_percent
+    )
+    if comparison is None:
+        return {"error": f"Fewer than two stored Lighthouse results for {parameters.url} with profile '{profile.key()}'"}
+    return comparison
+
+@tool("lighthouse_regressions", "Lists URLs whose latest stored Lighthouse result regressed against their baseline")
+async def lighthouse_regressions(parameters: LighthouseRegressionsParameters):
+    """
+    Compares the latest stored result of every URL (or of the given URLs)
+    with its baseline and returns those with regressions.
+    """
+    if parameters.baseline not in LIGHTHOUSE_BASELINES:
+        return {"error": f"Invalid baseline '{parameters.baseline}'. Use one of: {', '.join(LIGHTHOUSE_BASELINES)}"}
+    profile, error = resolve_profile(parameters.profile, parameters.only_categories, parameters.only_audits)
+    if error is not None:
+        return {"error": error}
+    flagged = await asyncio.to_thread(
+        lighthouse_history.regressions, profile.key(), parameters.urls,
+        time.time() - parameters.days * 86400, parameters.baseline, parameters.baseline_runs,
+        parameters.score_threshold, parameters.metric_threshold_percent
+    )
+    return {"profile": profile.key(), "regressed": len(flagged), "urls": flagged}
+
 # ============================================================================
 # TOOL FUNCTIONS - A/B TEST DETECTOR
 # ============================================================================
@@ -153,267 +454,754 @@ async def detect_ab_test(parameters: ABTestDetectorParameters):
     Captures multiple screenshots of a URL and analyzes them for variations
     that might indicate an active A/B test.
     """
-    screenshots = []
-    screenshot_hashes = []
-
-    # Rotate user agents to simulate different users
-    user_agents = [
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15',
-        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-    ]
+    return await run_ab_detection(parameters)
 
+async def run_ab_detection(parameters: ABTestDetectorParameters, limits: Optional[CaptureLimits] = None):
+    """
+    Body of detect_ab_test. `limits` shares global and per-host capture
+    concurrency limits with other detections (see detect_ab_test_batch).
+    """
+    if parameters.readiness not in READINESS_MODES:
+        return {"error": f"Invalid readiness '{parameters.readiness}'. Expected one of: {', '.join(READINESS_MODES)}"}
+    invalid = invalid_analysis_parameters(parameters)
+    if invalid is not None:
+        return invalid
+    if parameters.detection_mode not in DETECTION_MODES:
+        return {"error": f"Invalid detection_mode '{parameters.detection_mode}'. Expected one of: {', '.join(DETECTION_MODES)}"}
     try:
-        async with async_playwright() as p:
-            # Launch browser with container-friendly flags
-            browser = await p.chromium.launch(
-                headless=True,
-                args=[
-                    '--no-sandbox',
-                    '--disable-setuid-sandbox',
-                    '--disable-dev-shm-usage',
-                    '--disable-gpu',
-                    '--disable-software-rasterizer',
-                    '--disable-extensions'
-                ]
-            )
-
-            # Capture screenshots
-            for i in range(parameters.num_captures):
-                # Create new context for each capture (fresh session with no cookies/storage)
-                # Rotate user agent to simulate different users
-                context = await browser.new_context(
-                    viewport={'width': parameters.viewport_width, 'height': parameters.viewport_height},
-                    user_agent=random.choice(user_agents),
-                    ignore_https_errors=True,
-                    # Clear all storage between captures to simulate truly fresh visits
-                    storage_state=None
-                )
-
-                page = await context.new_page()
+        ignore_regions = parse_regions(parameters.ignore_regions)
+    except ValueError as e:
+        return {"error": str(e)}
+    tile_height = parameters.tile_height or parameters.viewport_height
+    if parameters.full_page:
+        if parameters.detection_mode != "pixel":
+            return {"error": "full_page requires detection_mode 'pixel' (structural snapshots cover the viewport only)"}
+        if parameters.capture_selector:
+            return {"error": "full_page and capture_selector cannot be combined"}
+        if parameters.ssim_mode != "exact":
+            return {"error": "full_page requires ssim_mode 'exact' (page SSIM is area-weighted over full-resolution tile scores)"}
+        if tile_height < 1 or parameters.max_tiles < 1:
+            return {"error": "tile_height and max_tiles must be at least 1"}
+    structural_requested = parameters.detection_mode == "structural"
 
-                try:
-                    # Navigate to URL with more lenient wait condition
-                    await page.goto(parameters.url, wait_until='domcontentloaded', timeout=60000)
-
-                    # Wait a bit for any dynamic content
-                    await asyncio.sleep(2)
-
-                    # Capture screenshot
-                    screenshot_bytes = await page.screenshot(full_page=False)
-
-                    # Convert to PIL Image for analysis
-                    img = Image.open(io.BytesIO(screenshot_bytes))
-                    screenshots.append(img)
-
-                    # Calculate perceptual hash for quick comparison
-                    hash_val = str(imagehash.phash(img))
-                    screenshot_hashes.append(hash_val)
-
-                except Exception as e:
-                    print(f"Error capturing screenshot {i+1}: {str(e)}")
-                finally:
-                    await context.close()
-
-                # Delay between captures (except after last one)
-                if i < parameters.num_captures - 1:
-                    await asyncio.sleep(parameters.delay_seconds)
+    try:
+        policy = NetworkPolicy(
+            block_trackers=parameters.block_trackers,
+            deny=parameters.block_patterns,
+            allow=parameters.allow_patterns
+        )
+    except re.error as e:
+        return {"error": f"Invalid regular expression in block_patterns/allow_patterns: {str(e)}"}
+    network = JobNetwork(policy, cache=parameters.cache_resources)
+    # Screenshots travel to the analysis workers through shared memory owned by this job
+    frame_store = FrameStore()
+    hash_types = list(dict.fromkeys(parameters.hash_types))
+
+    # With adaptive sampling num_captures is a budget; stopping is decided as hashes
+    # (or, in structural mode, snapshots) arrive
+    sampler = AdaptiveSampler(
+        parameters.num_captures,
+        0 if structural_requested else parameters.hash_radius,
+        min_captures=parameters.min_captures,
+        identical_to_stop=parameters.identical_captures_to_stop,
+        new_variant_probability=parameters.new_variant_probability
+    ) if parameters.adaptive else None
+
+    # Per-mode analysis of the captures as they arrive (see api/ab_detector/pipelines.py); the
+    # per-pixel variance across all captures is updated as each frame is decoded
+    pipeline_args = (
+        analysis_pool, frame_store, artifact_store, hash_types, StreamingVariance(analysis_pool, frame_store), sampler,
+        ignore_regions
+    )
+    if parameters.full_page:
+        pipeline = TiledPipeline(*pipeline_args, tile_height=tile_height, max_tiles=parameters.max_tiles)
+    elif structural_requested:
+        pipeline = StructuralPipeline(*pipeline_args)
+    else:
+        pipeline = PixelPipeline(*pipeline_args)
 
-            await browser.close()
+    try:
+        # Run captures concurrently in fresh contexts on the shared browser pool
+        spec = CaptureSpec(
+            url=parameters.url,
+            viewport_width=parameters.viewport_width,
+            viewport_height=parameters.viewport_height,
+            readiness=parameters.readiness,
+            readiness_timeout=parameters.readiness_timeout,
+            network=network,
+            structure=structural_requested,
+            mask_selectors=parameters.ignore_selectors,
+            capture_selector=parameters.capture_selector,
+            tile_height=tile_height if parameters.full_page else None,
+            max_tiles=parameters.max_tiles
+        )
+        scheduler = CaptureScheduler(
+            capture_pool,
+            max_concurrency=parameters.max_concurrency,
+            min_spacing=parameters.delay_seconds,
+            limits=limits
+        )
+        capture_started = time.monotonic()
+        capture_results = await scheduler.run(
+            spec,
+            parameters.num_captures,
+            on_capture=pipeline.on_capture,
+            should_stop=sampler.should_stop if sampler is not None else None
+        )
+        captures_started = sum(1 for c in capture_results if not c.skipped)
+        capture_wall_time = time.monotonic() - capture_started
+        invalid_selectors = next((c.invalid_selectors for c in capture_results if c.invalid_selectors), None)
+        if invalid_selectors:
+            return {"error": f"Invalid CSS selectors in ignore_selectors: {', '.join(invalid_selectors)}"}
+
+        # Results come back in capture order, so indices below follow capture order
+        captured = []
+        for capture in capture_results:
+            if capture.skipped:
+                continue
+            if not capture.ok:
+                print(f"Error capturing screenshot {capture.index+1}: {capture.error}")
+                continue
+            captured.append(capture)
+        await pipeline.collect(captured)
 
         # Analyze screenshots for variations
-        if len(screenshots) < 2:
+        if len(pipeline.frames) < 2:
             return {"error": "Not enough screenshots captured for comparison"}
 
-        # Find unique variations based on perceptual hashes
-        unique_hashes = list(set(screenshot_hashes))
-        variation_groups = {hash_val: [] for hash_val in unique_hashes}
-
-        for i, hash_val in enumerate(screenshot_hashes):
-            variation_groups[hash_val].append(i)
-
-        # Calculate pixel-level differences
-        differences = []
-        ssim_scores = []
-
-        # Convert first screenshot to numpy array for comparison
-        base_img = np.array(screenshots[0].convert('RGB'))
-
-        for i in range(1, len(screenshots)):
-            # Convert to numpy array
-            compare_img = np.array(screenshots[i].convert('RGB'))
-
-            # Ensure images are same size
-            if base_img.shape != compare_img.shape:
-                compare_img = np.array(screenshots[i].resize(screenshots[0].size).convert('RGB'))
-
-            # Calculate pixel difference
-            diff = np.abs(base_img.astype(float) - compare_img.astype(float))
-            diff_percentage = (diff > 10).sum() / diff.size  # Pixels with >10 intensity difference
-            differences.append(diff_percentage)
-
-            # Calculate SSIM (structural similarity)
-            gray_base = np.array(screenshots[0].convert('L'))
-            gray_compare = np.array(screenshots[i].convert('L'))
-
-            if gray_base.shape == gray_compare.shape:
-                score = ssim(gray_base, gray_compare)
-                ssim_scores.append(score)
+        def describe_job(block_results, compare_cpu):
+            blocks = {
+                "detection": pipeline.describe_detection(parameters.detection_mode, block_results, compare_cpu),
+                "capture": {
+                    "wall_time_seconds": round(capture_wall_time, 2),
+                    "failed_captures": sum(1 for c in capture_results if not c.ok and not c.skipped),
+                    "max_concurrency": parameters.max_concurrency,
+                    "readiness": parameters.readiness,
+                    "readiness_met": sum(1 for c in capture_results if c.ok and c.ready)
+                },
+                "sampling": sampler.summary(captures_started) if sampler is not None else {
+                    "mode": "fixed",
+                    "budget": parameters.num_captures,
+                    "captures_started": captures_started
+                },
+                # Requests blocked and static responses reused across this job's captures
+                "network": network.stats.to_dict()
+            }
+            if parameters.full_page:
+                blocks["tiles"] = pipeline.report
+            if ignore_regions or parameters.ignore_selectors or parameters.capture_selector:
+                blocks["masking"] = pipeline.describe_masking(parameters.capture_selector, parameters.ignore_selectors)
+            return blocks
+
+        result = await analyse_frames(
+            parameters,
+            parameters.url,
+            hash_types,
+            pipeline.frames,
+            pipeline.screenshot_hashes,
+            pipeline.frame_digests,
+            pipeline.variance,
+            lambda: pipeline.variance_grid(parameters.heatmap_grid),
+            pipeline.store_sample,
+            describe_job,
+            snapshots=pipeline.snapshots,
+            compare=(lambda: pipeline.compare(parameters.hash_radius)) if pipeline.compare is not None else None,
+            preview=pipeline.preview
+        )
 
-        # Determine if A/B test is likely running
-        max_difference = max(differences) if differences else 0
-        avg_difference = sum(differences) / len(differences) if differences else 0
-        num_variations = len(unique_hashes)
+        # Full-page jobs keep no page frames to store
+        if parameters.store_captures and not parameters.full_page:
+            # Keep the decoded frames so the analysis can be rerun without recapturing
+            try:
+                stored = await store_job(
+                    parameters,
+                    hash_types,
+                    frame_store,
+                    pipeline.frames,
+                    pipeline.screenshots,
+                    pipeline.screenshot_hashes,
+                    pipeline.frame_digests,
+                    [capture.index for capture in pipeline.captures],
+                    [capture.structure for capture in pipeline.captures] if pipeline.snapshots is not None else None,
+                    result
+                )
+                result = {"url": result["url"], "job_id": stored["job_id"], "job_expires": stored["expires"], **result}
+            except Exception as e:
+                print(f"Error storing captures: {str(e)}")
+        return result
 
-        is_ab_test_likely = (
-            max_difference > parameters.threshold or
-            num_variations > 1
-        )
+    except Exception as e:
+        return {
+            "error": f"Failed to analyze URL for A/B tests: {str(e)}"
+        }
+    finally:
+        # Let in-flight analysis finish before unlinking the shared memory it reads
+        await asyncio.gather(*pipeline.pending(), return_exceptions=True)
+        frame_store.close()
 
-        # Calculate confidence score
-        confidence = 0
+def invalid_analysis_parameters(parameters) -> Optional[Dict[str, str]]:
+    """
+    Error response for analysis settings shared by detect_ab_test,
+    reanalyze_ab_test and watch_ab_test, or None. Settings a tool has no
+    field for (watch_ab_test only hashes) are not checked.
+    """
+    invalid_hashes = [hash_type for hash_type in parameters.hash_types if hash_type not in HASH_TYPES]
+    if invalid_hashes or not parameters.hash_types:
+        return {"error": f"Invalid hash_types {invalid_hashes or parameters.hash_types}. Expected one or more of: {', '.join(HASH_TYPES)}"}
+    if getattr(parameters, "heatmap_grid", 1) < 1:
+        return {"error": "heatmap_grid must be at least 1"}
+    if getattr(parameters, "ssim_mode", SSIM_MODES[0]) not in SSIM_MODES:
+        return {"error": f"Invalid ssim_mode '{parameters.ssim_mode}'. Expected one of: {', '.join(SSIM_MODES)}"}
+    return None
+
+async def analyse_frames(
+    parameters,
+    url: str,
+    hash_types: List[str],
+    frames: List[Any],
+    screenshot_hashes: List[tuple],
+    frame_digests: List[str],
+    variance: StreamingVariance,
+    variance_grid,
+    store_sample,
+    describe_job,
+    snapshots: Optional[List[Any]] = None,
+    compare=None,
+    preview=None
+):
+    """
+    Analysis stage shared by detect_ab_test and reanalyze_ab_test.
+
+    Per analysed capture: `frames` holds its frame reference, or None when
+    it reuses the frame of an earlier capture with the same digest;
+    `screenshot_hashes` its hash signature and `frame_digests` its pixel
+    digest. `variance_grid()` completes `variance` and returns its heatmap
+    cells, `store_sample(index)` the artifact ID of a capture's screenshot and
+    `describe_job(block_results, compare_cpu)` the blocks describing how the
+    captures were taken. `compare()` and `preview(index)` replace the
+    pairwise frame comparison and the inline preview of a sample when the
+    captures are not single frames (full-page tiles).
+    """
+    # Group captures into variations by Hamming distance between their perceptual hashes,
+    # so a blinking cursor or a flipped bit doesn't count as a new variation
+    variation_groups = cluster_hashes(screenshot_hashes, parameters.hash_radius)
+    # Coarse SSIM of the pairs fast mode decided below full resolution
+    coarse = {}
+
+    async def compare_frames():
+        # Compare every pair of distinct frames (bit-identical captures are compared once),
+        # split across the analysis workers
+        unique_digests = list(dict.fromkeys(frame_digests))
+        unique_of = [unique_digests.index(digest) for digest in frame_digests]
+        unique_frames = [frames[frame_digests.index(digest)] for digest in unique_digests]
+        blocks = plan_blocks(len(unique_frames), analysis_pool.max_workers * 2)
+        timed_blocks = await asyncio.gather(*[
+            analysis_pool.run(timed, compare_block, unique_frames, block, parameters.ssim_mode, parameters.ssim_threshold)
+            for block in blocks
+        ])
+        block_results = [block for block, _ in timed_blocks]
+        diff_matrix, ssim_matrix = expand_matrices(unique_of, len(unique_frames), block_results)
+        if parameters.ssim_mode == "fast":
+            coarse["ssim"] = coarse_matrix(unique_of, len(unique_frames), block_results)
+        return diff_matrix, ssim_matrix, block_results, [cpu for _, cpu in timed_blocks]
+
+    # The variance heatmap is reduced alongside the comparisons
+    (diff_matrix, ssim_matrix, block_results, cpu_seconds), grid = await asyncio.gather(
+        (compare or compare_frames)(),
+        variance_grid()
+    )
+
+    # Statistics over all pairs of captures, not just against the first one
+    differences = upper_triangle(diff_matrix)
+    pair_ssim = upper_triangle(ssim_matrix)
+    ssim_scores = [float(score) for score in pair_ssim if not np.isnan(score)]
+    # Coarse scores are only good for the threshold decision, never reported as SSIM
+    coarse_scores = [float(score) for score in upper_triangle(coarse["ssim"]) if not np.isnan(score)] if coarse else []
+    cluster_stats = cluster_statistics(diff_matrix, ssim_matrix, variation_groups)
+
+    # Determine if A/B test is likely running
+    max_difference = float(differences.max()) if differences.size else 0
+    avg_difference = float(differences.mean()) if differences.size else 0
+    num_variations = len(variation_groups)
+
+    is_ab_test_likely = (
+        max_difference > parameters.threshold or
+        num_variations > 1
+    )
+
+    # Calculate confidence score
+    confidence = 0
+    if num_variations == 2:
+        # Classic A/B test pattern
+        confidence = 0.9
+    elif num_variations > 2:
+        # Multivariate test or dynamic content
+        confidence = 0.7
+    elif max_difference > parameters.threshold:
+        # Some variation detected
+        confidence = 0.5
+    else:
+        confidence = 0.1
+
+    # Areas with most variation across captures
+    if grid is not None:
+        cells, cell_height, cell_width = grid
+        top_variation_areas = hot_spots(cells, cell_height, cell_width, 5)
+        heatmap = {
+            "captures": variance.count,
+            "grid_size": parameters.heatmap_grid,
+            **compact_heatmap(cells, cell_height, cell_width, parameters.heatmap_top_k)
+        }
+    else:
+        top_variation_areas, heatmap = [], None
+
+    # Prepare response
+    result = {
+        "url": url,
+        "analysis": {
+            "screenshots_captured": len(frames),
+            "unique_variations_detected": num_variations,
+            "is_ab_test_likely": is_ab_test_likely,
+            "confidence_score": confidence,
+            "max_difference_percentage": float(max_difference * 100),
+            "average_difference_percentage": float(avg_difference * 100),
+            "threshold_percentage": float(parameters.threshold * 100)
+        },
+        "variations": {
+            "groups": {
+                f"variation_{i+1}": {
+                    "screenshot_indices": indices,
+                    "frequency": len(indices),
+                    "percentage": len(indices) / len(frames) * 100,
+                    "hashes": {
+                        hash_type: format(value, '016x')
+                        for hash_type, value in zip(hash_types, screenshot_hashes[indices[0]])
+                    },
+                    "max_hash_distance": max_internal_distance(screenshot_hashes, indices),
+                    "within": cluster_stats["within"][i]
+                }
+                for i, indices in enumerate(variation_groups)
+            },
+            "between": [
+                {
+                    "variations": [f"variation_{a+1}", f"variation_{b+1}"],
+                    "difference_percentage": entry["difference_percentage"],
+                    "ssim": entry["ssim"],
+                    # Visible text and layout changes between the variations' first captures
+                    **({"structure": diff_snapshots(
+                        snapshots[variation_groups[a][0]], snapshots[variation_groups[b][0]]
+                    )} if snapshots is not None else {})
+                }
+                for entry in cluster_stats["between"]
+                for a, b in [entry["clusters"]]
+            ],
+            "total_unique": num_variations,
+            "hash_types": hash_types,
+            "hash_radius": parameters.hash_radius
+        },
+        "similarity_metrics": {
+            "average_ssim": sum(ssim_scores) / len(ssim_scores) if ssim_scores else None,
+            "min_ssim": min(ssim_scores) if ssim_scores else None,
+            "max_ssim": max(ssim_scores) if ssim_scores else None,
+            "ssim_mode": parameters.ssim_mode,
+            "ssim_threshold": parameters.ssim_threshold,
+            "pairs_below_ssim_threshold": sum(1 for score in ssim_scores + coarse_scores if score < parameters.ssim_threshold),
+            # Pairs fast mode decided below full resolution: no SSIM, see pairwise.coarse_ssim
+            "pairs_without_full_resolution_ssim": len(coarse_scores),
+            # Pyramid level (0 = full resolution) that decided each distinct pair
+            "decided_at_level": decision_levels(block_results)
+        },
+        "pairwise": {
+            "difference_percentage": np.round(diff_matrix * 100, 3).tolist(),
+            "ssim": [[None if np.isnan(v) else v for v in row] for row in np.round(ssim_matrix, 4).tolist()],
+            **({"coarse_ssim": [
+                [None if np.isnan(v) else v for v in row] for row in np.round(coarse["ssim"], 4).tolist()
+            ]} if coarse else {})
+        },
+        "hot_spots": top_variation_areas[:3],  # Top 3 areas with most variation
+        "heatmap": heatmap,
+        # Blocks describing how the captures were taken and decided
+        **describe_job(block_results, cpu_seconds),
+        "recommendations": []
+    }
+
+    # Add recommendations based on findings
+    if is_ab_test_likely:
         if num_variations == 2:
-            # Classic A/B test pattern
-            confidence = 0.9
+            result["recommendations"].append(
+                "Strong indication of A/B test detected. Use watch_ab_test to monitor this page and track test duration."
+            )
         elif num_variations > 2:
-            # Multivariate test or dynamic content
-            confidence = 0.7
-        elif max_difference > parameters.threshold:
-            # Some variation detected
-            confidence = 0.5
-        else:
-            confidence = 0.1
-
-        # Create heatmap data (simplified - areas with most variation)
-        if len(screenshots) >= 2:
-            # Calculate variance across all screenshots
-            all_arrays = [np.array(img.convert('RGB')) for img in screenshots[:5]]  # Limit for performance
-            stacked = np.stack(all_arrays)
-            variance = np.var(stacked, axis=0).mean(axis=2)  # Average variance across RGB channels
-
-            # Find regions with highest variance
-            height, width = variance.shape
-            grid_size = 10
-            heatmap = []
-
-            for y in range(0, height, height // grid_size):
-                for x in range(0, width, width // grid_size):
-                    region_variance = variance[y:y+height//grid_size, x:x+width//grid_size].mean()
-                    heatmap.append({
-                        "x": x,
-                        "y": y,
-                        "variance": float(region_variance)
-                    })
-
-            # Sort by variance to find hot spots
-            heatmap.sort(key=lambda x: x["variance"], reverse=True)
-            top_variation_areas = heatmap[:5]
-        else:
-            top_variation_areas = []
-
-        # Prepare response
-        result = {
-            "url": parameters.url,
-            "analysis": {
-                "screenshots_captured": len(screenshots),
-                "unique_variations_detected": num_variations,
-                "is_ab_test_likely": is_ab_test_likely,
-                "confidence_score": confidence,
-                "max_difference_percentage": float(max_difference * 100),
-                "average_difference_percentage": float(avg_difference * 100),
-                "threshold_percentage": float(parameters.threshold * 100)
-            },
-            "variations": {
-                "groups": {
-                    f"variation_{i+1}": {
-                        "screenshot_indices": indices,
-                        "frequency": len(indices),
-                        "percentage": len(indices) / len(screenshots) * 100
-                    }
-                    for i, (hash_val, indices) in enumerate(variation_groups.items())
-                },
-                "total_unique": num_variations
-            },
-            "similarity_metrics": {
-                "average_ssim": sum(ssim_scores) / len(ssim_scores) if ssim_scores else None,
-                "min_ssim": min(ssim_scores) if ssim_scores else None,
-                "max_ssim": max(ssim_scores) if ssim_scores else None
-            },
-            "hot_spots": top_variation_areas[:3],  # Top 3 areas with most variation
-            "recommendations": []
-        }
-
-        # Add recommendations based on findings
-        if is_ab_test_likely:
-            if num_variations == 2:
-                result["recommendations"].append(
-                    "Strong indication of A/B test detected. Consider monitoring this page regularly to track test duration."
-                )
-            elif num_variations > 2:
-                result["recommendations"].append(
-                    "Multiple variations detected. This could be a multivariate test or personalization."
-                )
             result["recommendations"].append(
-                "Analyze the varying elements to understand competitor's testing priorities."
+                "Multiple variations detected. This could be a multivariate test or personalization."
             )
-        else:
+        result["recommendations"].append(
+            "Analyze the varying elements to understand competitor's testing priorities."
+        )
+    else:
+        result["recommendations"].append(
+            "No clear A/B test detected. The page appears consistent across captures."
+        )
+        if avg_difference > 0.01:
             result["recommendations"].append(
-                "No clear A/B test detected. The page appears consistent across captures."
+                "Minor variations detected, possibly due to dynamic content or ads."
             )
-            if avg_difference > 0.01:
-                result["recommendations"].append(
-                    "Minor variations detected, possibly due to dynamic content or ads."
-                )
 
-        # Always return screenshot samples for verification (not just when variations detected)
-        if len(screenshots) >= 1:
-            samples = []
-
-            # If variations detected, show first from each variation group
+    # Always return screenshot samples for verification (not just when variations detected)
+    if len(frames) >= 1:
+        # If variations detected, show first from each variation group,
+        # otherwise the first 3 screenshots so the user can verify
+        if num_variations > 1:
+            sample_indices = [indices[0] for indices in variation_groups[:3] if indices]
+        else:
+            sample_indices = [index for index, frame in enumerate(frames) if frame is not None][:3]
+
+        # Samples are stored as artifacts and referenced by URL; PNG previews are only encoded on request
+        artifact_ids = await asyncio.gather(*[store_sample(index) for index in sample_indices])
+        previews = [None] * len(sample_indices)
+        if parameters.inline_previews:
+            previews = await asyncio.gather(*[
+                preview(index) if preview is not None else analysis_pool.run(encode_preview, frames[index])
+                for index in sample_indices
+            ])
+
+        samples = []
+        for i, (index, artifact_id, preview) in enumerate(zip(sample_indices, artifact_ids, previews)):
+            sample = {
+                "screenshot_index": index,
+                "artifact_id": artifact_id,
+                "url": artifact_url(artifact_id),
+                "thumbnail_url": artifact_url(artifact_id, "thumbnail")
+            }
+            if preview is not None:
+                sample["preview"] = preview  # Full image for verification
             if num_variations > 1:
-                for i, (hash_val, indices) in enumerate(list(variation_groups.items())[:3]):
-                    if indices:
-                        img = screenshots[indices[0]]
-                        # Resize for manageable size
-                        img_thumb = img.resize((800, 600), Image.Resampling.LANCZOS)
-
-                        # Convert to base64
-                        buffer = io.BytesIO()
-                        img_thumb.save(buffer, format='PNG')
-                        img_str = base64.b64encode(buffer.getvalue()).decode()
-
-                        samples.append({
-                            "variation": f"variation_{i+1}",
-                            "screenshot_index": indices[0],
-                            "preview": f"data:image/png;base64,{img_str}"  # Full image for verification
-                        })
-            else:
-                # No variations detected - return first 3 screenshots so user can verify
-                for i in range(min(3, len(screenshots))):
-                    img = screenshots[i]
-                    # Resize for manageable size
-                    img_thumb = img.resize((800, 600), Image.Resampling.LANCZOS)
+                sample = {"variation": f"variation_{i+1}", **sample}
+            samples.append(sample)
+
+        result["screenshot_samples"] = samples
+
+    return result
+
+async def store_job(parameters, hash_types, frame_store, frames, screenshots, screenshot_hashes, frame_digests, capture_indices, snapshots, result):
+    """Persist a job's distinct decoded frames, hashes and snapshots in the capture store."""
+    first_of = {}
+    for index, digest in enumerate(frame_digests):
+        if frames[index] is not None:
+            first_of.setdefault(digest, index)
+
+    artifact_ids = await asyncio.gather(
+        *[asyncio.to_thread(artifact_store.put, screenshots[index]) for index in first_of.values()]
+    )
+    metadata = {
+        "url": parameters.url,
+        "detection_mode": parameters.detection_mode,
+        "structural": snapshots is not None,
+        "frames": {
+            digest: {
+                "shape": list(frames[index].shape),
+                "hashes": dict(zip(hash_types, screenshot_hashes[index])),
+                "artifact_id": artifact_id
+            }
+            for (digest, index), artifact_id in zip(first_of.items(), artifact_ids)
+        },
+        "captures": [
+            {
+                "capture_index": capture_index,
+                "frame": digest,
+                "decoded": frames[index] is not None,
+                "snapshot": snapshots[index] if snapshots is not None else None
+            }
+            for index, (capture_index, digest) in enumerate(zip(capture_indices, frame_digests))
+        ],
+        "capture": result["capture"],
+        "sampling": result["sampling"],
+        "network": result["network"],
+        "masking": result.get("masking")
+    }
+    arrays = {
+        digest: (frame_store.view(frames[index]), frame_store.gray_view(frames[index]))
+        for digest, index in first_of.items()
+    }
+    stored = await asyncio.to_thread(
+        capture_store.save, new_job_id(), metadata, arrays, parameters.capture_retention_hours
+    )
+    return {"job_id": stored["job_id"], "expires": datetime.fromtimestamp(stored["expires"], timezone.utc).isoformat()}
+
+@tool("reanalyze_ab_test", "Re-runs the A/B test analysis on the stored captures of an earlier detect_ab_test job with new settings, without recapturing")
+async def reanalyze_ab_test(parameters: ABTestReanalyzeParameters):
+    """
+    Reruns the analysis stage of detect_ab_test (hashing, clustering,
+    comparisons, heatmap) on a job's stored frames with new settings.
+    """
+    invalid = invalid_analysis_parameters(parameters)
+    if invalid is not None:
+        return invalid
+    if not is_job_id(parameters.job_id):
+        return {"error": f"Invalid job_id '{parameters.job_id}'"}
+    # A sweep triggered by another job's save must not delete this job while it is read
+    with capture_store.pin(parameters.job_id):
+        return await reanalyze_stored_job(parameters)
+
+async def reanalyze_stored_job(parameters: ABTestReanalyzeParameters):
+    """reanalyze_ab_test on a job pinned in the capture store."""
+    metadata = await asyncio.to_thread(capture_store.load, parameters.job_id)
+    if metadata is None:
+        return {"error": f"No stored captures for job_id '{parameters.job_id}' (unknown, expired or evicted)"}
+
+    started = time.monotonic()
+    hash_types = list(dict.fromkeys(parameters.hash_types))
+    stored_frames = metadata["frames"]
+    frame_refs = {
+        digest: capture_store.frame_ref(parameters.job_id, digest, info["shape"])
+        for digest, info in stored_frames.items()
+    }
+
+    # Hash types not computed at capture time are computed from the stored frames once and kept
+    missing = {
+        digest: [hash_type for hash_type in hash_types if hash_type not in info["hashes"]]
+        for digest, info in stored_frames.items()
+    }
+    missing = {digest: types for digest, types in missing.items() if types}
+    if missing:
+        computed = await asyncio.gather(
+            *[analysis_pool.run(hash_frame, frame_refs[digest], types) for digest, types in missing.items()]
+        )
+        for digest, hashes in zip(missing, computed):
+            stored_frames[digest]["hashes"].update(hashes)
+        await asyncio.to_thread(capture_store.update, parameters.job_id, {"frames": stored_frames})
+
+    captures = metadata["captures"]
+    frames = [frame_refs[capture["frame"]] if capture["decoded"] else None for capture in captures]
+    screenshot_hashes = [
+        tuple(stored_frames[capture["frame"]]["hashes"][hash_type] for hash_type in hash_types) for capture in captures
+    ]
+    frame_digests = [capture["frame"] for capture in captures]
+    snapshots = [parse_snapshot(capture["snapshot"]) for capture in captures] if metadata["structural"] else None
+    if len(frames) < 2:
+        return {"error": "Not enough screenshots captured for comparison"}
+
+    # Only the heatmap statistics live in shared memory; the frames are read from the store
+    frame_store = FrameStore()
+    variance = StreamingVariance(analysis_pool, frame_store)
+
+    async def variance_grid():
+        # Same frames as the original job: every decoded capture, repeats included
+        for frame in frames:
+            if frame is not None:
+                await variance.add(frame)
+        return await variance.grid(parameters.heatmap_grid)
+
+    async def store_sample(index):
+        artifact_id = stored_frames[frame_digests[index]]["artifact_id"]
+        if await asyncio.to_thread(artifact_store.path, artifact_id) is None:
+            # The screenshot was evicted from the artifact store: re-encode it from the stored frame
+            png = await analysis_pool.run(encode_png, frames[index])
+            artifact_id = await asyncio.to_thread(artifact_store.put, png)
+        return artifact_id
+
+    def describe_job(block_results, compare_cpu):
+        blocks = {
+            "reanalysis": {
+                "captured_at": datetime.fromtimestamp(metadata["created"], timezone.utc).isoformat(),
+                "detection_mode": metadata["detection_mode"],
+                "frames_stored": len(stored_frames),
+                "hashes_computed": sum(len(types) for types in missing.values()),
+                "pairs_compared": sum(len(block) for block in block_results),
+                "cpu_seconds": round(sum(compare_cpu), 4)
+            },
+            "capture": metadata["capture"],
+            "sampling": metadata["sampling"],
+            "network": metadata["network"]
+        }
+        # Stored frames were cropped and masked when the job was captured
+        if metadata.get("masking") is not None:
+            blocks["masking"] = metadata["masking"]
+        return blocks
+
+    try:
+        result = await analyse_frames(
+            parameters,
+            metadata["url"],
+            hash_types,
+            frames,
+            screenshot_hashes,
+            frame_digests,
+            variance,
+            variance_grid,
+            store_sample,
+            describe_job,
+            snapshots=snapshots
+        )
+    except Exception as e:
+        return {
+            "error": f"Failed to reanalyze stored captures: {str(e)}"
+        }
+    finally:
+        frame_store.close()
 
-                    # Convert to base64
-                    buffer = io.BytesIO()
-                    img_thumb.save(buffer, format='PNG')
-                    img_str = base64.b64encode(buffer.getvalue()).decode()
+    result["reanalysis"]["analysis_seconds"] = round(time.monotonic() - started, 3)
+    return {"url": result["url"], "job_id": parameters.job_id, **result}
 
-                    samples.append({
-                        "screenshot_index": i,
-                        "preview": f"data:image/png;base64,{img_str}"  # Full image for verification
-                    })
+@tool("detect_ab_test_batch", "Detects A/B tests on many URLs at once, sharing browsers and interleaving captures across URLs")
+async def detect_ab_test_batch(parameters: ABTestBatchParameters):
+    """
+    Runs detect_ab_test for every URL under one capture scheduler: captures
+    of all URLs share the browser pool and global/per-host concurrency
+    limits, so one URL's delay_seconds spacing is filled with captures of
+    the others. Results are returned per URL in completion order.
+    """
+    if not parameters.urls:
+        return {"error": "No URLs given"}
+
+    limits = CaptureLimits(parameters.max_concurrency, parameters.max_per_host)
+    active_urls = asyncio.Semaphore(max(1, parameters.max_active_urls))
+    started = time.monotonic()
+
+    async def run_one(index: int, url: str):
+        try:
+            url_parameters = ABTestDetectorParameters(**{**parameters.defaults, **parameters.overrides.get(url, {}), "url": url})
+        except ValidationError as e:
+            return {"index": index, "url": url, "result": {"error": f"Invalid parameters: {str(e)}"}}
+        async with active_urls:
+            url_started = time.monotonic()
+            result = await run_ab_detection(url_parameters, limits)
+        return {"index": index, "url": url, "elapsed_seconds": round(time.monotonic() - url_started, 2), "result": result}
+
+    def summary(results):
+        return {
+            "urls": len(parameters.urls),
+            "succeeded": sum(1 for item in results if "error" not in item["result"]),
+            "failed": sum(1 for item in results if "error" in item["result"]),
+            "wall_time_seconds": round(time.monotonic() - started, 2),
+            "max_concurrency": limits.max_concurrency,
+            "max_per_host": limits.max_per_host,
+            "peak_captures_in_flight": limits.peak_in_flight
+        }
 
-            result["screenshot_samples"] = samples
+    async def results_as_completed():
+        tasks = [asyncio.ensure_future(run_one(i, url)) for i, url in enumerate(parameters.urls)]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield await next_result
+        finally:
+            # The client went away or the batch failed: stop the remaining URLs
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    if not parameters.stream:
+        results = [item async for item in results_as_completed()]
+        return {"results": sorted(results, key=lambda item: item["index"]), "summary": summary(results)}
+
+    async def ndjson():
+        results = []
+        async for item in results_as_completed():
+            results.append(item)
+            yield json.dumps(item) + "\n"
+        yield json.dumps({"summary": summary(results)}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
 
-        return result
+# ============================================================================
+# TOOL FUNCTIONS - A/B TEST MONITORING
+# ============================================================================
 
+@tool("watch_ab_test", "Monitors a URL on a schedule and records when an A/B test starts, changes its variants or ends")
+async def watch_ab_test(parameters: WatchABTestParameters):
+    """
+    Adds (or updates) a watched URL. The background monitor re-samples it
+    every interval and matches the new captures against its known variants.
+    """
+    invalid = invalid_analysis_parameters(parameters)
+    if invalid is not None:
+        return invalid
+    if parameters.interval_minutes <= 0 or parameters.captures_per_run < 1 or parameters.window_captures < 2:
+        return {"error": "interval_minutes must be positive, captures_per_run at least 1 and window_captures at least 2"}
+
+    watch = Watch(
+        url=parameters.url,
+        interval_seconds=parameters.interval_minutes * 60,
+        captures_per_run=parameters.captures_per_run,
+        window_captures=parameters.window_captures,
+        hash_types=list(dict.fromkeys(parameters.hash_types)),
+        hash_radius=parameters.hash_radius,
+        viewport_width=parameters.viewport_width,
+        viewport_height=parameters.viewport_height
+    )
+    try:
+        status = await asyncio.to_thread(monitor.store.upsert_watch, watch, parameters.run_now)
     except Exception as e:
-        return {
-            "error": f"Failed to analyze URL for A/B tests: {str(e)}"
-        }
+        return {"error": f"Failed to watch URL: {str(e)}"}
+    monitor.wake()
+    return status
+
+@tool("unwatch_ab_test", "Stops monitoring a URL for A/B tests")
+async def unwatch_ab_test(parameters: UnwatchABTestParameters):
+    """
+    Removes a watched URL, optionally with its history.
+    """
+    removed = await asyncio.to_thread(monitor.store.delete_watch, parameters.url, parameters.keep_history)
+    if not removed:
+        return {"error": f"URL is not watched: {parameters.url}"}
+    return {"url": parameters.url, "watched": False, "history_kept": parameters.keep_history}
+
+@tool("ab_test_monitor_status", "Shows the monitored URLs with their current variants and A/B test start, change and end events")
+async def ab_test_monitor_status(parameters: ABTestMonitorStatusParameters):
+    """
+    Reports the state of one monitored URL, or of every watched URL.
+    """
+    if parameters.url is not None:
+        status = await asyncio.to_thread(monitor.store.watch_status, parameters.url, parameters.events_limit)
+        if status is None:
+            return {"error": f"No monitoring history for {parameters.url}"}
+        return status
+
+    urls = await asyncio.to_thread(monitor.store.watched_urls)
+    return {
+        "watches": [
+            await asyncio.to_thread(monitor.store.watch_status, url, parameters.events_limit) for url in urls
+        ]
+    }
+
+# ============================================================================
+# ARTIFACTS - A/B TEST DETECTOR SCREENSHOTS
+# ============================================================================
+
+@app.get(ARTIFACT_ROUTE + "/{artifact_id}")
+async def get_artifact(artifact_id: str, request: Request, variant: str = "full", format: str = "png"):
+    """
+    Serves a screenshot referenced by a detect_ab_test response.
+    variant: 'full' or 'thumbnail' (800x600); format: 'png', 'webp' or 'jpeg'.
+    """
+    if variant not in VARIANTS or format not in FORMATS:
+        return JSONResponse(
+            {"error": f"Expected variant in {', '.join(VARIANTS)} and format in {', '.join(FORMATS)}"},
+            status_code=400
+        )
+    if not is_artifact_id(artifact_id):
+        return JSONResponse({"error": "Artifact not found"}, status_code=404)
+
+    # An artifact ID is the hash of its content, so a rendition never changes
+    etag = f'"{artifact_id}-{variant}-{format}"'
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    media_type = FORMATS[format][1]
+    # Opened under the store lock, so a concurrent eviction cannot remove it before it is read
+    stored = await asyncio.to_thread(artifact_store.open, artifact_id, variant, format)
+    if stored is not None:
+        headers["Content-Length"] = str(os.fstat(stored.fileno()).st_size)
+        return StreamingResponse(iter_file(stored), media_type=media_type, headers=headers)
+
+    # Render the requested variant/format from the original on first request and keep it
+    source = await asyncio.to_thread(artifact_store.read, artifact_id)
+    if source is None:
+        return JSONResponse({"error": "Artifact not found"}, status_code=404)
+    data = await analysis_pool.run(render, source, variant, format)
+    await asyncio.to_thread(artifact_store.put_rendition, artifact_id, variant, format, data)
+    return Response(content=data, media_type=media_type, headers=headers)
 
 # ============================================================================
 # TOOL FUNCTIONS - A/B TEST PIVOT
@@ -509,40 +1297,10 @@ async def pivot_ab_test_data(parameters: ABTestPivotParameters):
             'Metric Bucket', 'Metric Name', 'Metric Value', 'Metric Rate',
             'Metric Var', 'Metric Stat Sig', 'Metric Confidence Interval'
         ]
-        all_cols = header_cols + metric_cols
-
-        # Build output rows
-        output_rows = []
-        grouped = df_treatment.groupby(['Name', 'Audience(s)', 'Variation Name'], sort=False)
-
-        for (name, audience, variation), group in grouped:
-            for i, (_, row) in enumerate(group.iterrows()):
-                output_row = {}
-
-                # First row gets header info, subsequent rows are blank
-                if i == 0:
-                    for col in header_cols:
-                        output_row[col] = row[col]
-                else:
-                    for col in header_cols:
-                        output_row[col] = ''
-
-                # All rows get metric info
-                for col in metric_cols:
-                    output_row[col] = row[col]
-
-                output_rows.append(output_row)
-
-            # Add blank separator row between groups
-            output_rows.append({col: '' for col in all_cols})
-
-        result_df = pd.DataFrame(output_rows)[all_cols]
-
-        # Convert DataFrame to list of dicts for JSON response
-        pivoted_data = result_df.to_dict(orient='records')
 
-        # Count unique groups
-        unique_groups = df_treatment.groupby(['Name', 'Audience(s)', 'Variation Name']).ngroups
+        # Group rows under blanked repeating headers with a separator row after each group,
+        # as JSON records (vectorized, see api/ab_pivot/pivot.py)
+        pivoted_data, unique_groups = pivot_records(df_treatment, header_cols, metric_cols)
 
         return {
             "pivoted_data": pivoted_data,
@@ -568,7 +1326,7 @@ async def pivot_ab_test_data(parameters: ABTestPivotParameters):
 # Export the app
 handler = app
 
-# For local testing
+# For local testing (run from the repo root: python -m api.heavy)
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
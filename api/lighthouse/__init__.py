@@ -0,0 +1,4 @@
+"""
+Support modules for the analyze_with_lighthouse tool in api/heavy.py
+(running the Lighthouse CLI without blocking the event loop).
+"""
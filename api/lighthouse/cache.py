@@ -0,0 +1,346 @@
+"""
+Result cache for analyze_with_lighthouse.
+
+The same URL is often audited by several agents within minutes. Results are
+cached under the normalized URL plus the Lighthouse options that affect the
+report, in two tiers holding the same payload (a small JSON header with the
+run's metadata, followed by the gzip-compressed report):
+
+* memory: the most recently used payloads, bounded by LIGHTHOUSE_CACHE_MEMORY_MB;
+* disk: one `<key>.bin` file per result, bounded by LIGHTHOUSE_CACHE_MAX_MB
+  with least recently used files evicted first. Its index is rebuilt from the
+  directory on startup, so results survive restarts of the same container.
+
+A result is served while it is younger than the TTL (or the caller's
+stricter maximum age). Concurrent requests for the same key share a single
+run (single-flight): the first one starts it, the others wait for its
+result, and a caller that goes away does not cancel the run for the rest.
+Failed runs are not cached, nor are results the caller's `cacheable` check
+rejects (such as a multi-run result that is missing some of its runs).
+
+Configuration (environment variables):
+    LIGHTHOUSE_CACHE_TTL_SECONDS    seconds a result is served from the cache; 0 disables caching (default: 600)
+    LIGHTHOUSE_CACHE_MEMORY_MB      size cap of the in-memory tier, compressed (default: 64)
+    LIGHTHOUSE_CACHE_DIR            directory of the disk tier (default: <tmp>/opal-lighthouse-cache)
+    LIGHTHOUSE_CACHE_MAX_MB         size cap of the disk tier (default: 512)
+"""
+
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+logger = logging.getLogger(__name__)
+
+TTL_SECONDS = float(os.environ.get("LIGHTHOUSE_CACHE_TTL_SECONDS", "600"))
+MEMORY_MAX_BYTES = int(os.environ.get("LIGHTHOUSE_CACHE_MEMORY_MB", "64")) * 1024 * 1024
+CACHE_DIR = os.environ.get("LIGHTHOUSE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "opal-lighthouse-cache"))
+DISK_MAX_BYTES = int(os.environ.get("LIGHTHOUSE_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    """
+    Canonical form of a URL for cache keys: lowercase scheme and host, no
+    default port, no fragment, "/" for an empty path and sorted query
+    parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = host
+    if parts.port is not None and parts.port != _DEFAULT_PORTS.get(scheme):
+        netloc += f":{parts.port}"
+    if parts.username is not None:
+        userinfo = parts.username + (f":{parts.password}" if parts.password is not None else "")
+        netloc = f"{userinfo}@{netloc}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def cache_key(url: str, options: Sequence[str]) -> str:
+    """Key of a result: SHA-256 of the normalized URL and the run options."""
+    material = json.dumps({"url": normalize_url(url), "options": list(options)}, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+# Payload layout: header length (4 bytes, big endian), JSON header, gzip-compressed report
+_HEADER_LENGTH = struct.Struct('>I')
+
+
+def _encode(meta: Dict[str, Any], report: bytes, url: str, options: Sequence[str], created_at: float) -> bytes:
+    header = json.dumps({"url": url, "options": list(options), "created_at": created_at, "meta": meta}).encode()
+    return _HEADER_LENGTH.pack(len(header)) + header + report
+
+
+def _decode(data: bytes) -> Tuple[float, Dict[str, Any], bytes]:
+    (length,) = _HEADER_LENGTH.unpack_from(data)
+    header = json.loads(data[_HEADER_LENGTH.size:_HEADER_LENGTH.size + length])
+    return header["created_at"], header["meta"], data[_HEADER_LENGTH.size + length:]
+
+
+@dataclass
+class CacheResult:
+    # Small, JSON-serializable metadata of the run
+    meta: Dict[str, Any]
+    # gzip-compressed report
+    report: bytes
+    created_at: float
+    # "memory" or "disk" for cache hits, "run" for a new run, "coalesced" for a run shared with another request
+    source: str
+
+    def open_report(self) -> BinaryIO:
+        """The decompressed report as a binary stream."""
+        return gzip.GzipFile(fileobj=io.BytesIO(self.report), mode='rb')
+
+    def metadata(self) -> Dict[str, Any]:
+        return {
+            "hit": self.source in ("memory", "disk"),
+            "source": self.source,
+            "age_seconds": round(max(0.0, time.time() - self.created_at), 1),
+            "created_at": datetime.fromtimestamp(self.created_at, timezone.utc).isoformat()
+        }
+
+
+class _DiskTier:
+    """
+    Size-capped, LRU-evicted directory of compressed results. Methods do
+    blocking file I/O; call them through asyncio.to_thread.
+    """
+
+    def __init__(self, root: str, max_bytes: int, ttl_seconds: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # file name -> size, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        self._loaded = False
+
+    def _load(self):
+        # Rebuild the index from disk, oldest access first, dropping expired results
+        if self._loaded:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            stat = os.stat(path)
+            if name.endswith(".tmp") or now - stat.st_mtime > self.ttl_seconds:
+                os.unlink(path)
+                continue
+            found.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._total += size
+        self._loaded = True
+
+    def _remove(self, name: str):
+        self._total -= self._entries.pop(name)
+        try:
+            os.unlink(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        name = f"{key}.bin"
+        with self._lock:
+            self._load()
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+        try:
+            with open(os.path.join(self.root, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        name = f"{key}.bin"
+        path = os.path.join(self.root, name)
+        with self._lock:
+            self._load()
+            if name in self._entries:
+                self._remove(name)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._entries[name] = len(data)
+            self._total += len(data)
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                if oldest == name:
+                    break
+                self._remove(oldest)
+
+    def stats(self) -> Tuple[int, int]:
+        """(number of files, total bytes)."""
+        with self._lock:
+            self._load()
+            return len(self._entries), self._total
+
+
+class LighthouseCache:
+    """
+    Two-tier TTL cache of Lighthouse results with single-flight runs.
+
+    Usage:
+        result = await cache.get_or_run(url, options, run)
+        result.meta, result.open_report(), result.metadata()
+
+    `run` is a coroutine function producing (JSON-serializable metadata,
+    gzip-compressed report); it is only called when no fresh enough result
+    is cached and no identical run is in flight.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = TTL_SECONDS,
+        memory_max_bytes: int = MEMORY_MAX_BYTES,
+        root: str = CACHE_DIR,
+        disk_max_bytes: int = DISK_MAX_BYTES
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.memory_max_bytes = memory_max_bytes
+        # key -> (created_at, compressed payload), least recently used first
+        self._memory: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._memory_total = 0
+        self._disk = _DiskTier(root, disk_max_bytes, ttl_seconds)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._hits = {"memory": 0, "disk": 0}
+        self._runs = 0
+        self._coalesced = 0
+
+    def _memory_get(self, key: str, max_age: float) -> Optional[Tuple[float, bytes]]:
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > max_age:
+            return None
+        self._memory.move_to_end(key)
+        return entry
+
+    def _memory_put(self, key: str, created_at: float, data: bytes):
+        if key in self._memory:
+            self._memory_total -= len(self._memory.pop(key)[1])
+        if len(data) > self.memory_max_bytes:
+            return
+        self._memory[key] = (created_at, data)
+        self._memory_total += len(data)
+        while self._memory_total > self.memory_max_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_total -= len(evicted)
+
+    async def _lookup(self, key: str, max_age: float) -> Optional[CacheResult]:
+        entry = self._memory_get(key, max_age)
+        source = "memory"
+        if entry is None:
+            data = await asyncio.to_thread(self._disk.get, key)
+            if data is None:
+                return None
+            created_at, meta, report = _decode(data)
+            if time.time() - created_at > max_age:
+                return None
+            self._memory_put(key, created_at, data)
+            source = "disk"
+        else:
+            created_at, meta, report = _decode(entry[1])
+        self._hits[source] += 1
+        return CacheResult(meta, report, created_at, source)
+
+    async def _run(
+        self,
+        key: str,
+        url: str,
+        options: Sequence[str],
+        run: Callable[[], Awaitable[Tuple[Dict[str, Any], bytes]]],
+        cacheable: Optional[Callable[[Dict[str, Any]], bool]]
+    ):
+        self._runs += 1
+        meta, report = await run()
+        created_at = time.time()
+        if self.ttl_seconds > 0 and (cacheable is None or cacheable(meta)):
+            try:
+                data = _encode(meta, report, url, options, created_at)
+                self._memory_put(key, created_at, data)
+                await asyncio.to_thread(self._disk.put, key, data)
+            except Exception as e:
+                logger.warning("Failed to cache Lighthouse result: %s", e)
+        return created_at, meta, report
+
+    def _finished(self, key: str, task: asyncio.Future):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark a failure as retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    async def get_or_run(
+        self,
+        url: str,
+        options: Sequence[str],
+        run: Callable[[], Awaitable[Tuple[Dict[str, Any], bytes]]],
+        max_age: Optional[float] = None,
+        cacheable: Optional[Callable[[Dict[str, Any]], bool]] = None
+    ) -> CacheResult:
+        """
+        A cached result at most `max_age` seconds old (at most the TTL;
+        0 skips the cache), else the result of an in-flight identical run,
+        else the result of a new run. A new result is only stored if
+        `cacheable(meta)` is true (always without `cacheable`).
+        """
+        max_age = self.ttl_seconds if max_age is None else min(max_age, self.ttl_seconds)
+        key = cache_key(url, options)
+        if max_age > 0:
+            try:
+                cached = await self._lookup(key, max_age)
+            except Exception as e:
+                logger.warning("Failed to read cached Lighthouse result: %s", e)
+                cached = None
+            if cached is not None:
+                return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self._coalesced += 1
+            source = "coalesced"
+        else:
+            task = asyncio.ensure_future(self._run(key, url, options, run, cacheable))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+            source = "run"
+        # Shielded so one caller's cancellation does not cancel the run for the others
+        created_at, meta, report = await asyncio.shield(task)
+        return CacheResult(meta, report, created_at, source)
+
+    def stats(self) -> Dict[str, Any]:
+        files, disk_bytes = self._disk.stats()
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_total,
+            "disk_entries": files,
+            "disk_bytes": disk_bytes,
+            "hits": dict(self._hits),
+            "runs": self._runs,
+            "coalesced": self._coalesced,
+            "in_flight": len(self._inflight)
+        }
@@ -0,0 +1,272 @@
+"""
+Warm Chrome instances for Lighthouse runs.
+
+Left to itself, the Lighthouse CLI launches a fresh headless Chrome for
+every run and tears it down afterwards, which costs seconds per audit.
+ChromePool instead launches a few Chrome processes with the app, each
+listening on a remote debugging port, and Lighthouse attaches to one of
+them with `--port`.
+
+* A lease is exclusive: one Lighthouse run per Chrome at a time, so runs
+  never compete for the same renderer.
+* Every Chrome has its own temporary profile directory. Lighthouse resets
+  the audited origin's storage and the HTTP cache when a run starts; when
+  the run ends, the pool also clears every cookie in the profile and the
+  storage of every origin the run requested, so the next run starts from a
+  clean profile.
+* A Chrome is recycled (killed, its profile deleted and a new one launched)
+  after a number of runs, once it is older than a maximum age, when a run
+  on it timed out or its reset failed, and when it has exited. A background
+  task replaces dead and expired idle instances (see
+  api/shared/warm_pool.py for the lifecycle shared with the A/B
+  detector's browser pool).
+
+The Chrome binary is CHROME_PATH (the variable Lighthouse's own launcher
+reads) or, when unset, Playwright's Chromium.
+
+Configuration (environment variables):
+    LIGHTHOUSE_CHROME_POOL_SIZE          warm Chrome instances; 0 lets Lighthouse launch Chrome per run (default: LIGHTHOUSE_MAX_CONCURRENCY)
+    LIGHTHOUSE_CHROME_MAX_RUNS           runs before a Chrome is recycled (default 25)
+    LIGHTHOUSE_CHROME_MAX_AGE_MINUTES    minutes before a Chrome is recycled (default 30)
+    LIGHTHOUSE_CHROME_HEALTH_INTERVAL    seconds between health checks (default 30)
+    CHROME_PATH                          Chrome executable (default: Playwright's Chromium)
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional
+
+from api.shared.warm_pool import WarmPool
+from api.lighthouse.processes import kill_process_group, kill_tagged
+from api.lighthouse.runner import CHROME_FLAGS, MAX_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.environ.get("LIGHTHOUSE_CHROME_POOL_SIZE", str(MAX_CONCURRENCY)))
+MAX_RUNS_PER_CHROME = int(os.environ.get("LIGHTHOUSE_CHROME_MAX_RUNS", "25"))
+MAX_CHROME_AGE_MINUTES = float(os.environ.get("LIGHTHOUSE_CHROME_MAX_AGE_MINUTES", "30"))
+HEALTH_CHECK_INTERVAL = float(os.environ.get("LIGHTHOUSE_CHROME_HEALTH_INTERVAL", "30"))
+CHROME_PATH = os.environ.get("CHROME_PATH")
+
+# Flags chrome-launcher adds when Lighthouse launches Chrome itself, so
+# pooled runs measure the same browser configuration
+LAUNCHER_FLAGS = [
+    '--disable-background-networking',
+    '--disable-background-timer-throttling',
+    '--disable-backgrounding-occluded-windows',
+    '--disable-renderer-backgrounding',
+    '--disable-client-side-phishing-detection',
+    '--disable-component-update',
+    '--disable-default-apps',
+    '--disable-domain-reliability',
+    '--disable-extensions',
+    '--disable-hang-monitor',
+    '--disable-sync',
+    '--metrics-recording-only',
+    '--mute-audio',
+    '--no-default-browser-check',
+    '--no-first-run',
+    '--password-store=basic',
+    '--use-mock-keychain'
+]
+
+# Switch added to every pooled Chrome so its process tree can be found in /proc
+_MARKER_SWITCH = "--opal-lighthouse-chrome"
+
+# Seconds to wait for a launched Chrome to open its debugging port
+_LAUNCH_TIMEOUT = 30
+
+# Seconds to wait for a killed Chrome to be reaped
+_KILL_WAIT = 5
+
+
+@dataclass
+class PooledChrome:
+    """A warm Chrome process owned by the pool."""
+    process: asyncio.subprocess.Process
+    port: int
+    marker: str
+    profile_dir: str
+    launched_at: float
+    runs: int = 0
+    leased: bool = False
+    retired: bool = False
+
+    @property
+    def healthy(self) -> bool:
+        return not self.retired and self.process.returncode is None
+
+    @property
+    def age_minutes(self) -> float:
+        return (time.monotonic() - self.launched_at) / 60
+
+
+async def _debugging_port(process: asyncio.subprocess.Process, profile_dir: str) -> int:
+    """Wait for Chrome to write the port it listens on to DevToolsActivePort."""
+    path = os.path.join(profile_dir, 'DevToolsActivePort')
+    while True:
+        if process.returncode is not None:
+            raise RuntimeError(f"Chrome exited during launch with code {process.returncode}")
+        try:
+            with open(path) as f:
+                first_line = f.readline().strip()
+            if first_line:
+                return int(first_line)
+        except (OSError, ValueError):
+            pass
+        await asyncio.sleep(0.05)
+
+
+class ChromePool(WarmPool):
+    """
+    Pool of warm Chrome processes that Lighthouse runs attach to.
+
+    Usage:
+        pool = ChromePool()
+        await pool.start()
+        chrome = await pool.acquire()
+        ... lighthouse <url> --port=<chrome.port> ...
+        await pool.release(chrome, visited_origins(url, report))
+        await pool.stop()
+
+    LighthouseRunner (runner.py) does this for every run when given a pool.
+    """
+
+    pool_name = "Lighthouse Chrome pool"
+    instance_name = "Chrome"
+
+    def __init__(
+        self,
+        size: int = POOL_SIZE,
+        max_runs_per_chrome: int = MAX_RUNS_PER_CHROME,
+        max_age_minutes: float = MAX_CHROME_AGE_MINUTES,
+        health_check_interval: float = HEALTH_CHECK_INTERVAL,
+        executable: Optional[str] = CHROME_PATH
+    ):
+        super().__init__(size, health_check_interval)
+        self.max_runs_per_chrome = max_runs_per_chrome
+        self.max_age_minutes = max_age_minutes
+        self.executable = executable
+
+    async def _launch(self) -> PooledChrome:
+        marker = uuid.uuid4().hex
+        profile_dir = tempfile.mkdtemp(prefix='lighthouse-chrome-')
+        process = None
+        try:
+            # Playwright's Chromium by default; Playwright also provides the CDP connection _reset uses
+            process = await asyncio.create_subprocess_exec(
+                self.executable or self._playwright.chromium.executable_path,
+                *CHROME_FLAGS,
+                *LAUNCHER_FLAGS,
+                f'--user-data-dir={profile_dir}',
+                '--remote-debugging-address=127.0.0.1',
+                # Port 0 lets Chrome pick a free port and report it in DevToolsActivePort
+                '--remote-debugging-port=0',
+                f'{_MARKER_SWITCH}={marker}',
+                'about:blank',
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+                start_new_session=True
+            )
+            port = await asyncio.wait_for(_debugging_port(process, profile_dir), _LAUNCH_TIMEOUT)
+        except BaseException:
+            if process is not None:
+                kill_process_group(process.pid)
+            await asyncio.to_thread(self._remove, marker, profile_dir)
+            raise
+        self._launches += 1
+        return PooledChrome(
+            process=process, port=port, marker=marker, profile_dir=profile_dir, launched_at=time.monotonic()
+        )
+
+    @staticmethod
+    def _remove(marker: str, profile_dir: str):
+        kill_tagged(marker)
+        shutil.rmtree(profile_dir, ignore_errors=True)
+
+    async def _close(self, chrome: PooledChrome):
+        # Also when Chrome itself has exited: its renderers may still be alive in its group
+        kill_process_group(chrome.process.pid)
+        if chrome.process.returncode is None:
+            try:
+                await asyncio.wait_for(chrome.process.wait(), _KILL_WAIT)
+            except asyncio.TimeoutError:
+                logger.warning("Pooled Chrome %d did not exit after SIGKILL", chrome.process.pid)
+        await asyncio.to_thread(self._remove, chrome.marker, chrome.profile_dir)
+
+    # ------------------------------------------------------------------
+    # Leasing
+    # ------------------------------------------------------------------
+
+    def _lease(self) -> Optional[PooledChrome]:
+        # Leases are exclusive: any idle healthy Chrome
+        for chrome in self._instances:
+            if chrome.healthy and not chrome.leased:
+                chrome.leased = True
+                return chrome
+        return None
+
+    def _in_use(self, chrome: PooledChrome) -> bool:
+        return chrome.leased
+
+    async def release(self, chrome: PooledChrome, origins: Iterable[str] = (), retire: bool = False):
+        """
+        Return a lease after a run. The profile is reset for the next run, or
+        the Chrome is recycled if `retire` is set (the run was killed) or it
+        is due for replacement.
+        """
+        chrome.runs += 1
+        if retire or chrome.runs >= self.max_runs_per_chrome or chrome.age_minutes >= self.max_age_minutes:
+            chrome.retired = True
+        if chrome.healthy:
+            try:
+                await self._reset(chrome, origins)
+            except Exception as e:
+                logger.warning("Failed to reset pooled Chrome profile, recycling it: %s", e)
+                chrome.retired = True
+
+        async with self._condition:
+            chrome.leased = False
+            self._condition.notify_all()
+
+        if not chrome.healthy:
+            await self._replace_if_idle(chrome)
+
+    async def _reset(self, chrome: PooledChrome, origins: Iterable[str]):
+        """Clear every cookie, and the storage of `origins`, from the Chrome's profile."""
+        browser = await self._playwright.chromium.connect_over_cdp(f'http://127.0.0.1:{chrome.port}')
+        try:
+            session = await browser.new_browser_cdp_session()
+            await session.send('Storage.clearCookies')
+            for origin in origins:
+                await session.send('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+        finally:
+            # Disconnects only; the Chrome process keeps running
+            await browser.close()
+
+    # ------------------------------------------------------------------
+    # Health checks
+    # ------------------------------------------------------------------
+
+    async def _needs_replacing(self, chrome: PooledChrome) -> bool:
+        # Dead and expired Chromes are replaced once idle
+        if chrome.leased:
+            return False
+        if chrome.age_minutes >= self.max_age_minutes:
+            chrome.retired = True
+        return not chrome.healthy
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chromes": len(self._instances),
+            "leased": sum(1 for chrome in self._instances if chrome.leased),
+            "launches": self._launches,
+            "recycled": self._recycled
+        }
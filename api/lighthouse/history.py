@@ -0,0 +1,317 @@
+"""
+Historical Lighthouse results.
+
+Every new analyze_with_lighthouse run (not cache hits) records its category
+scores and key metrics in one SQLite database, so trends, baselines and
+regressions are answered from the store instead of by new audits:
+
+* one narrow row per run: integer scores (0-100) and metric values
+  (numericValue, ms except cumulative-layout-shift) as plain columns, in a
+  WITHOUT ROWID table clustered on (url, profile, time); URLs are stored
+  once, normalized as for the result cache;
+* results of different profiles are kept apart by the profile's canonical
+  key (see profiles.RunProfile.key), since a seo-only run has no
+  performance score to compare, and a custom run of one audit builds its
+  category scores from that audit alone;
+* a multi-run result is recorded as the medians of its runs, flagged
+  `partial` when some of its runs failed.
+
+A regression is the latest run being worse than the baseline by more than
+a threshold: a score `score_threshold` points lower, or a metric
+`metric_threshold_percent` higher. The default baseline is the median of
+the runs before the latest one.
+
+Configuration (environment variables):
+    LIGHTHOUSE_HISTORY_DB    SQLite database path (default: <tmp>/opal-lighthouse-history.sqlite3)
+"""
+
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+from api.lighthouse.cache import normalize_url
+from api.lighthouse.report import SUMMARY_CATEGORIES, SUMMARY_METRICS
+
+HISTORY_DB = os.environ.get(
+    "LIGHTHOUSE_HISTORY_DB", os.path.join(tempfile.gettempdir(), "opal-lighthouse-history.sqlite3")
+)
+
+BASELINES = ("median", "previous", "first")
+
+# Report name -> column name
+SCORE_COLUMNS = {category: category.replace('-', '_') for category in SUMMARY_CATEGORIES}
+METRIC_COLUMNS = {metric: metric.replace('-', '_') for metric in SUMMARY_METRICS}
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS urls (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS runs (
+    url_id INTEGER NOT NULL REFERENCES urls (id),
+    profile TEXT NOT NULL,
+    at REAL NOT NULL,
+    runs INTEGER NOT NULL,
+    partial INTEGER NOT NULL DEFAULT 0,
+    {", ".join(f"{column} INTEGER" for column in SCORE_COLUMNS.values())},
+    {", ".join(f"{column} REAL" for column in METRIC_COLUMNS.values())},
+    PRIMARY KEY (url_id, profile, at)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS runs_time ON runs (at);
+"""
+
+_VALUE_COLUMNS = list(SCORE_COLUMNS.values()) + list(METRIC_COLUMNS.values())
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def _row_values(row: sqlite3.Row) -> Dict[str, Dict[str, Any]]:
+    return {
+        "scores": {category: row[column] for category, column in SCORE_COLUMNS.items()},
+        "metrics": {metric: row[column] for metric, column in METRIC_COLUMNS.items()}
+    }
+
+
+def values_from_result(meta: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    """
+    Column values of an analyze_with_lighthouse result's metadata: the
+    medians of a multi-run result, else the run's own summary fields.
+    """
+    runs = meta.get("runs")
+    fields = meta["summary_fields"]
+    values: Dict[str, Optional[float]] = {}
+    for category, column in SCORE_COLUMNS.items():
+        if runs is not None:
+            spread = runs["categories"].get(category)
+            score = spread["median"] if spread else None
+        else:
+            score = fields.get(f'categories.{category}.score')
+            score = score * 100 if score is not None else None
+        values[column] = round(score) if score is not None else None
+    for metric, column in METRIC_COLUMNS.items():
+        if runs is not None:
+            spread = runs["metrics"].get(metric)
+            value = spread["median"] if spread else None
+        else:
+            value = fields.get(f'audits.{metric}.numericValue')
+        values[column] = round(value, 3) if value is not None else None
+    return values
+
+
+def compare_values(
+    latest: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    score_threshold: float,
+    metric_threshold_percent: float
+) -> Dict[str, Any]:
+    """Per score and metric change from `baseline` to `latest`, and the regressions among them."""
+    changes: Dict[str, Dict[str, Any]] = {"scores": {}, "metrics": {}}
+    regressions = []
+    for kind in ("scores", "metrics"):
+        for name, value in latest[kind].items():
+            base = baseline[kind].get(name)
+            if value is None or base is None:
+                continue
+            change = value - base
+            entry = {"latest": value, "baseline": base, "change": round(change, 3)}
+            if kind == "scores":
+                # Scores: higher is better
+                regressed = -change > score_threshold
+            else:
+                # Metrics: lower is better
+                entry["change_percent"] = round(change / base * 100, 1) if base else None
+                regressed = base > 0 and change / base * 100 > metric_threshold_percent
+            entry["regressed"] = regressed
+            changes[kind][name] = entry
+            if regressed:
+                regressions.append({"kind": kind[:-1], "name": name, **entry})
+    return {"changes": changes, "regressions": regressions}
+
+
+class LighthouseHistory:
+    """
+    SQLite history of Lighthouse results. Methods block; call them through
+    asyncio.to_thread from handlers.
+    """
+
+    def __init__(self, path: str = HISTORY_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def record(self, url: str, profile: str, meta: Dict[str, Any], at: Optional[float] = None):
+        """Store the scores and metrics of an analyze_with_lighthouse result."""
+        values = values_from_result(meta)
+        runs = meta["runs"]["completed"] if "runs" in meta else 1
+        partial = bool(meta.get("runs", {}).get("partial", False))
+        with self._lock:
+            db = self._db()
+            with db:
+                db.execute("INSERT OR IGNORE INTO urls (url) VALUES (?)", (normalize_url(url),))
+                url_id = db.execute("SELECT id FROM urls WHERE url = ?", (normalize_url(url),)).fetchone()["id"]
+                db.execute(
+                    f"INSERT OR REPLACE INTO runs (url_id, profile, at, runs, partial, {', '.join(_VALUE_COLUMNS)}) "
+                    f"VALUES (?, ?, ?, ?, ?, {', '.join('?' for _ in _VALUE_COLUMNS)})",
+                    (
+                        url_id, profile, time.time() if at is None else at, runs, partial,
+                        *[values[c] for c in _VALUE_COLUMNS]
+                    )
+                )
+
+    def _runs(
+        self,
+        url: str,
+        profile: str,
+        since: Optional[float] = None,
+        limit: Optional[int] = None
+    ) -> List[sqlite3.Row]:
+        """Runs of a URL and profile, newest first."""
+        query = (
+            "SELECT runs.* FROM runs JOIN urls ON urls.id = runs.url_id "
+            "WHERE urls.url = ? AND runs.profile = ? AND runs.at >= ? ORDER BY runs.at DESC"
+        )
+        args: List[Any] = [normalize_url(url), profile, since if since is not None else 0]
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        with self._lock:
+            return self._db().execute(query, args).fetchall()
+
+    def trend(self, url: str, profile: str, since: Optional[float] = None, limit: int = 100) -> Optional[Dict[str, Any]]:
+        """
+        The most recent runs of a URL (oldest first) with, per score and
+        metric, its latest value, median, range and change over the period.
+        """
+        rows = self._runs(url, profile, since, limit)
+        if not rows:
+            return None
+        rows.reverse()
+        points = [
+            {"at": _iso(row["at"]), "runs": row["runs"], "partial": bool(row["partial"]), **_row_values(row)}
+            for row in rows
+        ]
+        summary: Dict[str, Dict[str, Any]] = {"scores": {}, "metrics": {}}
+        for kind, columns in (("scores", SCORE_COLUMNS), ("metrics", METRIC_COLUMNS)):
+            for name, column in columns.items():
+                values = [row[column] for row in rows if row[column] is not None]
+                if not values:
+                    continue
+                summary[kind][name] = {
+                    "latest": values[-1],
+                    "median": statistics.median(values),
+                    "min": min(values),
+                    "max": max(values),
+                    "change": round(values[-1] - values[0], 3)
+                }
+        return {
+            "url": normalize_url(url),
+            "profile": profile,
+            "count": len(points),
+            "from": points[0]["at"],
+            "to": points[-1]["at"],
+            "summary": summary,
+            "points": points
+        }
+
+    def compare(
+        self,
+        url: str,
+        profile: str,
+        baseline: str = "median",
+        baseline_runs: int = 5,
+        score_threshold: float = 5,
+        metric_threshold_percent: float = 10
+    ) -> Optional[Dict[str, Any]]:
+        """
+        The latest run of a URL against a baseline: the median of the
+        `baseline_runs` runs before it, the previous run, or the first run
+        stored. None when the URL has fewer than two runs.
+        """
+        if baseline == "first":
+            rows = self._runs(url, profile, limit=1)
+            with self._lock:
+                first = self._db().execute(
+                    "SELECT runs.* FROM runs JOIN urls ON urls.id = runs.url_id "
+                    "WHERE urls.url = ? AND runs.profile = ? ORDER BY runs.at LIMIT 1",
+                    (normalize_url(url), profile)
+                ).fetchone()
+            base_rows = [first] if rows and first is not None and first["at"] != rows[0]["at"] else []
+        else:
+            rows = self._runs(url, profile, limit=1 + (1 if baseline == "previous" else max(1, baseline_runs)))
+            base_rows = rows[1:]
+        if not rows or not base_rows:
+            return None
+
+        latest = _row_values(rows[0])
+        base: Dict[str, Dict[str, Any]] = {"scores": {}, "metrics": {}}
+        for kind, columns in (("scores", SCORE_COLUMNS), ("metrics", METRIC_COLUMNS)):
+            for name, column in columns.items():
+                values = [row[column] for row in base_rows if row[column] is not None]
+                base[kind][name] = statistics.median(values) if values else None
+        return {
+            "url": normalize_url(url),
+            "profile": profile,
+            "latest_at": _iso(rows[0]["at"]),
+            "latest_partial": bool(rows[0]["partial"]),
+            "baseline": {
+                "kind": baseline,
+                "runs": len(base_rows),
+                "from": _iso(base_rows[-1]["at"]),
+                "to": _iso(base_rows[0]["at"])
+            },
+            **compare_values(latest, base, score_threshold, metric_threshold_percent)
+        }
+
+    def urls(self, profile: str, since: Optional[float] = None) -> List[str]:
+        """URLs with runs of `profile` since a time, most recently run first."""
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT urls.url, MAX(runs.at) AS last FROM runs JOIN urls ON urls.id = runs.url_id "
+                "WHERE runs.profile = ? AND runs.at >= ? GROUP BY urls.url ORDER BY last DESC",
+                (profile, since if since is not None else 0)
+            ).fetchall()
+        return [row["url"] for row in rows]
+
+    def regressions(
+        self,
+        profile: str,
+        urls: Sequence[str] = (),
+        since: Optional[float] = None,
+        baseline: str = "median",
+        baseline_runs: int = 5,
+        score_threshold: float = 5,
+        metric_threshold_percent: float = 10
+    ) -> List[Dict[str, Any]]:
+        """Comparisons of the given URLs (default: every URL run since `since`) that show a regression."""
+        flagged = []
+        for url in urls or self.urls(profile, since):
+            comparison = self.compare(url, profile, baseline, baseline_runs, score_threshold, metric_threshold_percent)
+            if comparison is not None and comparison["regressions"]:
+                flagged.append(comparison)
+        return flagged
@@ -0,0 +1,75 @@
+"""
+Aggregation of repeated Lighthouse runs.
+
+A single Lighthouse run is noisy: the same page can score several points
+apart between runs. analyze_with_lighthouse can run the same audit N times
+in parallel, each run on its own Chrome (a pooled instance leased
+exclusively, or one launched for the run) and within the runner's
+concurrency limit, and aggregate the results here:
+
+* per category score and per metric (numericValue): median, min, max and
+  standard deviation over the runs that completed;
+* the representative run: the one closest to the medians, measured as the
+  sum of squared relative distances over every metric and score all runs
+  have (the idea of Lighthouse's own computeMedianRun, which uses FCP and
+  TTI only). Its report is returned as the full report, so summary and
+  full report describe one real run rather than a synthetic mix.
+
+Configuration (environment variables):
+    LIGHTHOUSE_MAX_RUNS    upper bound of `runs` per request (default: 5)
+"""
+
+import os
+import statistics
+from typing import Any, Dict, List, Optional
+
+from api.lighthouse.report import SUMMARY_CATEGORIES, SUMMARY_METRICS
+
+MAX_RUNS = int(os.environ.get("LIGHTHOUSE_MAX_RUNS", "5"))
+
+
+def _values(fields: List[Dict[str, Any]]) -> Dict[str, List[Optional[float]]]:
+    """Category scores (0-100) and metric values of each run, by name."""
+    values: Dict[str, List[Optional[float]]] = {}
+    for category in SUMMARY_CATEGORIES:
+        scores = [run.get(f'categories.{category}.score') for run in fields]
+        values[f'categories.{category}'] = [score * 100 if score is not None else None for score in scores]
+    for metric in SUMMARY_METRICS:
+        values[f'metrics.{metric}'] = [run.get(f'audits.{metric}.numericValue') for run in fields]
+    return values
+
+
+def _spread(values: List[float]) -> Dict[str, float]:
+    return {
+        "median": round(statistics.median(values), 3),
+        "min": round(min(values), 3),
+        "max": round(max(values), 3),
+        "stdev": round(statistics.stdev(values), 3) if len(values) > 1 else 0.0
+    }
+
+
+def representative_run(fields: List[Dict[str, Any]]) -> int:
+    """Index of the run closest to the medians of the values every run has."""
+    distances = [0.0] * len(fields)
+    for values in _values(fields).values():
+        if any(value is None for value in values):
+            continue
+        median = statistics.median(values)
+        scale = abs(median) or 1.0
+        for i, value in enumerate(values):
+            distances[i] += ((value - median) / scale) ** 2
+    return min(range(len(fields)), key=lambda i: distances[i])
+
+
+def aggregate(fields: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Median and spread of each category score and metric over runs' summary
+    fields (see report.annotate); None where no run has the value.
+    """
+    categories = {}
+    metrics = {}
+    for name, values in _values(fields).items():
+        present = [value for value in values if value is not None]
+        kind, key = name.split('.', 1)
+        (categories if kind == 'categories' else metrics)[key] = _spread(present) if present else None
+    return {"categories": categories, "metrics": metrics}
@@ -0,0 +1,58 @@
+"""
+Killing Lighthouse and Chrome process trees.
+
+Lighthouse and the Chrome instances it drives are started in process groups
+of their own. chrome-launcher also detaches Chrome from Lighthouse's group,
+so Chrome is additionally found through a marker switch on its command line.
+"""
+
+import os
+import signal
+from typing import Dict, List
+
+
+def kill_process_group(pid: int):
+    """SIGKILL the process group led by `pid`, if it still exists."""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def kill_tagged(marker: str):
+    """
+    SIGKILL every process whose command line contains `marker`, and all of
+    their descendants. Does nothing where /proc is not available.
+    """
+    if not os.path.isdir('/proc'):
+        return
+
+    children: Dict[int, List[int]] = {}
+    tagged = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        pid = int(entry)
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                # The command name may contain spaces, fields resume after ')'
+                parent = int(f.read().rsplit(b')', 1)[1].split()[1])
+            children.setdefault(parent, []).append(pid)
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                if marker.encode() in f.read():
+                    tagged.append(pid)
+        except (OSError, IndexError, ValueError):
+            continue
+
+    victims = set()
+    stack = list(tagged)
+    while stack:
+        pid = stack.pop()
+        if pid not in victims:
+            victims.add(pid)
+            stack.extend(children.get(pid, []))
+    for pid in victims:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
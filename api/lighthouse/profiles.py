@@ -0,0 +1,135 @@
+"""
+Run profiles for analyze_with_lighthouse.
+
+A full Lighthouse run gathers and audits every category, including the
+deprecated `pwa`, even when the caller only wants one score. A profile
+names the subset of the report that is needed and maps it to Lighthouse's
+`--only-categories` / `--only-audits` filters, so gatherers and audits
+outside it are skipped:
+
+* default: performance, accessibility, best-practices and seo (no pwa, so
+  summary.scores.pwa is None unless the caller asks for "all");
+* all: every category, including pwa;
+* performance, accessibility, best-practices, seo: that category only;
+* custom: the caller's own categories and/or audit ids.
+
+The filters are part of the run options and therefore of the result cache
+key, so a cached report is only served to requests of the same profile.
+Responses keep one schema for every profile: summary scores and metrics
+that the profile did not run are None.
+
+ProfileTimings keeps the run times of recent runs per profile key (see
+RunProfile.key), to report how long each profile typically takes.
+"""
+
+import re
+import statistics
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+CATEGORIES = ['performance', 'accessibility', 'best-practices', 'seo', 'pwa']
+
+# Profile name -> categories it runs; None runs every category
+PROFILES: Dict[str, Optional[List[str]]] = {
+    "default": ['performance', 'accessibility', 'best-practices', 'seo'],
+    "all": None,
+    "performance": ['performance'],
+    "accessibility": ['accessibility'],
+    "best-practices": ['best-practices'],
+    "seo": ['seo']
+}
+CUSTOM_PROFILE = "custom"
+PROFILE_NAMES = list(PROFILES) + [CUSTOM_PROFILE]
+
+# Lighthouse audit ids: lowercase words joined by hyphens
+_AUDIT_ID = re.compile(r'^[a-z0-9]+(-[a-z0-9]+)*$')
+
+
+@dataclass
+class RunProfile:
+    name: str
+    # None runs every category
+    categories: Optional[List[str]]
+    audits: List[str]
+
+    def flags(self) -> List[str]:
+        """Lighthouse filter flags of the profile (sorted, so equal profiles share a cache key)."""
+        flags = []
+        if self.categories is not None:
+            flags.append(f'--only-categories={",".join(sorted(self.categories))}')
+        if self.audits:
+            flags.append(f'--only-audits={",".join(sorted(self.audits))}')
+        return flags
+
+    def key(self) -> str:
+        """
+        Canonical id of what the profile runs: the name of the preset with
+        the same filters, else the sorted filter flags (so custom profiles
+        with different audits are kept apart).
+        """
+        flags = self.flags()
+        for name, categories in PROFILES.items():
+            if flags == RunProfile(name, categories, []).flags():
+                return name
+        return ' '.join(flags)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "name": self.name,
+            "key": self.key(),
+            "categories": [c for c in CATEGORIES if self.categories is None or c in self.categories],
+            "audits": sorted(self.audits)
+        }
+
+
+def resolve_profile(
+    name: str,
+    categories: Sequence[str] = (),
+    audits: Sequence[str] = ()
+) -> Tuple[Optional[RunProfile], Optional[str]]:
+    """
+    (profile, None) for a valid profile request, else (None, error message).
+    `categories` and `audits` are only used by the custom profile.
+    """
+    if name in PROFILES:
+        if categories or audits:
+            return None, f"only_categories and only_audits need the '{CUSTOM_PROFILE}' profile"
+        return RunProfile(name, PROFILES[name], []), None
+    if name != CUSTOM_PROFILE:
+        return None, f"Invalid profile '{name}'. Use one of: {', '.join(PROFILE_NAMES)}"
+    if not categories and not audits:
+        return None, f"The '{CUSTOM_PROFILE}' profile needs only_categories or only_audits"
+    unknown = [c for c in categories if c not in CATEGORIES]
+    if unknown:
+        return None, f"Unknown categories: {', '.join(unknown)}. Use any of: {', '.join(CATEGORIES)}"
+    invalid = [a for a in audits if not _AUDIT_ID.match(a)]
+    if invalid:
+        return None, f"Invalid audit ids: {', '.join(invalid)}"
+    # With audits only, every category is kept but lists just those audits
+    return RunProfile(
+        CUSTOM_PROFILE,
+        sorted(set(categories)) if categories else None,
+        sorted(set(audits))
+    ), None
+
+
+class ProfileTimings:
+    """Run times of the most recent `window` runs of each profile key."""
+
+    def __init__(self, window: int = 50):
+        self.window = window
+        self._runs: Dict[str, Deque[float]] = {}
+
+    def record(self, profile: str, run_seconds: float):
+        self._runs.setdefault(profile, deque(maxlen=self.window)).append(run_seconds)
+
+    def median(self, profile: str) -> Optional[float]:
+        runs = self._runs.get(profile)
+        return round(statistics.median(runs), 3) if runs else None
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        return {
+            profile: {"runs": len(runs), "median_run_seconds": self.median(profile)}
+            for profile, runs in self._runs.items()
+        }
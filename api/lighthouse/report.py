@@ -0,0 +1,250 @@
+"""
+Incremental handling of Lighthouse JSON reports.
+
+A report is several MB of JSON (screenshots, network records, rendered
+strings); loading it with json.load builds a Python object many times that
+size for every request, even when only a score is wanted. Reports are
+instead read as a stream of ijson events:
+
+* annotate() runs once per Lighthouse run. It adds `scorePercentage` to
+  every scored audit, re-encodes the report as compact gzip-compressed JSON
+  for the result cache, and collects the fields of the summary on the way.
+* project() reads chosen categories, audits and JSON paths from a cached
+  report, building only those subtrees.
+* full_response() streams a cached report back inside the response
+  envelope without parsing it, gzip-compressed when the client accepts
+  gzip (accepts_gzip()).
+
+JSON paths are dotted keys as ijson spells them, with `item` for the
+elements of an array (e.g. `audits.network-requests.details.items.item.url`,
+which matches once per element).
+"""
+
+import gzip
+import io
+import json
+import zlib
+from json.encoder import encode_basestring_ascii
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import ijson
+
+# Response modes of analyze_with_lighthouse, smallest first
+RESPONSE_MODES = ('summary', 'projection', 'full')
+
+SUMMARY_CATEGORIES = ['performance', 'accessibility', 'best-practices', 'seo', 'pwa']
+SUMMARY_METRICS = [
+    'first-contentful-paint',
+    'largest-contentful-paint',
+    'total-blocking-time',
+    'cumulative-layout-shift',
+    'speed-index',
+    'interactive'
+]
+SUMMARY_PATHS = (
+    ['finalUrl', 'fetchTime']
+    + [f'categories.{category}.score' for category in SUMMARY_CATEGORIES]
+    + [f'audits.{metric}.displayValue' for metric in SUMMARY_METRICS]
+    # Numeric metric values, for aggregating repeated runs (see multirun.py)
+    + [f'audits.{metric}.numericValue' for metric in SUMMARY_METRICS]
+)
+
+# Bytes read or written per step when streaming reports
+_CHUNK_SIZE = 64 * 1024
+
+_VALUE_EVENTS = ('null', 'boolean', 'integer', 'double', 'number', 'string', 'start_map', 'start_array')
+
+
+def extract(stream: BinaryIO, paths: Iterable[str]) -> Dict[str, List[Any]]:
+    """
+    Every value found at each of `paths` in one pass over a JSON stream,
+    as path -> list of matches (more than one for paths through arrays).
+    Only the matched subtrees are built.
+    """
+    wanted = set(paths)
+    found: Dict[str, List[Any]] = {}
+    # (path, builder) of the matched containers being built; paths may nest
+    building: List[Tuple[str, Any]] = []
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        for _, builder in building:
+            builder.event(event, value)
+        if building and prefix == building[-1][0] and event in ('end_map', 'end_array'):
+            path, builder = building.pop()
+            found.setdefault(path, []).append(builder.value)
+            continue
+        if prefix in wanted and event in _VALUE_EVENTS:
+            if event in ('start_map', 'start_array'):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                building.append((prefix, builder))
+            else:
+                found.setdefault(prefix, []).append(value)
+    return found
+
+
+def _first(found: Dict[str, List[Any]], path: str, default=None):
+    values = found.get(path)
+    return values[0] if values else default
+
+
+def _scalar(value) -> str:
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, str):
+        return encode_basestring_ascii(value)
+    return repr(value)
+
+
+def annotate(report: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    (gzip-compressed compact report with `scorePercentage` on every scored
+    audit, summary fields) of a raw Lighthouse report. CPU-bound: run it in
+    a thread.
+    """
+    out = io.BytesIO()
+    summary_paths = set(SUMMARY_PATHS)
+    fields: Dict[str, Any] = {}
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6) as compressed:
+        parts: List[str] = []
+        # Per open container: whether the next element is its first
+        first = [True]
+        after_key = False
+        scores: Dict[str, Any] = {}
+        for prefix, event, value in ijson.parse(io.BytesIO(report), use_float=True):
+            if event == 'map_key':
+                parts.append(('' if first[-1] else ',') + encode_basestring_ascii(value) + ':')
+                first[-1] = False
+                after_key = True
+                continue
+            if event in ('end_map', 'end_array'):
+                if event == 'end_map' and prefix.startswith('audits.') and prefix.count('.') == 1:
+                    score = scores.pop(prefix, None)
+                    if score is not None:
+                        # Convert score from 0-1 to 0-100 for better readability
+                        parts.append(f',"scorePercentage":{int(score * 100)}')
+                parts.append('}' if event == 'end_map' else ']')
+                first.pop()
+            else:
+                if not after_key:
+                    if not first[-1]:
+                        parts.append(',')
+                    first[-1] = False
+                if event == 'start_map':
+                    parts.append('{')
+                    first.append(True)
+                elif event == 'start_array':
+                    parts.append('[')
+                    first.append(True)
+                else:
+                    parts.append(_scalar(value))
+                    if prefix in summary_paths:
+                        fields[prefix] = value
+                    if prefix.startswith('audits.') and prefix.endswith('.score') and prefix.count('.') == 2:
+                        scores[prefix[:-len('.score')]] = value
+            after_key = False
+            if len(parts) >= 4096:
+                compressed.write(''.join(parts).encode())
+                parts.clear()
+        compressed.write(''.join(parts).encode())
+    return out.getvalue(), fields
+
+
+def summarize(fields: Dict[str, Any], url: str) -> Dict[str, Any]:
+    """The summary block of analyze_with_lighthouse from annotate()'s summary fields."""
+    def percentage(category):
+        score = fields.get(f'categories.{category}.score')
+        return int(score * 100) if score is not None else None
+
+    return {
+        "url": fields.get('finalUrl', url),
+        "fetchTime": fields.get('fetchTime'),
+        "scores": {category: percentage(category) for category in SUMMARY_CATEGORIES},
+        "metrics": {metric: fields.get(f'audits.{metric}.displayValue') for metric in SUMMARY_METRICS}
+    }
+
+
+def project(
+    stream: BinaryIO,
+    categories: Sequence[str] = (),
+    audits: Sequence[str] = (),
+    paths: Sequence[str] = ()
+) -> Dict[str, Any]:
+    """
+    The chosen categories and audits (whole objects, None when the report
+    has no such entry) and JSON paths of a report, read in one pass.
+    CPU-bound: run it in a thread.
+    """
+    found = extract(
+        stream,
+        [f'categories.{c}' for c in categories] + [f'audits.{a}' for a in audits] + list(paths)
+    )
+    projection: Dict[str, Any] = {}
+    if categories:
+        projection["categories"] = {c: _first(found, f'categories.{c}') for c in categories}
+    if audits:
+        projection["audits"] = {a: _first(found, f'audits.{a}') for a in audits}
+    if paths:
+        # Paths through arrays keep every match; other paths map to their single value
+        projection["paths"] = {
+            path: found.get(path, []) if 'item' in path.split('.') else _first(found, path)
+            for path in paths
+        }
+    return projection
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header value allows a gzip-encoded response."""
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        quality = params.strip().lower()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def full_response(
+    envelope: Dict[str, Any],
+    stream: BinaryIO,
+    compress: bool = True,
+    compresslevel: int = 6
+) -> Iterator[bytes]:
+    """
+    Chunks of `envelope` with the report read from `stream` added as its
+    "full_report" member, gzip-compressed if `compress` is set. A blocking
+    iterator: Starlette's StreamingResponse runs it in a worker thread.
+    """
+    head = json.dumps(envelope)
+    head = head[:-1] + (', ' if envelope else '') + '"full_report": '
+    try:
+        if not compress:
+            yield head.encode()
+            while True:
+                data = stream.read(_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+            yield b'}'
+            return
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        pending = compressor.compress(head.encode())
+        while True:
+            data = stream.read(_CHUNK_SIZE)
+            if not data:
+                break
+            pending += compressor.compress(data)
+            if len(pending) >= _CHUNK_SIZE:
+                yield pending
+                pending = b''
+        yield pending + compressor.compress(b'}') + compressor.flush()
+    finally:
+        stream.close()
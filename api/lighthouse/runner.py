@@ -0,0 +1,296 @@
+"""
+Non-blocking Lighthouse runs.
+
+A Lighthouse run takes 10-60 seconds and drives its own Chrome, so running
+the CLI with a blocking subprocess call from a tool coroutine stalls every
+other request on the uvicorn event loop. LighthouseRunner starts the CLI as
+an asyncio subprocess instead:
+
+* A semaphore bounds how many runs (one Node process and one Chrome each)
+  execute at the same time; later runs wait for a slot, and the time spent
+  waiting is reported separately from the run itself.
+* Every run has a hard timeout. Lighthouse starts in a process group of its
+  own, which is killed on timeout or when the caller is cancelled.
+  chrome-launcher detaches Chrome into yet another group, so each run tags
+  its Chrome with a unique marker switch and the tagged process tree is
+  killed as well.
+* The report and Chrome's profile are written to a per-run temporary
+  directory that is removed on every path, success or not.
+
+With a ChromePool (chrome_pool.py), runs attach to a warm Chrome through its
+remote debugging port instead of launching one; a run that times out has
+its Chrome recycled. A run holds its concurrency slot while it waits for a
+pooled Chrome, so the wait is bounded: when the pool cannot start, or has
+no Chrome to lease within LIGHTHOUSE_CHROME_ACQUIRE_TIMEOUT, the run
+launches its own Chrome as it does without a pool.
+
+Configuration (environment variables):
+    LIGHTHOUSE_MAX_CONCURRENCY          Lighthouse runs executing at once (default: half the available CPUs, at least 1)
+    LIGHTHOUSE_TIMEOUT_SECONDS          seconds before a run is killed (default: 120)
+    LIGHTHOUSE_CHROME_ACQUIRE_TIMEOUT   seconds a run waits for a pooled Chrome before launching its own (default: 10)
+"""
+
+import asyncio
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import urlsplit
+
+import ijson
+
+from api.ab_detector.analysis_pool import available_cpus
+from api.lighthouse.processes import kill_process_group, kill_tagged
+from api.lighthouse.report import extract
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENCY = int(os.environ.get("LIGHTHOUSE_MAX_CONCURRENCY", "0")) or max(1, available_cpus() // 2)
+TIMEOUT_SECONDS = float(os.environ.get("LIGHTHOUSE_TIMEOUT_SECONDS", "120"))
+CHROME_ACQUIRE_TIMEOUT = float(os.environ.get("LIGHTHOUSE_CHROME_ACQUIRE_TIMEOUT", "10"))
+
+CHROME_FLAGS = ["--headless", "--no-sandbox", "--disable-gpu", "--disable-dev-shm-usage"]
+
+# Seconds to wait for a killed Lighthouse process to be reaped
+_KILL_WAIT = 5
+
+
+class LighthouseError(Exception):
+    """A Lighthouse run that did not produce a report."""
+
+    def __init__(self, message: str, timing: Dict[str, float], stdout: str = "", stderr: str = ""):
+        super().__init__(message)
+        self.timing = timing
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class LighthouseTimeout(LighthouseError):
+    """A Lighthouse run killed after the timeout."""
+
+
+@dataclass
+class LighthouseRun:
+    # The report as written by Lighthouse (JSON bytes, not parsed)
+    report: bytes
+    queue_seconds: float
+    run_seconds: float
+    warm_chrome: bool = False
+
+    def timing(self) -> Dict[str, Any]:
+        return _timing(self.queue_seconds, self.run_seconds, self.warm_chrome)
+
+
+def _timing(queue_seconds: float, run_seconds: float, warm_chrome: bool) -> Dict[str, Any]:
+    return {
+        "queue_wait_seconds": round(queue_seconds, 3),
+        "run_seconds": round(run_seconds, 3),
+        # Whether the run attached to a pooled Chrome instead of launching one
+        "warm_chrome": warm_chrome
+    }
+
+
+_REQUEST_URLS = 'audits.network-requests.details.items.item.url'
+
+
+def visited_origins(url: str, report: Optional[bytes] = None) -> List[str]:
+    """Origins of `url` and of every request in a Lighthouse report's network-requests audit."""
+    urls = [url]
+    if report:
+        try:
+            urls.extend(extract(io.BytesIO(report), [_REQUEST_URLS]).get(_REQUEST_URLS, []))
+        except ijson.JSONError:
+            pass
+    origins = []
+    for request_url in urls:
+        parts = urlsplit(request_url)
+        if parts.scheme in ('http', 'https') and parts.netloc:
+            origins.append(f'{parts.scheme}://{parts.netloc}')
+    return list(dict.fromkeys(origins))
+
+
+def _cleanup(marker: str, workdir: str):
+    kill_tagged(marker)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _read_output(workdir: str, name: str) -> str:
+    with open(os.path.join(workdir, name), 'rb') as f:
+        return f.read().decode(errors='replace')
+
+
+def _read_report(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class LighthouseRunner:
+    """
+    Runs the Lighthouse CLI as asyncio subprocesses, at most `max_concurrency`
+    at a time, killing any run that takes longer than `timeout` seconds.
+    With a `chrome_pool`, each run leases a warm Chrome from it, waiting at
+    most `chrome_acquire_timeout` seconds before launching its own.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENCY,
+        timeout: float = TIMEOUT_SECONDS,
+        executable: str = 'lighthouse',
+        chrome_pool=None,
+        chrome_acquire_timeout: float = CHROME_ACQUIRE_TIMEOUT
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.executable = executable
+        self.chrome_pool = chrome_pool
+        self.chrome_acquire_timeout = chrome_acquire_timeout
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.waiting = 0
+        self.running = 0
+        # Runs that launched their own Chrome because the pool had none to lease
+        self.pool_fallbacks = 0
+
+    async def _acquire_chrome(self):
+        """A leased pooled Chrome, or None to launch one for the run."""
+        if self.chrome_pool is None:
+            return None
+        try:
+            return await self.chrome_pool.acquire(timeout=self.chrome_acquire_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "No pooled Chrome free after %g seconds, launching one for this run", self.chrome_acquire_timeout
+            )
+        except Exception as e:
+            logger.warning("Lighthouse Chrome pool unavailable, launching Chrome for this run: %s", e)
+        self.pool_fallbacks += 1
+        return None
+
+    def command(
+        self,
+        url: str,
+        output_path: str,
+        profile_dir: str,
+        marker: str,
+        flags: Sequence[str] = (),
+        port: Optional[int] = None
+    ) -> List[str]:
+        """The Lighthouse command line of one run; with `port`, it attaches to that Chrome."""
+        if port is not None:
+            chrome = [f'--port={port}']
+        else:
+            # Lighthouse splits --chrome-flags on spaces itself; the value must not be quoted
+            chrome_flags = CHROME_FLAGS + [f'--user-data-dir={profile_dir}', f'--opal-lighthouse-run={marker}']
+            chrome = [f'--chrome-flags={" ".join(chrome_flags)}']
+        return [
+            self.executable,
+            url,
+            '--output=json',
+            f'--output-path={output_path}',
+            *chrome,
+            '--quiet',
+            *self.options(flags)
+        ]
+
+    @staticmethod
+    def options(flags: Sequence[str] = ()) -> List[str]:
+        """The options of a run that affect its report (part of the result cache key)."""
+        return [
+            '--form-factor=desktop',
+            '--screenEmulation.disabled',
+            '--throttling-method=provided',
+            *flags
+        ]
+
+    async def run(self, url: str, flags: Sequence[str] = ()) -> LighthouseRun:
+        """
+        Run Lighthouse on `url` and return its JSON report. Raises
+        LighthouseTimeout when the run is killed and LighthouseError when it
+        exits without a report.
+        """
+        queued = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+            try:
+                chrome = await self._acquire_chrome()
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+        started = time.monotonic()
+        queue_seconds = started - queued
+        warm = chrome is not None
+        self.running += 1
+
+        marker = uuid.uuid4().hex
+        workdir = tempfile.mkdtemp(prefix='lighthouse-')
+        output_path = os.path.join(workdir, 'report.json')
+        process: Optional[asyncio.subprocess.Process] = None
+        report = None
+        completed = False
+        try:
+            # Output goes to files rather than pipes: a pipe inherited by a stray
+            # Chrome process would keep the run waiting for EOF after Lighthouse exits
+            with open(os.path.join(workdir, 'stdout'), 'wb') as stdout, \
+                    open(os.path.join(workdir, 'stderr'), 'wb') as stderr:
+                process = await asyncio.create_subprocess_exec(
+                    *self.command(
+                        url, output_path, os.path.join(workdir, 'profile'), marker, flags,
+                        chrome.port if warm else None
+                    ),
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=stdout,
+                    stderr=stderr,
+                    start_new_session=True
+                )
+            try:
+                await asyncio.wait_for(process.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                raise LighthouseTimeout(
+                    f"Lighthouse timed out after {self.timeout:g} seconds",
+                    _timing(queue_seconds, time.monotonic() - started, warm)
+                )
+            completed = True
+
+            if process.returncode != 0 or not os.path.exists(output_path):
+                raise LighthouseError(
+                    "Lighthouse analysis failed",
+                    _timing(queue_seconds, time.monotonic() - started, warm),
+                    _read_output(workdir, 'stdout'),
+                    _read_output(workdir, 'stderr')
+                )
+            report = await asyncio.to_thread(_read_report, output_path)
+            return LighthouseRun(report, queue_seconds, time.monotonic() - started, warm)
+        finally:
+            if process is not None and process.returncode is None:
+                kill_process_group(process.pid)
+                try:
+                    await asyncio.wait_for(process.wait(), _KILL_WAIT)
+                except asyncio.TimeoutError:
+                    pass
+            await asyncio.to_thread(_cleanup, marker, workdir)
+            if warm:
+                # A run that was killed may have left its tab mid-navigation: recycle that Chrome
+                origins = await asyncio.to_thread(visited_origins, url, report)
+                await self.chrome_pool.release(chrome, origins, retire=not completed)
+            self.running -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "max_concurrency": self.max_concurrency,
+            "timeout_seconds": self.timeout,
+            "running": self.running,
+            "waiting": self.waiting
+        }
+        if self.chrome_pool is not None:
+            stats["chrome_pool"] = self.chrome_pool.stats()
+            stats["chrome_pool_fallbacks"] = self.pool_fallbacks
+        return stats
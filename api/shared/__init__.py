@@ -0,0 +1,4 @@
+"""
+Support modules shared by the heavy tools in api/heavy.py
+(the lifecycle of warm browser process pools).
+"""
@@ -0,0 +1,214 @@
+"""
+Lifecycle of the warm browser pools.
+
+A warm pool keeps a fixed number of browser processes running between
+requests: the A/B detector's BrowserPool (api/ab_detector/browser_pool.py)
+and the Lighthouse ChromePool (api/lighthouse/chrome_pool.py). WarmPool
+holds what they have in common, and subclasses say how an instance is
+launched, closed, leased and checked:
+
+* start() starts Playwright and launches `size` instances; if any launch
+  fails, the others are closed again and the error is raised, so a later
+  start() begins from scratch;
+* acquire() waits, within an optional timeout that also covers a lazy
+  start(), for an instance that _lease() hands out;
+* an instance that is retired or dead is closed and relaunched once no
+  lease holds it (_replace_if_idle), and a background task runs
+  check_health() to find such instances and to relaunch slots lost to
+  failed relaunches;
+* stop() closes every instance and fails pending acquire() calls.
+"""
+
+import asyncio
+import logging
+from typing import Any, List, Optional
+
+from playwright.async_api import Playwright, async_playwright
+
+logger = logging.getLogger(__name__)
+
+
+class WarmPool:
+    """
+    Base class of pools of warm browser processes. Subclasses implement
+    _launch, _close, _lease, _in_use and _needs_replacing, and their own
+    release().
+    """
+
+    # Names used in log messages
+    pool_name = "Browser pool"
+    instance_name = "browser"
+
+    def __init__(self, size: int, health_check_interval: float):
+        self.size = max(1, size)
+        self.health_check_interval = health_check_interval
+
+        self._playwright: Optional[Playwright] = None
+        self._instances: List[Any] = []
+        self._condition = asyncio.Condition()
+        self._start_lock = asyncio.Lock()
+        self._health_task: Optional[asyncio.Task] = None
+        self._started = False
+        self._launches = 0
+        self._recycled = 0
+        self._relaunching = 0
+
+    # ------------------------------------------------------------------
+    # Subclass hooks
+    # ------------------------------------------------------------------
+
+    async def _launch(self) -> Any:
+        """Launch one instance; clean up after itself if it fails."""
+        raise NotImplementedError
+
+    async def _close(self, instance: Any):
+        """Close an instance and release its resources."""
+        raise NotImplementedError
+
+    def _lease(self) -> Optional[Any]:
+        """Lease and return an available instance, or None. Called with the condition held."""
+        raise NotImplementedError
+
+    def _in_use(self, instance: Any) -> bool:
+        """Whether a lease still holds the instance."""
+        raise NotImplementedError
+
+    async def _needs_replacing(self, instance: Any) -> bool:
+        """Health check of one instance: whether to replace it (retiring it as needed)."""
+        raise NotImplementedError
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+
+    async def start(self):
+        """Start Playwright and launch the warm instances (idempotent)."""
+        async with self._start_lock:
+            if self._started:
+                return
+            self._playwright = await async_playwright().start()
+            try:
+                launched = await asyncio.gather(
+                    *[self._launch() for _ in range(self.size)], return_exceptions=True
+                )
+                failures = [result for result in launched if isinstance(result, BaseException)]
+                if failures:
+                    for instance in launched:
+                        if not isinstance(instance, BaseException):
+                            await self._close(instance)
+                    raise failures[0]
+            except BaseException:
+                await self._playwright.stop()
+                self._playwright = None
+                raise
+            self._instances.extend(launched)
+            self._started = True
+            if self.health_check_interval > 0:
+                self._health_task = asyncio.create_task(self._health_loop())
+            logger.info("%s started with %d instances", self.pool_name, len(self._instances))
+
+    async def stop(self):
+        """Close every instance and stop Playwright."""
+        async with self._start_lock:
+            if not self._started:
+                return
+            self._started = False
+            if self._health_task:
+                self._health_task.cancel()
+                try:
+                    await self._health_task
+                except asyncio.CancelledError:
+                    pass
+                self._health_task = None
+
+            instances, self._instances = self._instances, []
+            for instance in instances:
+                await self._close(instance)
+            await self._playwright.stop()
+            self._playwright = None
+
+            # Wake up any waiters so they fail instead of hanging
+            async with self._condition:
+                self._condition.notify_all()
+
+    # ------------------------------------------------------------------
+    # Leasing
+    # ------------------------------------------------------------------
+
+    async def acquire(self, timeout: Optional[float] = None) -> Any:
+        """
+        Lease an instance, waiting until one is available. Starts the pool
+        lazily if the app lifespan did not. Raises asyncio.TimeoutError
+        after `timeout` seconds, and RuntimeError once the pool is stopped.
+        """
+        async def _wait_for_instance():
+            if not self._started:
+                await self.start()
+            async with self._condition:
+                while True:
+                    if not self._started:
+                        raise RuntimeError(f"{self.pool_name} is stopped")
+                    instance = self._lease()
+                    if instance is not None:
+                        return instance
+                    await self._condition.wait()
+
+        return await asyncio.wait_for(_wait_for_instance(), timeout)
+
+    # ------------------------------------------------------------------
+    # Health checks and recycling
+    # ------------------------------------------------------------------
+
+    async def _replace_if_idle(self, instance: Any):
+        """Swap a retired or dead instance for a fresh one once no lease holds it."""
+        async with self._condition:
+            if self._in_use(instance) or instance not in self._instances:
+                return
+            self._instances.remove(instance)
+
+        self._recycled += 1
+        await self._close(instance)
+
+        if not self._started:
+            return
+        self._relaunching += 1
+        try:
+            replacement = await self._launch()
+        except Exception as e:
+            logger.error("Failed to relaunch pooled %s: %s", self.instance_name, e)
+            return
+        finally:
+            self._relaunching -= 1
+
+        async with self._condition:
+            if self._started:
+                self._instances.append(replacement)
+                self._condition.notify_all()
+                return
+        await self._close(replacement)
+
+    async def check_health(self):
+        """Replace the instances _needs_replacing() flags and top the pool back up."""
+        for instance in list(self._instances):
+            if await self._needs_replacing(instance):
+                await self._replace_if_idle(instance)
+
+        # Replace slots lost to failed relaunches
+        missing = self.size - len(self._instances) - self._relaunching
+        for _ in range(max(0, missing)):
+            try:
+                replacement = await self._launch()
+            except Exception as e:
+                logger.error("Failed to launch pooled %s: %s", self.instance_name, e)
+                break
+            async with self._condition:
+                self._instances.append(replacement)
+                self._condition.notify_all()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                logger.error("%s health check failed: %s", self.pool_name, e)
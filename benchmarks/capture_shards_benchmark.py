@@ -0,0 +1,123 @@
+"""
+Throughput benchmark for AB_CAPTURE_SHARDS.
+
+Serves a synthetic page from a local HTTP server (no network access needed)
+and captures it repeatedly under one CaptureScheduler with:
+    * no shards: every browser driven from this process (AB_CAPTURE_SHARDS=0)
+    * CaptureShards with each of the requested shard counts
+
+and reports captures per second, the speedup over the unsharded run and the
+scaling efficiency (speedup / shards). Browsers per process and the
+scheduler's concurrency grow with the shard count, so each configuration
+drives shards * pool_size browsers. Scaling is only expected up to the
+number of cores; the CPU count is printed with the results.
+
+Requires Playwright's Chromium (`playwright install chromium`).
+
+Usage (from the repository root):
+    python -m benchmarks.capture_shards_benchmark                  # 0, 1, 2 and 4 shards
+    python -m benchmarks.capture_shards_benchmark --shards 1 2 4 8 --captures 128
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from api.ab_detector.analysis_pool import available_cpus
+from api.ab_detector.browser_pool import MAX_LEASES_PER_BROWSER, BrowserPool
+from api.ab_detector.capture import CaptureScheduler, CaptureSpec
+from api.ab_detector.capture_shards import CaptureShards
+
+
+def synthetic_page(blocks: int = 400) -> bytes:
+    """A long page of styled blocks, built by a script so layout and paint take real work."""
+    return f"""<!doctype html>
+<html><head><style>
+body {{ font-family: sans-serif; margin: 0; }}
+.block {{ display: inline-block; width: 180px; margin: 8px; padding: 12px; border-radius: 8px;
+          box-shadow: 0 2px 6px rgba(0, 0, 0, .3); background: linear-gradient(#fafafa, #ddd); }}
+</style></head><body><main id="main"></main><script>
+const main = document.getElementById('main');
+for (let i = 0; i < {blocks}; i++) {{
+    const block = document.createElement('div');
+    block.className = 'block';
+    block.style.color = `hsl(${{(i * 37) % 360}}, 60%, 35%)`;
+    block.innerHTML = `<h3>Block ${{i}}</h3><p>${{'Lorem ipsum dolor sit amet. '.repeat(3)}}</p>`;
+    main.appendChild(block);
+}}
+</script></body></html>""".encode()
+
+
+def serve(page: bytes) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def throughput(pool, spec: CaptureSpec, captures: int, concurrency: int):
+    """(captures per second, failed captures) of one scheduler run."""
+    await pool.start()
+    try:
+        scheduler = CaptureScheduler(pool, max_concurrency=concurrency)
+        # One untimed round so every browser has loaded the page once
+        await scheduler.run(spec, concurrency)
+        started = time.perf_counter()
+        results = await scheduler.run(spec, captures)
+        elapsed = time.perf_counter() - started
+    finally:
+        await pool.stop()
+    return captures / elapsed, sum(1 for result in results if not result.ok)
+
+
+async def run(args, url: str):
+    spec = CaptureSpec(url=url, readiness="load", readiness_timeout=10)
+    print(f"cpus={available_cpus()} captures={args.captures} browsers per process={args.pool_size} "
+          f"concurrency per process={args.pool_size * MAX_LEASES_PER_BROWSER}")
+    print(f"{'shards':>7}{'browsers':>10}{'captures/s':>12}{'speedup':>9}{'efficiency':>12}{'failed':>8}")
+
+    baseline = None
+    for shards in args.shards:
+        processes = max(1, shards)
+        concurrency = processes * args.pool_size * MAX_LEASES_PER_BROWSER
+        if shards == 0:
+            pool = BrowserPool(size=args.pool_size)
+        else:
+            pool = CaptureShards(num_shards=shards, browsers_per_shard=args.pool_size)
+        rate, failed = await throughput(pool, spec, args.captures, concurrency)
+        baseline = baseline or rate
+        speedup = rate / baseline
+        print(f"{shards:>7}{processes * args.pool_size:>10}{rate:>12.2f}{speedup:>8.2f}x"
+              f"{speedup / processes:>12.2f}{failed:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 1, 2, 4],
+                        help="Shard counts to measure; 0 captures in this process (the first count is the baseline)")
+    parser.add_argument("--captures", type=int, default=64, help="Timed captures per configuration")
+    parser.add_argument("--pool-size", type=int, default=2, help="Browsers per process")
+    parser.add_argument("--blocks", type=int, default=400, help="Blocks on the synthetic page")
+    args = parser.parse_args()
+
+    server = serve(synthetic_page(args.blocks))
+    try:
+        asyncio.run(run(args, f"http://127.0.0.1:{server.server_address[1]}/"))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Benchmark for the pivot_ab_test_data report layout.
+
+Compares, on synthetic long-format exports of growing size:
+    * the row-by-row layout (group.iterrows() and a dict per row, the original implementation)
+    * pivot.py's vectorized layout
+
+and reports the time of each, from sorted treatment rows to the JSON
+records the tool returns, and whether both produce the same records.
+
+Usage (from the repository root):
+    python -m benchmarks.pivot_benchmark                       # 1k to 1M input rows
+    python -m benchmarks.pivot_benchmark --rows 1000 50000 --repeat 3
+    python -m benchmarks.pivot_benchmark --max-rowwise 100000  # skip the slow layout above this size
+"""
+
+import argparse
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+from api.ab_pivot.pivot import pivot_records
+
+HEADER_COLS = [
+    'Name', 'Description', 'Created By', 'Audience(s)', 'Traffic Allocation',
+    'Start Date', 'Days Running', 'Visitors', 'Variation Name', 'Baseline Variation'
+]
+METRIC_COLS = [
+    'Metric Bucket', 'Metric Name', 'Metric Value', 'Metric Rate',
+    'Metric Var', 'Metric Stat Sig', 'Metric Confidence Interval'
+]
+
+
+def synthetic_export(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Long-format export: ~12 metrics per variation, 3 variations (1 baseline) per experiment and audience."""
+    rng = np.random.default_rng(seed)
+    metrics = 12
+    variations = 3
+    groups = max(1, rows // (metrics * variations))
+    experiment = rng.integers(0, max(1, groups // 2), rows)
+    audience = rng.integers(0, 2, rows)
+    variation = rng.integers(0, variations, rows)
+    metric = rng.integers(0, metrics, rows)
+    df = pd.DataFrame({
+        'Name': [f"Experiment {e}" for e in experiment],
+        'Description': [f"Test of layout {e % 7}" for e in experiment],
+        'Created By': np.where(experiment % 2 == 0, "alice@example.com", "bob@example.com"),
+        'Audience(s)': np.where(audience == 0, "Everyone", "Returning visitors"),
+        'Traffic Allocation': "50%",
+        'Start Date': "2024-05-01",
+        'Days Running': (experiment % 30).astype(np.int64),
+        'Visitors': rng.integers(100, 100000, rows),
+        'Variation Name': [f"Variation {v}" for v in variation],
+        'Baseline Variation': variation == 0,
+        'Metric Bucket': np.where(metric == 0, "Primary", "Secondary"),
+        'Metric Name': [f"Metric {m:02d}" for m in metric],
+        'Metric Value': rng.random(rows) * 1000,
+        'Metric Rate': rng.random(rows),
+        'Metric Var': rng.normal(0, 0.05, rows),
+        'Metric Stat Sig': rng.random(rows),
+        'Metric Confidence Interval': "[-0.01, 0.03]"
+    })
+    # A few missing values, as real exports have, and a column that is empty throughout
+    df.loc[rng.random(rows) < 0.01, 'Metric Rate'] = np.nan
+    df['Traffic Allocation'] = None
+    return df
+
+
+def treatment_rows(df: pd.DataFrame) -> pd.DataFrame:
+    """The filtering and sorting pivot_ab_test_data does before the layout."""
+    df_treatment = df[df['Baseline Variation'] == False].copy()
+    bucket_order = {'Primary': 0, 'Secondary': 1}
+    df_treatment['_sort'] = df_treatment['Metric Bucket'].map(bucket_order)
+    return df_treatment.sort_values(
+        by=['Name', 'Audience(s)', 'Variation Name', '_sort', 'Metric Name']
+    ).drop(columns=['_sort'])
+
+
+def rowwise_records(df_treatment: pd.DataFrame):
+    all_cols = HEADER_COLS + METRIC_COLS
+    output_rows = []
+    grouped = df_treatment.groupby(['Name', 'Audience(s)', 'Variation Name'], sort=False)
+    for (name, audience, variation), group in grouped:
+        for i, (_, row) in enumerate(group.iterrows()):
+            output_row = {}
+            if i == 0:
+                for col in HEADER_COLS:
+                    output_row[col] = row[col]
+            else:
+                for col in HEADER_COLS:
+                    output_row[col] = ''
+            for col in METRIC_COLS:
+                output_row[col] = row[col]
+            output_rows.append(output_row)
+        output_rows.append({col: '' for col in all_cols})
+    result_df = pd.DataFrame(output_rows)[all_cols]
+    records = result_df.to_dict(orient='records')
+    return records, df_treatment.groupby(['Name', 'Audience(s)', 'Variation Name']).ngroups
+
+
+def same_records(a, b) -> bool:
+    """Equal records, with NaN equal to NaN and types compared too."""
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if list(x) != list(y):
+            return False
+        for key in x:
+            u, v = x[key], y[key]
+            if type(u) is not type(v):
+                return False
+            if not (u == v or (isinstance(u, float) and math.isnan(u) and math.isnan(v))):
+                return False
+    return True
+
+
+def timed(fn, repeat: int):
+    best = math.inf
+    for _ in range(repeat):
+        started = time.perf_counter()
+        value = fn()
+        best = min(best, time.perf_counter() - started)
+    return value, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000],
+                        help="Input row counts to benchmark")
+    parser.add_argument("--repeat", type=int, default=1, help="Timing repetitions per size (best is reported)")
+    parser.add_argument("--max-rowwise", type=int, default=1_000_000,
+                        help="Largest input to run the row-by-row layout on")
+    args = parser.parse_args()
+
+    print(f"{'rows':>9}{'groups':>8}{'rowwise s':>11}{'vectorized s':>14}{'speedup':>9}{'identical':>11}")
+    for rows in args.rows:
+        df_treatment = treatment_rows(synthetic_export(rows))
+        (records, groups), t_vector = timed(
+            lambda: pivot_records(df_treatment, HEADER_COLS, METRIC_COLS), args.repeat
+        )
+        if rows > args.max_rowwise:
+            print(f"{rows:>9}{groups:>8}{'-':>11}{t_vector:>14.3f}{'-':>9}{'-':>11}")
+            continue
+        (reference, reference_groups), t_rowwise = timed(lambda: rowwise_records(df_treatment), args.repeat)
+        identical = reference_groups == groups and same_records(reference, records)
+        print(f"{rows:>9}{groups:>8}{t_rowwise:>11.3f}{t_vector:>14.3f}{t_rowwise / t_vector:>8.1f}x"
+              f"{'yes' if identical else 'NO':>11}")
+
+
+if __name__ == "__main__":
+    main()
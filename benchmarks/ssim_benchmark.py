@@ -0,0 +1,124 @@
+"""
+Benchmark for the detect_ab_test SSIM modes.
+
+Compares, per screenshot pair:
+    * skimage structural_similarity (the original implementation)
+    * compare.py exact mode (integer window sums, full resolution)
+    * fast_ssim.py fast mode (float32 pyramid with early exit)
+
+and reports timings, the deviation of each mode from skimage and whether the
+fast mode's similar/dissimilar decision agrees with the exact score.
+
+Usage (from the repository root):
+    python -m benchmarks.ssim_benchmark                  # synthetic 1920x1080 pages
+    python -m benchmarks.ssim_benchmark shot1.png shot2.png ...
+"""
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+from skimage.metrics import structural_similarity as ssim
+
+from api.ab_detector.compare import _frame_sums, _ssim_from_sums, _window_sums, _workspace
+from api.ab_detector.fast_ssim import FAST_SSIM_MARGIN, FAST_SSIM_TOLERANCE, multires_ssim, pyramid, ssim_f32
+
+
+def synthetic_page(seed: int, width: int = 1920, height: int = 1080, noise: int = 0) -> np.ndarray:
+    """Light background with random blocks, roughly the layout of a web page."""
+    rng = np.random.default_rng(seed)
+    page = np.full((height, width), 245, dtype=np.uint8)
+    for _ in range(80):
+        y, x = rng.integers(0, height - 120), rng.integers(0, width - 400)
+        page[y:y + rng.integers(8, 120), x:x + rng.integers(20, 400)] = rng.integers(0, 255)
+    if noise:
+        page = np.clip(page.astype(np.int16) + rng.integers(-noise, noise + 1, page.shape), 0, 255).astype(np.uint8)
+    return page
+
+
+def synthetic_pairs():
+    base = synthetic_page(1)
+    banner = base.copy()
+    banner[80:260, 200:1700] = 40          # swapped hero banner
+    button = base.copy()
+    button[600:640, 900:1060] = 20         # recoloured call to action
+    shifted = np.roll(base, 12, axis=0)    # layout shift
+    return [
+        ("identical", base, base.copy()),
+        ("button colour", base, button),
+        ("hero banner", base, banner),
+        ("layout shift", base, shifted),
+        ("different page", base, synthetic_page(2)),
+        ("noisy rerender", synthetic_page(3, noise=6), synthetic_page(3, noise=6)),
+    ]
+
+
+def file_pairs(paths):
+    frames = [np.asarray(Image.open(path).convert('L')) for path in paths]
+    return [
+        (f"{i}-{j}", frames[i], frames[j])
+        for i in range(len(frames)) for j in range(i + 1, len(frames))
+        if frames[i].shape == frames[j].shape
+    ]
+
+
+def exact_ssim(x: np.ndarray, y: np.ndarray) -> float:
+    ws = _workspace(x.shape + (3,))
+    _frame_sums(x, ws, ws.sum_x, ws.sum_xx)
+    _frame_sums(y, ws, ws.sum_y, ws.sum_yy)
+    np.multiply(x, y, out=ws.product, dtype=np.uint16)
+    _window_sums(ws.product, ws, ws.sum_xy)
+    return _ssim_from_sums(ws)
+
+
+def timed(fn, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        value = fn()
+    return value, (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="Screenshots to compare pairwise (default: synthetic pages)")
+    parser.add_argument("--threshold", type=float, default=0.95, help="SSIM decision threshold")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions per pair")
+    args = parser.parse_args()
+
+    pairs = file_pairs(args.images) if args.images else synthetic_pairs()
+    if not pairs:
+        parser.error("need at least two images of the same size")
+
+    print(f"threshold={args.threshold} margin={FAST_SSIM_MARGIN} documented level-0 tolerance={FAST_SSIM_TOLERANCE}")
+    print(f"{'pair':<16}{'skimage':>10}{'exact':>10}{'fast':>10}{'level':>7}{'skimage s':>11}{'exact s':>9}{'fast s':>9}{'agree':>7}")
+
+    totals = np.zeros(3)
+    worst_exact = worst_level0 = worst_coarse = 0.0
+    disagreements = 0
+    for name, x, y in pairs:
+        reference, t_skimage = timed(lambda: ssim(x, y), args.repeat)
+        exact, t_exact = timed(lambda: exact_ssim(x, y), args.repeat)
+        # The pyramid is built once per frame in production, so it is part of the per-pair cost only once
+        (fast, level), t_fast = timed(lambda: multires_ssim(pyramid(x), pyramid(y), args.threshold), args.repeat)
+
+        worst_exact = max(worst_exact, abs(exact - reference))
+        worst_level0 = max(worst_level0, abs(ssim_f32(x, y) - reference))
+        if level > 0:
+            worst_coarse = max(worst_coarse, abs(fast - reference))
+        agree = (fast < args.threshold) == (reference < args.threshold)
+        disagreements += not agree
+        totals += (t_skimage, t_exact, t_fast)
+        print(f"{name:<16}{reference:>10.5f}{exact:>10.5f}{fast:>10.5f}{level:>7}"
+              f"{t_skimage:>11.3f}{t_exact:>9.3f}{t_fast:>9.3f}{'yes' if agree else 'NO':>7}")
+
+    print()
+    print(f"total seconds: skimage {totals[0]:.3f}, exact {totals[1]:.3f}, fast {totals[2]:.3f}")
+    print(f"speedup vs skimage: exact {totals[0] / totals[1]:.1f}x, fast {totals[0] / totals[2]:.1f}x")
+    print(f"max |score - skimage|: exact {worst_exact:.2e}, fast level 0 {worst_level0:.2e}, "
+          f"fast coarse levels {worst_coarse:.3f}")
+    print(f"decision disagreements: {disagreements} of {len(pairs)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,247 @@ import numpy as np
 from skimage.metrics import structural_similarity as ssim
 import imagehash
 import base64
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from contextlib import asynccontextmanager
+import os
 import time
+import uuid
+
+# Number of warm browsers kept open, and how many contexts each serves before it is relaunched
+BROWSER_POOL_SIZE = int(os.environ.get("AB_BROWSER_POOL_SIZE", "2"))
+BROWSER_MAX_CONTEXTS = int(os.environ.get("AB_BROWSER_MAX_CONTEXTS", "200"))
+# Browser process tree memory (RSS) before it is relaunched, 0 disables the limit
+BROWSER_MAX_MEMORY_MB = int(os.environ.get("AB_BROWSER_MAX_MEMORY_MB", "1500"))
+# Seconds between background health checks of the idle browsers, 0 disables them
+BROWSER_HEALTH_INTERVAL = float(os.environ.get("AB_BROWSER_HEALTH_INTERVAL", "30"))
+# Seconds a request waits for a free browser before it fails
+BROWSER_ACQUIRE_TIMEOUT = float(os.environ.get("AB_BROWSER_ACQUIRE_TIMEOUT", "60"))
+
+# Switch added to every pooled browser so its process tree can be found in /proc
+BROWSER_MARKER_SWITCH = "--opal-browser-pool-id"
+
+def process_tree_rss_bytes(marker: str) -> Optional[int]:
+    """
+    Total resident memory of the browser process tagged with `marker` and all
+    of its descendants (renderers, GPU and utility processes).
+    Returns None where /proc is not available.
+    """
+    if not os.path.isdir('/proc'):
+        return None
+
+    parents: Dict[int, int] = {}
+    rss_pages: Dict[int, int] = {}
+    root_pid = None
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        pid = int(entry)
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                # The command name may contain spaces, fields resume after ')'
+                fields = f.read().rsplit(b')', 1)[1].split()
+            parents[pid] = int(fields[1])
+            rss_pages[pid] = int(fields[21])
+            if root_pid is None:
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    if marker.encode() in f.read():
+                        root_pid = pid
+        except (OSError, IndexError, ValueError):
+            continue
+
+    if root_pid is None:
+        return None
+
+    # Walk descendants of the browser process
+    children: Dict[int, List[int]] = {}
+    for pid, ppid in parents.items():
+        children.setdefault(ppid, []).append(pid)
+
+    total_pages = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        total_pages += rss_pages.get(pid, 0)
+        stack.extend(children.get(pid, []))
+
+    return total_pages * os.sysconf('SC_PAGE_SIZE')
+
+class BrowserPool:
+    """
+    Small pool of warm Chromium browsers leased to one request at a time.
+    Browsers are health-checked on acquire and release, and relaunched after
+    BROWSER_MAX_CONTEXTS contexts or once their process tree uses more than
+    BROWSER_MAX_MEMORY_MB, so long-running servers don't accumulate leaks.
+    A background task checks the idle browsers every BROWSER_HEALTH_INTERVAL
+    seconds the same way, as the heavy app's pool does (api/ab_detector/browser_pool.py).
+
+    The pool has `size` slots. A slot whose browser crashed, was recycled or
+    failed to launch is kept as an empty slot (None) and launched again by
+    the next acquire or health check, so a failed launch never shrinks the pool.
+    """
 
-app = FastAPI()
+    def __init__(
+        self,
+        size: int,
+        max_contexts: int,
+        acquire_timeout: float = BROWSER_ACQUIRE_TIMEOUT,
+        max_memory_mb: int = BROWSER_MAX_MEMORY_MB,
+        health_check_interval: float = BROWSER_HEALTH_INTERVAL
+    ):
+        self.size = size
+        self.max_contexts = max_contexts
+        self.acquire_timeout = acquire_timeout
+        self.max_memory_mb = max_memory_mb
+        self.health_check_interval = health_check_interval
+        self._playwright = None
+        # Idle slots: a browser, or None for a slot to launch on acquire
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._leased = set()
+        self._contexts_created: Dict[Any, int] = {}
+        self._markers: Dict[Any, str] = {}
+        self._health_task: Optional[asyncio.Task] = None
+        self._start_lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._start_lock:
+            if self._playwright is not None:
+                return
+            self._playwright = await async_playwright().start()
+            for _ in range(self.size):
+                try:
+                    await self._idle.put(await self._launch())
+                except Exception as e:
+                    print(f"Browser failed to launch, will retry on first use: {str(e)}")
+                    await self._idle.put(None)
+            if self.health_check_interval > 0:
+                self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._playwright is None:
+            return
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        browsers = list(self._leased)
+        self._leased.clear()
+        while not self._idle.empty():
+            browsers.append(self._idle.get_nowait())
+        for browser in browsers:
+            if browser is not None:
+                await self._close(browser)
+        await self._playwright.stop()
+        self._playwright = None
+
+    async def _launch(self):
+        marker = uuid.uuid4().hex
+        browser = await self._playwright.chromium.launch(
+            headless=True,
+            args=[f'{BROWSER_MARKER_SWITCH}={marker}']
+        )
+        self._contexts_created[browser] = 0
+        self._markers[browser] = marker
+        return browser
+
+    async def _close(self, browser):
+        self._contexts_created.pop(browser, None)
+        self._markers.pop(browser, None)
+        try:
+            await browser.close()
+        except Exception:
+            pass
+
+    def _over_memory_limit(self, browser) -> bool:
+        if self.max_memory_mb <= 0 or browser not in self._markers:
+            return False
+        rss = process_tree_rss_bytes(self._markers[browser])
+        return rss is not None and rss > self.max_memory_mb * 1024 * 1024
+
+    async def _needs_replacing(self, browser) -> bool:
+        # Crashed, served its contexts, or grown past the memory limit
+        if not browser.is_connected() or self._contexts_created.get(browser, 0) >= self.max_contexts:
+            return True
+        return await asyncio.to_thread(self._over_memory_limit, browser)
+
+    async def acquire(self):
+        await self.start()
+        try:
+            browser = await asyncio.wait_for(self._idle.get(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"No browser became available within {self.acquire_timeout:g} seconds")
+        if browser is None or not browser.is_connected():
+            # Empty slot, or crashed while idle - (re)launch it
+            if browser is not None:
+                self._contexts_created.pop(browser, None)
+                self._markers.pop(browser, None)
+            try:
+                browser = await self._launch()
+            except BaseException:
+                # Keep the slot so a later acquire can try again
+                await self._idle.put(None)
+                raise
+        self._leased.add(browser)
+        return browser
+
+    async def release(self, browser):
+        self._leased.discard(browser)
+        if self._playwright is None:
+            # Released after stop(), which already closed it
+            return
+        if await self._needs_replacing(browser):
+            # Relaunched by the next acquire or health check
+            await self._close(browser)
+            browser = None
+        await self._idle.put(browser)
+
+    async def check_health(self):
+        """Replace idle browsers that crashed or outgrew their limits, and refill empty slots."""
+        for _ in range(self._idle.qsize()):
+            try:
+                browser = self._idle.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            try:
+                if browser is not None and await self._needs_replacing(browser):
+                    await self._close(browser)
+                    browser = None
+                if browser is None and self._playwright is not None:
+                    try:
+                        browser = await self._launch()
+                    except Exception as e:
+                        print(f"Browser failed to relaunch, will retry: {str(e)}")
+            finally:
+                # Each slot goes back, launched or empty
+                await self._idle.put(browser)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                print(f"Browser health check failed: {str(e)}")
+
+    async def new_context(self, browser, **kwargs):
+        self._contexts_created[browser] = self._contexts_created.get(browser, 0) + 1
+        return await browser.new_context(**kwargs)
+
+browser_pool = BrowserPool(BROWSER_POOL_SIZE, BROWSER_MAX_CONTEXTS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Launch the warm browsers once, when the server starts
+    await browser_pool.start()
+    try:
+        yield
+    finally:
+        await browser_pool.stop()
+
+app = FastAPI(lifespan=lifespan)
 tools_service = ToolsService(app)
 
 class ABTestDetectorParameters(BaseModel):
@@ -33,13 +270,14 @@ async def detect_ab_test(parameters: ABTestDetectorParameters):
     screenshot_hashes = []
 
     try:
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-
+        # Lease a warm browser from the pool instead of launching one per request
+        browser = await browser_pool.acquire()
+        try:
             # Capture screenshots
             for i in range(parameters.num_captures):
                 # Create new context for each capture (fresh session)
-                context = await browser.new_context(
+                context = await browser_pool.new_context(
+                    browser,
                     viewport={'width': parameters.viewport_width, 'height': parameters.viewport_height},
                     user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
                 )
@@ -72,8 +310,8 @@ async def detect_ab_test(parameters: ABTestDetectorParameters):
                 # Delay between captures (except after last one)
                 if i < parameters.num_captures - 1:
                     await asyncio.sleep(parameters.delay_seconds)
-
-            await browser.close()
+        finally:
+            await browser_pool.release(browser)
 
         # Analyze screenshots for variations
         if len(screenshots) < 2:
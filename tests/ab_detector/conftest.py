@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from api.ab_detector.analysis import decode_and_hash
+from api.ab_detector.shared_frames import FrameStore
+from tests.ab_detector.screenshots import png
+
+
+class InlinePool:
+    """Stands in for AnalysisPool: runs worker tasks in the calling process."""
+
+    max_workers = 2
+
+    async def run(self, fn, *args):
+        return fn(*args)
+
+
+@pytest.fixture
+def inline_pool():
+    return InlinePool()
+
+
+@pytest.fixture
+def frame_store():
+    store = FrameStore()
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def decoded(frame_store):
+    """Decode screenshots into `frame_store` the way detect_ab_test does; returns their frame references."""
+    def decode(*images: np.ndarray):
+        frames = []
+        for pixels in images:
+            blob, frame = frame_store.put_png(png(pixels))
+            decode_and_hash(blob, frame)
+            frames.append(frame)
+        return frames
+    return decode
@@ -0,0 +1,26 @@
+"""Synthetic screenshots for the A/B test detector tests."""
+
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def png(pixels: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def page(variant: int = 0, width: int = 160, height: int = 120, noise: int = 0) -> np.ndarray:
+    """A synthetic screenshot: a banner whose colour depends on `variant`, some text and optional noise."""
+    img = Image.new("RGB", (width, height), (230, 230, 230))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([10, 10, width - 10, 40], fill=[(20, 20, 200), (200, 30, 30), (20, 160, 20)][variant % 3])
+    for line in range(3):
+        draw.text((10, 50 + 18 * line), f"Line {line}", fill=(0, 0, 0))
+    pixels = np.asarray(img).copy()
+    if noise:
+        rng = np.random.default_rng(noise)
+        pixels = np.clip(pixels.astype(int) + rng.integers(-noise, noise + 1, pixels.shape), 0, 255).astype(np.uint8)
+    return pixels
@@ -0,0 +1,90 @@
+import hashlib
+import io
+import os
+
+from PIL import Image
+
+from api.ab_detector.artifacts import ArtifactStore, artifact_url, is_artifact_id, iter_file, render
+from tests.ab_detector.screenshots import page, png
+
+
+def blob(tag: int, size: int = 1000) -> bytes:
+    return bytes([tag]) * size
+
+
+def test_put_is_content_addressed(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    first = store.put(blob(1))
+    assert first == hashlib.sha256(blob(1)).hexdigest()
+    assert is_artifact_id(first)
+    assert store.put(blob(1)) == first
+    assert store.stats() == (1, 1000)
+    assert store.read(first) == blob(1)
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    store = ArtifactStore(str(tmp_path), max_bytes=2500)
+    a, b = store.put(blob(1)), store.put(blob(2))
+    # Reading a marks it recently used, so b is evicted for c
+    assert store.read(a) == blob(1)
+    c = store.put(blob(3))
+
+    assert store.path(b) is None
+    assert not os.path.exists(tmp_path / f"{b}.png")
+    assert store.read(a) == blob(1) and store.read(c) == blob(3)
+    assert store.stats() == (2, 2000)
+
+
+def test_the_newest_file_is_kept_when_it_alone_exceeds_the_cap(tmp_path):
+    store = ArtifactStore(str(tmp_path), max_bytes=500)
+    store.put(blob(1))
+    large = store.put(blob(2))
+    assert store.stats() == (1, 1000)
+    assert store.read(large) == blob(2)
+
+
+def test_open_file_stays_readable_after_eviction(tmp_path):
+    store = ArtifactStore(str(tmp_path), max_bytes=1500)
+    first = store.put(blob(1))
+    f = store.open(first)
+    store.put(blob(2))
+
+    assert store.path(first) is None
+    assert b"".join(iter_file(f, chunk_size=300)) == blob(1)
+    assert f.closed
+
+
+def test_files_removed_behind_the_store_are_dropped_from_the_index(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    artifact_id = store.put(blob(1))
+    os.unlink(tmp_path / f"{artifact_id}.png")
+    assert store.open(artifact_id) is None
+    assert store.stats() == (0, 0)
+
+
+def test_index_is_rebuilt_from_disk(tmp_path):
+    artifact_id = ArtifactStore(str(tmp_path)).put(blob(1))
+    (tmp_path / "partial.png.1.tmp").write_bytes(b"x")
+
+    reopened = ArtifactStore(str(tmp_path))
+    assert reopened.stats() == (1, 1000)
+    assert reopened.read(artifact_id) == blob(1)
+    assert not (tmp_path / "partial.png.1.tmp").exists()
+
+
+def test_renditions_are_stored_next_to_the_original(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    artifact_id = store.put(png(page(0)))
+    thumbnail = render(store.read(artifact_id), "thumbnail", "webp")
+    store.put_rendition(artifact_id, "thumbnail", "webp", thumbnail)
+
+    assert Image.open(io.BytesIO(thumbnail)).size == (800, 600)
+    assert store.path(artifact_id, "thumbnail", "webp").endswith(f"{artifact_id}.thumbnail.webp")
+    assert store.stats()[0] == 2
+
+
+def test_artifact_url_omits_default_query_parameters():
+    artifact_id = "0" * 64
+    assert artifact_url(artifact_id) == f"/artifacts/{artifact_id}"
+    assert artifact_url(artifact_id, "thumbnail", "webp") == f"/artifacts/{artifact_id}?variant=thumbnail&format=webp"
+    assert not is_artifact_id("../etc/passwd")
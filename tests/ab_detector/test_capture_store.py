@@ -0,0 +1,95 @@
+import os
+import time
+
+import numpy as np
+
+from api.ab_detector.capture_store import CaptureStore, is_job_id, new_job_id
+from api.ab_detector.shared_frames import open_frame
+
+FRAME_KEY = "0" * 32
+
+
+def frames(value: int = 7):
+    """One 10 x 10 frame: 300 RGB bytes plus 100 grayscale bytes."""
+    return {FRAME_KEY: (np.full((10, 10, 3), value, dtype=np.uint8), np.full((10, 10), value, dtype=np.uint8))}
+
+
+def save(store, retention_hours=None, last_used=None):
+    job_id = new_job_id()
+    store.save(job_id, {"url": "https://example.com"}, frames(), retention_hours)
+    if last_used is not None:
+        # Last use is the metadata file's modification time
+        path = os.path.join(store.root, job_id, "job.json")
+        os.utime(path, (last_used, last_used))
+    return job_id
+
+
+def test_saved_jobs_load_with_their_frames(tmp_path):
+    store = CaptureStore(str(tmp_path))
+    job_id = new_job_id()
+    metadata = store.save(job_id, {"url": "https://example.com"}, frames(9))
+
+    assert is_job_id(job_id)
+    assert metadata["size_bytes"] == 400
+    assert store.load(job_id)["url"] == "https://example.com"
+    with open_frame(store.frame_ref(job_id, FRAME_KEY, (10, 10, 3))) as (rgb, gray):
+        assert (rgb == 9).all() and (gray == 9).all()
+    assert store.load(new_job_id()) is None
+    assert store.load("../etc") is None
+
+
+def test_expired_jobs_are_swept(tmp_path):
+    store = CaptureStore(str(tmp_path))
+    expired = save(store, retention_hours=-1)
+    kept = save(store)
+
+    assert store.load(expired) is None
+    assert not os.path.exists(tmp_path / expired)
+    assert store.load(kept) is not None
+
+
+def test_least_recently_used_jobs_are_evicted_over_the_cap(tmp_path):
+    store = CaptureStore(str(tmp_path), max_bytes=1000)
+    now = time.time()
+    oldest = save(store, last_used=now - 300)
+    recent = save(store, last_used=now - 100)
+    older = save(store, last_used=now - 200)
+    newest = save(store)
+
+    assert store.stats() == (2, 800)
+    assert store.load(oldest) is None and store.load(older) is None
+    assert store.load(recent) is not None and store.load(newest) is not None
+
+
+def test_pinned_jobs_survive_sweeps(tmp_path):
+    store = CaptureStore(str(tmp_path), max_bytes=500)
+    pinned = save(store, last_used=time.time() - 300)
+    with store.pin(pinned):
+        with store.pin(pinned):
+            save(store)
+        # Still pinned by the outer block
+        save(store)
+        assert store.load(pinned) is not None
+    save(store)
+    assert not os.path.exists(tmp_path / pinned)
+
+
+def test_stale_partial_saves_are_removed(tmp_path):
+    store = CaptureStore(str(tmp_path))
+    stale, fresh = tmp_path / f"{new_job_id()}.tmp", tmp_path / f"{new_job_id()}.tmp"
+    stale.mkdir()
+    fresh.mkdir()
+    old = time.time() - 2 * 3600
+    os.utime(stale, (old, old))
+
+    store.sweep()
+    assert not stale.exists()
+    assert fresh.exists()
+
+
+def test_update_merges_metadata(tmp_path):
+    store = CaptureStore(str(tmp_path))
+    job_id = save(store)
+    store.update(job_id, {"frames": {"a": 1}})
+    metadata = store.load(job_id)
+    assert metadata["frames"] == {"a": 1} and metadata["url"] == "https://example.com"
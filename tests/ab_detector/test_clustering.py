@@ -0,0 +1,70 @@
+import random
+
+import pytest
+
+from api.ab_detector.clustering import BKTree, cluster_hashes, max_internal_distance, signature_distance
+
+
+def brute_force_clusters(signatures, radius):
+    """Connected components of the 'within radius' graph, by pairwise comparison."""
+    labels = list(range(len(signatures)))
+    for i in range(len(signatures)):
+        for j in range(i):
+            if signature_distance(signatures[i], signatures[j]) <= radius:
+                old, new = max(labels[i], labels[j]), min(labels[i], labels[j])
+                labels = [new if label == old else label for label in labels]
+    clusters = {}
+    for index, label in enumerate(labels):
+        clusters.setdefault(label, []).append(index)
+    return list(clusters.values())
+
+
+def test_radius_zero_groups_identical_signatures_in_order_of_appearance():
+    signatures = [(0b1010,), (0b1011,), (0b1010,), (0xff,), (0b1011,)]
+    assert cluster_hashes(signatures, 0) == [[0, 2], [1, 4], [3]]
+
+
+def test_radius_links_near_signatures():
+    signatures = [(0b0000,), (0b0001,), (0b1111,)]
+    assert cluster_hashes(signatures, 1) == [[0, 1], [2]]
+
+
+def test_single_linkage_chains_beyond_the_radius():
+    # 0 and 2 are 2 bits apart but both within 1 bit of 1
+    signatures = [(0b00,), (0b01,), (0b11,)]
+    assert cluster_hashes(signatures, 1) == [[0, 1, 2]]
+    assert max_internal_distance(signatures, [0, 1, 2]) == 2
+
+
+def test_distance_is_the_largest_over_hash_types():
+    assert signature_distance((0b0, 0b111), (0b1, 0b000)) == 3
+    # Close in one hash type, far in the other: not linked
+    assert cluster_hashes([(0b0, 0b111), (0b1, 0b000)], 1) == [[0], [1]]
+
+
+@pytest.mark.parametrize("radius", [1, 3, 6])
+def test_matches_brute_force_components(radius):
+    rng = random.Random(radius)
+    centres = [rng.getrandbits(16) for _ in range(4)]
+    signatures = [
+        (centre ^ (1 << rng.randrange(16)) ^ (1 << rng.randrange(16)), rng.getrandbits(4))
+        for centre in rng.choices(centres, k=60)
+    ]
+    assert cluster_hashes(signatures, radius) == brute_force_clusters(signatures, radius)
+
+
+def test_bk_tree_search_matches_linear_scan():
+    rng = random.Random(0)
+    signatures = list({(rng.getrandbits(12),) for _ in range(200)})
+    tree = BKTree()
+    for signature in signatures:
+        tree.add(signature)
+    for query in signatures[:20]:
+        expected = {s for s in signatures if signature_distance(query, s) <= 3}
+        assert set(tree.search(query, 3)) == expected
+
+
+def test_empty_and_singleton():
+    assert cluster_hashes([], 2) == []
+    assert cluster_hashes([(5,)], 2) == [[0]]
+    assert max_internal_distance([(5,)], [0]) == 0
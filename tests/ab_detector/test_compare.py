@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from skimage.metrics import structural_similarity
+
+from api.ab_detector.compare import (
+    DIFF_INTENSITY_THRESHOLD, cluster_statistics, compare_block, expand_matrices, plan_blocks, upper_triangle
+)
+from tests.ab_detector.screenshots import page
+
+
+def test_exact_ssim_matches_skimage(frame_store, decoded):
+    frames = decoded(page(0), page(1), page(0, noise=20))
+    results = compare_block(frames, [(0, 1), (0, 2), (1, 2)])
+    for i, j, _, score, level in results:
+        expected = structural_similarity(frame_store.gray_view(frames[i]), frame_store.gray_view(frames[j]))
+        assert score == pytest.approx(expected, abs=1e-9)
+        assert level == 0
+
+
+def test_difference_counts_changed_channel_values(frame_store, decoded):
+    base = page(0)
+    changed = base.copy()
+    changed[:10, :, 0] = np.where(changed[:10, :, 0] > 127, 0, 255)
+    # Changes at or below the threshold do not count
+    nudged = np.clip(base.astype(int) + DIFF_INTENSITY_THRESHOLD, 0, 255).astype(np.uint8)
+    frames = decoded(base, changed, nudged)
+
+    (_, _, difference, _, _), (_, _, nudged_difference, _, _) = compare_block(frames, [(0, 1), (0, 2)])
+    assert difference == pytest.approx(10 * base.shape[1] / base.size)
+    assert nudged_difference == 0
+
+
+def test_frames_of_different_sizes_have_no_ssim(decoded):
+    frames = decoded(page(0), page(0, width=200))
+    [(_, _, difference, score, level)] = compare_block(frames, [(0, 1)])
+    assert score is None and level is None
+    assert 0 <= difference <= 1
+
+
+@pytest.mark.parametrize("num_frames, num_blocks", [(2, 4), (5, 1), (6, 4), (9, 16)])
+def test_plan_blocks_covers_every_pair_once(num_frames, num_blocks):
+    blocks = plan_blocks(num_frames, num_blocks)
+    pairs = [pair for block in blocks for pair in block]
+    assert sorted(pairs) == [(i, j) for i in range(num_frames) for j in range(i + 1, num_frames)]
+    assert len(blocks) <= num_blocks
+
+
+def test_plan_blocks_without_pairs():
+    assert plan_blocks(1, 4) == []
+
+
+def test_expand_matrices_copies_rows_of_identical_frames():
+    # Frames 0 and 2 are bit-identical and share unique frame 0
+    blocks = [[(0, 1, 0.25, 0.8, 0)]]
+    diff, ssim = expand_matrices([0, 1, 0], 2, blocks)
+    assert diff.tolist() == [[0, 0.25, 0], [0.25, 0, 0.25], [0, 0.25, 0]]
+    assert ssim.tolist() == [[1, 0.8, 1], [0.8, 1, 0.8], [1, 0.8, 1]]
+    assert upper_triangle(diff).tolist() == [0.25, 0, 0.25]
+
+
+def test_cluster_statistics_within_and_between():
+    diff = np.array([[0, 0.1, 0.5], [0.1, 0, 0.4], [0.5, 0.4, 0]])
+    ssim = np.array([[1, 0.9, 0.3], [0.9, 1, np.nan], [0.3, np.nan, 1]])
+    stats = cluster_statistics(diff, ssim, [[0, 1], [2]])
+
+    assert stats["within"][0]["difference_percentage"]["max"] == pytest.approx(10)
+    assert stats["within"][1]["ssim"] == {"mean": None, "min": None, "max": None}
+    [between] = stats["between"]
+    assert between["clusters"] == [0, 1]
+    assert between["difference_percentage"]["min"] == pytest.approx(40)
+    # NaN SSIM is left out of the summary
+    assert between["ssim"] == {"mean": 0.3, "min": 0.3, "max": 0.3}
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from skimage.metrics import structural_similarity
+
+from api.ab_detector.compare import coarse_matrix, compare_block, decision_levels, expand_matrices
+from api.ab_detector.fast_ssim import FAST_SSIM_TOLERANCE, SSIM_WIN, multires_ssim, pyramid, ssim_f32
+from tests.ab_detector.screenshots import page
+
+
+def gray(pixels: np.ndarray) -> np.ndarray:
+    return (pixels @ np.array([0.299, 0.587, 0.114])).astype(np.uint8)
+
+
+@pytest.mark.parametrize("other", [page(1), page(0, noise=30), page(2, noise=5)])
+def test_float32_ssim_matches_skimage(other):
+    x, y = gray(page(0)), gray(other)
+    assert abs(ssim_f32(x, y) - structural_similarity(x, y)) <= FAST_SSIM_TOLERANCE
+
+
+def test_pyramid_halves_each_level_until_the_window_no_longer_fits():
+    levels = pyramid(gray(page(0, width=161, height=121)), levels=5)
+    assert [level.shape for level in levels] == [(121, 161), (60, 80), (30, 40), (15, 20)]
+    assert all(min(level.shape) >= 2 * SSIM_WIN for level in levels)
+
+
+def test_pyramid_levels_are_box_averages():
+    frame = np.arange(64 * 64, dtype=np.uint8).reshape(64, 64)
+    _, level = pyramid(frame, levels=1)
+    assert level.dtype == np.float32
+    assert level[0, 0] == pytest.approx(frame[:2, :2].mean())
+
+
+def test_clear_pairs_are_decided_at_a_coarse_level():
+    x = pyramid(gray(page(0)))
+    score, level = multires_ssim(x, x, threshold=0.5)
+    assert level == len(x) - 1
+    assert score == pytest.approx(1.0)
+
+
+def test_pairs_near_the_threshold_are_refined_to_full_resolution():
+    x, y = gray(page(0)), gray(page(0, noise=2))
+    exact = structural_similarity(x, y)
+    score, level = multires_ssim(pyramid(x), pyramid(y), threshold=exact)
+    assert level == 0
+    assert score == pytest.approx(exact, abs=FAST_SSIM_TOLERANCE)
+
+
+def test_coarse_scores_are_reported_apart_from_ssim(frame_store, decoded):
+    frames = decoded(page(0), page(0, noise=2), 255 - page(0))
+    exact_score = structural_similarity(frame_store.gray_view(frames[0]), frame_store.gray_view(frames[1]))
+    # The threshold sits on the near-identical pair, so only the clearly different pairs are decided early
+    block = compare_block(frames, [(0, 1), (0, 2), (1, 2)], "fast", exact_score)
+    levels = {(i, j): level for i, j, _, _, level in block}
+    assert levels[(0, 1)] == 0
+    assert levels[(0, 2)] > 0 and levels[(1, 2)] > 0
+
+    _, ssim = expand_matrices([0, 1, 2], 3, [block])
+    coarse = coarse_matrix([0, 1, 2], 3, [block])
+    assert ssim[0, 1] == pytest.approx(exact_score, abs=FAST_SSIM_TOLERANCE)
+    assert np.isnan(ssim[0, 2]) and np.isnan(ssim[1, 2])
+    assert np.isnan(coarse[0, 1]) and not np.isnan(coarse[0, 2])
+    assert decision_levels([block]) == {"0": 1, str(levels[(0, 2)]): 2}
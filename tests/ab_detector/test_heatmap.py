@@ -0,0 +1,65 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from api.ab_detector.heatmap import StreamingVariance, compact_heatmap, hot_spots
+from tests.ab_detector.screenshots import page
+
+
+def expected_cells(images, grid_size):
+    variance = np.var(np.stack(images).astype(np.float64), axis=0).mean(axis=2)
+    height, width = variance.shape
+    cell_height, cell_width = height // grid_size, width // grid_size
+    return np.array([
+        [variance[y:y + cell_height, x:x + cell_width].mean() for x in range(0, width, cell_width)]
+        for y in range(0, height, cell_height)
+    ])
+
+
+def stream(pool, frame_store, frames, grid_size):
+    async def run():
+        variance = StreamingVariance(pool, frame_store)
+        for frame in frames:
+            await variance.add(frame)
+        return variance.count, await variance.grid(grid_size)
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("grid_size", [4, 7])
+def test_welford_cells_match_batch_variance(inline_pool, frame_store, decoded, grid_size):
+    images = [page(0), page(1, noise=10), page(2), page(0, noise=40)]
+    count, (cells, cell_height, cell_width) = stream(inline_pool, frame_store, decoded(*images), grid_size)
+
+    assert count == len(images)
+    assert (cell_height, cell_width) == (120 // grid_size, 160 // grid_size)
+    np.testing.assert_allclose(cells, expected_cells(images, grid_size), rtol=1e-4, atol=1e-3)
+
+
+def test_frames_of_another_size_are_skipped(inline_pool, frame_store, decoded):
+    images = [page(0), page(1)]
+    count, (cells, _, _) = stream(inline_pool, frame_store, decoded(*images, page(2, width=200)), 4)
+    assert count == 2
+    np.testing.assert_allclose(cells, expected_cells(images, 4), rtol=1e-4, atol=1e-3)
+
+
+def test_no_frames_no_grid(inline_pool, frame_store):
+    assert stream(inline_pool, frame_store, [], 4) == (0, None)
+
+
+def test_hot_spots_are_sorted_by_variance():
+    cells = np.array([[1.0, 5.0], [3.0, 5.0]])
+    assert hot_spots(cells, 10, 20, 3) == [
+        {"x": 20, "y": 0, "variance": 5.0},
+        {"x": 20, "y": 10, "variance": 5.0},
+        {"x": 0, "y": 10, "variance": 3.0}
+    ]
+
+
+def test_compact_heatmap_keeps_all_cells_or_the_top_k():
+    cells = np.array([[1.0, 5.0], [3.0, 0.25]])
+    full = compact_heatmap(cells, 10, 20)
+    assert full == {"rows": 2, "cols": 2, "cell_width": 20, "cell_height": 10, "cells": [[1.0, 5.0], [3.0, 0.25]]}
+    top = compact_heatmap(cells, 10, 20, top_k=2)
+    assert "cells" not in top
+    assert top["top_cells"] == [[20, 0, 5.0], [0, 10, 3.0]]
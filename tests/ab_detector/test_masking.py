@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from api.ab_detector.analysis import decode_and_hash
+from api.ab_detector.masking import MASK_VALUE, clip, crop_box, mask_array, normalize, parse_regions
+from tests.ab_detector.screenshots import page, png
+
+
+@pytest.mark.parametrize("regions, expected", [
+    ([], (0, 0, 200, 100)),
+    # Full-width header and footer
+    ([(0, 0, 200, 20), (0, 90, 200, 10)], (0, 20, 200, 70)),
+    # Full-height side bar, given larger than the screenshot
+    ([(-5, -5, 40, 200)], (35, 0, 165, 100)),
+    # Not touching an edge: masked, not cropped
+    ([(0, 30, 200, 10)], (0, 0, 200, 100)),
+    # Does not span the full width
+    ([(0, 0, 150, 20)], (0, 0, 200, 100)),
+    # Each crop makes the next region span the remaining width
+    ([(0, 0, 120, 20), (120, 0, 80, 100)], (0, 20, 120, 80)),
+    # Everything ignored
+    ([(0, 0, 200, 100)], (0, 0, 1, 1)),
+])
+def test_crop_box(regions, expected):
+    assert crop_box(200, 100, regions) == expected
+
+
+def test_mask_array_is_relative_to_the_crop_origin():
+    mask = mask_array((10, 20), [(25, 12, 5, 3), (0, 0, 100, 2)], origin=(20, 10))
+    expected = np.zeros((10, 20), dtype=bool)
+    expected[2:5, 5:10] = True
+    assert np.array_equal(mask, expected)
+
+
+def test_mask_array_ignores_rectangles_outside_the_frame():
+    assert not mask_array((10, 10), [(20, 20, 5, 5), (-10, 0, 5, 5)]).any()
+
+
+def test_decoded_frames_are_cropped_and_masked(frame_store):
+    pixels = page(0)
+    crop = crop_box(160, 120, [(0, 0, 160, 10)])
+    masks = [(0, 0, 160, 10), (20, 30, 10, 10)]
+    blob, frame = frame_store.put_png(png(pixels), crop)
+    decode_and_hash(blob, frame, masks=masks, crop=crop)
+
+    rgb = frame_store.view(frame)
+    assert rgb.shape == (110, 160, 3)
+    assert (rgb[20:30, 20:30] == MASK_VALUE).all()
+    assert np.array_equal(rgb[:20], pixels[10:30])
+    assert (frame_store.gray_view(frame)[20:30, 20:30] == MASK_VALUE).all()
+
+
+def test_normalize_rounds_outwards():
+    assert normalize((1.5, 2.2, 3.0, 4.1)) == (1, 2, 4, 5)
+
+
+def test_clip():
+    assert clip((-5, -5, 10, 10), 100, 100) == (0, 0, 5, 5)
+    assert clip((100, 0, 10, 10), 100, 100) is None
+
+
+def test_parse_regions_rejects_empty_regions():
+    assert parse_regions([[0, 0, 10.5, 10]]) == [(0, 0, 11, 10)]
+    with pytest.raises(ValueError):
+        parse_regions([[0, 0, 0, 10]])
+    with pytest.raises(ValueError):
+        parse_regions([[0, 0, 10]])
@@ -0,0 +1,110 @@
+import pytest
+
+from api.ab_detector.monitor import (
+    EVENT_TEST_ENDED, EVENT_TEST_STARTED, EVENT_VARIANTS_CHANGED, MonitorStore, Watch, active_set, centroid,
+    format_signature, parse_signature, transition
+)
+
+URL = "https://example.com"
+A, B, C = (0x0,), (0xffff,), (0xffff0000,)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MonitorStore(str(tmp_path / "monitor.sqlite3"), max_events=2)
+    yield store
+    store.close()
+
+
+def test_active_set_needs_two_captures_per_variant():
+    assert active_set([1, 2, 1, 3]) == [1]
+    assert active_set([2, 1, 2, 1]) == [1, 2]
+    assert active_set([]) == []
+
+
+@pytest.mark.parametrize("previous, current, expected", [
+    (None, [1], None),
+    (None, [1, 2], EVENT_TEST_STARTED),
+    ([1], [1, 2], EVENT_TEST_STARTED),
+    ([1, 2], [1, 2], None),
+    ([1, 2], [1, 3], EVENT_VARIANTS_CHANGED),
+    ([1, 2], [2], EVENT_TEST_ENDED),
+    ([1, 2], [], EVENT_TEST_ENDED),
+    ([1], [2], None),
+])
+def test_transition(previous, current, expected):
+    assert transition(previous, current) == expected
+
+
+def test_centroid_is_the_bitwise_majority():
+    bit_counts = [[3, 1, 2] + [0] * 61]
+    assert centroid(bit_counts, 3) == (0b101,)
+
+
+def test_signatures_round_trip():
+    assert parse_signature(format_signature((1, 0xabc))) == (1, 0xabc)
+
+
+def test_runs_record_test_start_change_and_end(store):
+    watch = Watch(url=URL, window_captures=4, hash_radius=1)
+    store.upsert_watch(watch)
+
+    assert store.record_run(watch, [A, A], now=1) == []
+    [started] = store.record_run(watch, [B, B], now=2)
+    assert (started["kind"], started["variants"]) == (EVENT_TEST_STARTED, [1, 2])
+    [changed] = store.record_run(watch, [C, C, B, B], now=3)
+    assert (changed["kind"], changed["variants"], changed["previous_variants"]) == (EVENT_VARIANTS_CHANGED, [2, 3], [1, 2])
+    [ended] = store.record_run(watch, [C, C, C, C], now=4)
+    assert (ended["kind"], ended["variants"]) == (EVENT_TEST_ENDED, [3])
+
+    status = store.watch_status(URL)
+    assert status["active_variants"] == [3] and not status["test_running"]
+    # Only the window's captures and the last max_events events are kept; centroids keep their counts
+    assert status["captures_stored"] == 4
+    assert [event["kind"] for event in status["events"]] == [EVENT_TEST_ENDED, EVENT_VARIANTS_CHANGED]
+    assert [variant["captures"] for variant in status["variants"]] == [2, 4, 6]
+
+
+def test_captures_within_the_radius_join_the_nearest_variant(store):
+    watch = Watch(url=URL, hash_radius=1)
+    store.upsert_watch(watch)
+    store.record_run(watch, [(0b0000,), (0b0001,), (0b0011,)], now=1)
+    assert [variant["captures"] for variant in store.watch_status(URL)["variants"]] == [2, 1]
+
+
+def test_changing_hash_settings_discards_variants(store):
+    watch = Watch(url=URL)
+    store.upsert_watch(watch)
+    store.record_run(watch, [A, B], now=1)
+    store.upsert_watch(Watch(url=URL, hash_types=["dhash"]))
+    status = store.watch_status(URL)
+    assert status["variants"] == [] and status["captures_stored"] == 0
+
+
+def test_scheduling(store):
+    watch = Watch(url=URL, interval_seconds=60)
+    store.upsert_watch(watch)
+    assert [due.url for due in store.due_watches(now=float("inf"))] == [URL]
+
+    store.record_run(watch, [A], now=1000)
+    assert store.next_due() == 1060
+    store.record_failure(URL, "timeout", now=2000)
+    status = store.watch_status(URL)
+    assert store.next_due() == 2060 and status["last_error"] == "timeout"
+    # Keeping the schedule on update: the next run follows the last one
+    store.upsert_watch(Watch(url=URL, interval_seconds=600), run_now=False)
+    assert store.next_due() == 2600
+
+
+def test_unwatching_keeps_or_deletes_history(store):
+    watch = Watch(url=URL)
+    store.upsert_watch(watch)
+    store.record_run(watch, [A], now=1)
+    assert store.delete_watch(URL, keep_history=True)
+    assert store.watch_status(URL)["watched"] is False
+    assert store.watched_urls() == []
+
+    store.upsert_watch(watch)
+    store.delete_watch(URL, keep_history=False)
+    assert store.watch_status(URL) is None
+    assert not store.delete_watch(URL)
@@ -0,0 +1,156 @@
+import asyncio
+from email.utils import formatdate
+import time
+
+import pytest
+
+from api.ab_detector.network import JobNetwork, NetworkPolicy, _cacheable
+
+
+class Response:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self._body = body
+
+    async def body(self):
+        return self._body
+
+
+class Server:
+    """Answers route.fetch: the body names the User-Agent, conditional requests get a 304."""
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.fetches = []
+
+    def respond(self, request_headers):
+        self.fetches.append(request_headers)
+        if "if-none-match" in request_headers and request_headers["if-none-match"] == self.headers.get("ETag"):
+            return Response(304, {}, b"")
+        return Response(200, dict(self.headers), f"body for {request_headers['user-agent']}".encode())
+
+
+class Route:
+    def __init__(self, server, request):
+        self.server = server
+        self.request = request
+        self.served = None
+        self.aborted = None
+
+    async def fetch(self, headers):
+        return self.server.respond(headers)
+
+    async def fulfill(self, status, headers, body):
+        self.served = (status, headers, body)
+
+    async def continue_(self):
+        self.served = "network"
+
+    async def abort(self, reason):
+        self.aborted = reason
+
+
+class Request:
+    def __init__(self, url, user_agent, resource_type="stylesheet", method="GET"):
+        self.url = url
+        self.method = method
+        self.resource_type = resource_type
+        self.headers = {"user-agent": user_agent}
+
+    async def all_headers(self):
+        return {**self.headers, "accept": "*/*"}
+
+
+def browse(network, server, requests):
+    async def run():
+        routes = []
+        for request in requests:
+            route = Route(server, request)
+            await network.handle(route, request)
+            routes.append(route)
+        return routes
+    return asyncio.run(run())
+
+
+def bodies(routes):
+    return [route.served[2].decode() for route in routes]
+
+
+URL = "https://example.com/site.css"
+
+
+def test_responses_are_reused_per_vary_header_value():
+    server = Server({"Cache-Control": "max-age=600", "Vary": "Accept-Encoding, User-Agent"})
+    network = JobNetwork(NetworkPolicy())
+    routes = browse(network, server, [Request(URL, ua) for ua in "ABAB"])
+
+    assert bodies(routes) == ["body for A", "body for B", "body for A", "body for B"]
+    assert network.stats.requests_fetched == 2
+    assert network.stats.requests_from_cache == 2
+
+
+def test_responses_without_vary_are_shared_across_user_agents():
+    server = Server({"Cache-Control": "max-age=600"})
+    network = JobNetwork(NetworkPolicy())
+    routes = browse(network, server, [Request(URL, ua) for ua in "AB"])
+    assert bodies(routes) == ["body for A", "body for A"]
+
+
+def test_vary_star_is_never_reused():
+    server = Server({"Cache-Control": "max-age=600", "Vary": "*"})
+    network = JobNetwork(NetworkPolicy())
+    browse(network, server, [Request(URL, "A"), Request(URL, "A")])
+    assert network.stats.requests_fetched == 2
+
+
+def test_stale_responses_are_revalidated_with_their_etag():
+    server = Server({"Cache-Control": "max-age=0", "ETag": '"v1"'})
+    network = JobNetwork(NetworkPolicy())
+    routes = browse(network, server, [Request(URL, "A"), Request(URL, "B")])
+
+    assert server.fetches[1]["if-none-match"] == '"v1"'
+    assert bodies(routes) == ["body for A", "body for A"]
+    assert network.stats.requests_revalidated == 1
+
+
+def test_set_cookie_is_passed_through_but_never_replayed():
+    server = Server({"Cache-Control": "max-age=600", "Set-Cookie": "session=1"})
+    network = JobNetwork(NetworkPolicy())
+    first, second = browse(network, server, [Request(URL, "A"), Request(URL, "A")])
+    assert first.served[1]["Set-Cookie"] == "session=1"
+    assert "Set-Cookie" not in second.served[1]
+
+
+def test_trackers_and_media_are_blocked_and_documents_go_to_the_network():
+    server = Server({"Cache-Control": "max-age=600"})
+    network = JobNetwork(NetworkPolicy())
+    tracker, media, document = browse(network, server, [
+        Request("https://www.google-analytics.com/analytics.js", "A", "script"),
+        Request("https://example.com/intro.mp4", "A", "media"),
+        Request("https://example.com/", "A", "document")
+    ])
+    assert tracker.aborted == media.aborted == "blockedbyclient"
+    assert document.served == "network"
+    assert network.stats.requests_blocked == 2
+
+
+def test_allow_wins_over_deny():
+    policy = NetworkPolicy(block_trackers=False, deny=["example.com"], allow=["re:/keep/"])
+    assert policy.blocks("https://cdn.example.com/a.js", "script")
+    assert not policy.blocks("https://cdn.example.com/keep/a.js", "script")
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"cache-control": "max-age=600"}, False),
+    ({"cache-control": "public, immutable"}, False),
+    ({"expires": formatdate(time.time() + 600, usegmt=True)}, False),
+    ({"cache-control": "no-cache", "etag": '"v1"'}, True),
+    ({"last-modified": formatdate(time.time() - 600, usegmt=True)}, True),
+    ({"expires": formatdate(time.time() - 600, usegmt=True)}, None),
+    ({}, None),
+    ({"cache-control": "max-age=600, private"}, None),
+    ({"cache-control": "no-store", "etag": '"v1"'}, None),
+])
+def test_cacheability(headers, expected):
+    assert _cacheable(headers) is expected
@@ -0,0 +1,80 @@
+import asyncio
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from api.ab_detector.analysis import stitch_png
+from api.ab_detector.capture import CaptureResult
+from api.ab_detector.tiles import TiledCaptures, tile_offsets
+from tests.ab_detector.screenshots import page, png
+
+
+@pytest.mark.parametrize("page_height, tile_height, max_tiles, expected", [
+    (300, 100, 10, [(0, 100), (100, 100), (200, 100)]),
+    (250, 100, 10, [(0, 100), (100, 100), (200, 50)]),
+    (300, 100, 2, [(0, 100), (100, 100)]),
+    (50, 100, 10, [(0, 50)]),
+    # An unreadable height still yields one full tile
+    (0, 100, 10, [(0, 100)]),
+])
+def test_tile_offsets(page_height, tile_height, max_tiles, expected):
+    assert tile_offsets(page_height, tile_height, max_tiles) == expected
+
+
+def full_page(middle_variant: int, height: int = 300) -> bytes:
+    """Three 100 px bands; only the middle one depends on the variant."""
+    bands = [page(0, height=100), page(middle_variant, height=100), page(2, height=100)]
+    return png(np.concatenate(bands)[:height])
+
+
+def run_tiled(pool, frame_store, screenshots, **settings):
+    async def run():
+        tiled = TiledCaptures(pool, frame_store, ["phash"], 100, 10, **settings)
+        captures = [CaptureResult(index=k, screenshot=screenshot) for k, screenshot in enumerate(screenshots)]
+        for capture in captures:
+            tiled.start(capture)
+        collected = await tiled.collect(captures)
+        return tiled, collected, await tiled.compare(0)
+    return asyncio.run(run())
+
+
+def test_only_positions_that_differ_are_compared(inline_pool, frame_store):
+    tiled, collected, (diff, ssim, _, _) = run_tiled(
+        inline_pool, frame_store, [full_page(0), full_page(1), full_page(0)]
+    )
+
+    assert [len(capture.tiles) for capture in collected] == [3, 3, 3]
+    assert [entry["compared"] for entry in tiled.report["tiles"]] == [False, True, False]
+    assert tiled.report["tiles"][1]["variations"] == 2
+    # One frame per distinct middle tile
+    assert tiled.frames_decoded == 2
+    assert tiled.report["pixels_compared_fraction"] == round(1 / 3, 4)
+    assert diff[0, 2] == 0 and ssim[0, 2] == 1
+    # Page scores are the area-weighted mean over positions
+    assert 0 < diff[0, 1] < 1 / 3
+    assert tiled.signatures()[0] == tiled.signatures()[2] != tiled.signatures()[1]
+
+
+def test_a_tile_only_one_page_has_counts_as_fully_different(inline_pool, frame_store):
+    tiled, _, (diff, ssim, _, _) = run_tiled(inline_pool, frame_store, [full_page(0), full_page(0, height=200)])
+    assert tiled.report["tiles_per_capture"] == {"min": 2, "max": 3}
+    assert diff[0, 1] == pytest.approx(1 / 3)
+    assert ssim[0, 1] == pytest.approx(2 / 3)
+
+
+def test_ignore_regions_are_applied_per_tile(inline_pool, frame_store):
+    # The only difference lies in an ignored region spanning the middle band
+    tiled, _, (diff, _, _, _) = run_tiled(
+        inline_pool, frame_store, [full_page(0), full_page(1)], ignore_regions=[(0, 100, 160, 100)]
+    )
+    assert diff[0, 1] == 0
+    assert tiled.report["tiles_compared"] == 0
+
+
+def test_stitched_tiles_restore_the_page(inline_pool, frame_store):
+    _, collected, _ = run_tiled(inline_pool, frame_store, [full_page(1, height=250)])
+    stitched = np.asarray(Image.open(io.BytesIO(stitch_png(collected[0].tiles))))
+    original = np.asarray(Image.open(io.BytesIO(full_page(1, height=250))))
+    assert np.array_equal(stitched, original)
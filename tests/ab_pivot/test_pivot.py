@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from api.ab_pivot.pivot import pivot_records
+from benchmarks.pivot_benchmark import (
+    HEADER_COLS, METRIC_COLS, rowwise_records, same_records, synthetic_export, treatment_rows
+)
+
+
+def assert_same_layout(df_treatment, header_cols=HEADER_COLS, metric_cols=METRIC_COLS):
+    records, groups = pivot_records(df_treatment, header_cols, metric_cols)
+    reference, reference_groups = rowwise_records(df_treatment)
+    assert groups == reference_groups
+    assert same_records(records, reference)
+    return records
+
+
+@pytest.mark.parametrize("rows, seed", [(40, 0), (500, 1), (5000, 2)])
+def test_matches_the_row_by_row_layout(rows, seed):
+    assert_same_layout(treatment_rows(synthetic_export(rows, seed)))
+
+
+def test_groups_are_laid_out_with_headers_once_and_a_separator_after():
+    df = pd.DataFrame({
+        'Name': ["A", "A", "B"],
+        'Audience(s)': ["All", "All", "All"],
+        'Variation Name': ["V1", "V1", "V1"],
+        'Visitors': [10, 10, 20],
+        'Metric Name': ["m1", "m2", "m1"],
+        'Metric Value': [1.5, 2.5, 3.5]
+    })
+    records, groups = pivot_records(df, ['Name', 'Audience(s)', 'Variation Name', 'Visitors'], ['Metric Name', 'Metric Value'])
+    assert groups == 2
+    assert [(r['Name'], r['Visitors'], r['Metric Name'], r['Metric Value']) for r in records] == [
+        ("A", 10, "m1", 1.5),
+        ("", "", "m2", 2.5),
+        ("", "", "", ""),
+        ("B", 20, "m1", 3.5),
+        ("", "", "", ""),
+    ]
+
+
+def test_rows_missing_a_group_key_are_left_out():
+    df = treatment_rows(synthetic_export(300, seed=3))
+    df.loc[df.index[::7], 'Audience(s)'] = None
+    records = assert_same_layout(df)
+    assert all(record['Audience(s)'] is not None for record in records)
+
+
+def test_all_numeric_frames_give_python_floats():
+    df = pd.DataFrame({
+        'Name': [1, 1, 2],
+        'Audience(s)': [0, 0, 0],
+        'Variation Name': [5, 5, 6],
+        'Metric Value': np.array([0.25, np.nan, 1.0])
+    })
+    header_cols = ['Name', 'Audience(s)', 'Variation Name']
+    records, _ = pivot_records(df, header_cols, ['Metric Value'])
+    # One numeric dtype for the whole frame, as iterrows gave the row-by-row layout
+    assert type(records[0]['Name']) is float
+
+    reference = pd.DataFrame([
+        {'Name': 1.0, 'Audience(s)': 0.0, 'Variation Name': 5.0, 'Metric Value': 0.25},
+        {'Name': '', 'Audience(s)': '', 'Variation Name': '', 'Metric Value': np.nan},
+        {col: '' for col in header_cols + ['Metric Value']},
+        {'Name': 2.0, 'Audience(s)': 0.0, 'Variation Name': 6.0, 'Metric Value': 1.0},
+        {col: '' for col in header_cols + ['Metric Value']},
+    ]).to_dict(orient='records')
+    assert same_records(records, reference)
+
+
+def test_missing_columns_raise_key_error():
+    df = treatment_rows(synthetic_export(100))
+    with pytest.raises(KeyError):
+        pivot_records(df, HEADER_COLS + ['Owner'], METRIC_COLS)
+    with pytest.raises(KeyError):
+        pivot_records(df.iloc[:0], HEADER_COLS, METRIC_COLS)
+    with pytest.raises(KeyError):
+        rowwise_records(df.iloc[:0])
@@ -0,0 +1,142 @@
+import pytest
+
+from api.lighthouse.history import LighthouseHistory, compare_values, values_from_result
+
+URL = "https://example.com/"
+
+
+def single(performance, fcp, seo=None):
+    fields = {
+        'categories.performance.score': performance,
+        'audits.first-contentful-paint.numericValue': fcp
+    }
+    if seo is not None:
+        fields['categories.seo.score'] = seo
+    return {"summary_fields": fields}
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = LighthouseHistory(str(tmp_path / "history" / "runs.sqlite3"))
+    yield history
+    history.close()
+
+
+def test_values_from_a_single_run():
+    values = values_from_result(single(0.876, 1234.5678, seo=1))
+    assert values["performance"] == 88
+    assert values["seo"] == 100
+    assert values["accessibility"] is None
+    assert values["first_contentful_paint"] == 1234.568
+    assert values["speed_index"] is None
+
+
+def test_values_from_a_multi_run_result_are_its_medians():
+    meta = {
+        "summary_fields": {'categories.performance.score': 0.1},
+        "runs": {
+            "categories": {"performance": {"median": 72.5}, "seo": None},
+            "metrics": {"first-contentful-paint": {"median": 1500.0}}
+        }
+    }
+    values = values_from_result(meta)
+    assert values["performance"] == 72
+    assert values["seo"] is None
+    assert values["first_contentful_paint"] == 1500.0
+
+
+def test_compare_values_flags_lower_scores_and_slower_metrics():
+    latest = {"scores": {"performance": 80, "seo": 96}, "metrics": {"first-contentful-paint": 1150, "speed-index": None}}
+    baseline = {"scores": {"performance": 90, "seo": 100}, "metrics": {"first-contentful-paint": 1000, "speed-index": 2000}}
+    result = compare_values(latest, baseline, score_threshold=5, metric_threshold_percent=10)
+
+    assert result["changes"]["scores"]["performance"] == {"latest": 80, "baseline": 90, "change": -10, "regressed": True}
+    assert not result["changes"]["scores"]["seo"]["regressed"]
+    assert result["changes"]["metrics"]["first-contentful-paint"]["change_percent"] == 15.0
+    assert "speed-index" not in result["changes"]["metrics"]
+    assert [(r["kind"], r["name"]) for r in result["regressions"]] == [
+        ("score", "performance"), ("metric", "first-contentful-paint")
+    ]
+
+
+def test_compare_values_treats_improvements_as_no_regression():
+    latest = {"scores": {"performance": 99}, "metrics": {"total-blocking-time": 0}}
+    baseline = {"scores": {"performance": 70}, "metrics": {"total-blocking-time": 0}}
+    result = compare_values(latest, baseline, 5, 10)
+    assert result["regressions"] == []
+    assert result["changes"]["metrics"]["total-blocking-time"]["change_percent"] is None
+
+
+def test_trend_is_oldest_first_per_normalized_url_and_profile(history):
+    history.record("HTTPS://Example.com:443/#top", "default", single(0.9, 1000), at=100)
+    history.record(URL, "default", single(0.7, 1400), at=200)
+    history.record(URL, "default", single(0.8, 1200), at=300)
+    history.record(URL, "seo", single(None, None, seo=1), at=250)
+
+    trend = history.trend(URL, "default")
+    assert trend["count"] == 3
+    assert [point["scores"]["performance"] for point in trend["points"]] == [90, 70, 80]
+    assert trend["summary"]["scores"]["performance"] == {"latest": 80, "median": 80, "min": 70, "max": 90, "change": -10}
+    assert "seo" not in trend["summary"]["scores"]
+
+    assert history.trend(URL, "default", since=150)["count"] == 2
+    assert history.trend(URL, "default", limit=1)["points"][0]["scores"]["performance"] == 80
+    assert history.trend("https://example.org/", "default") is None
+
+
+def test_multi_run_results_record_their_run_count(history):
+    meta = {
+        "summary_fields": {},
+        "runs": {"completed": 2, "partial": True, "categories": {"performance": {"median": 50}}, "metrics": {}}
+    }
+    history.record(URL, "default", meta, at=100)
+    point = history.trend(URL, "default")["points"][0]
+    assert (point["runs"], point["partial"], point["scores"]["performance"]) == (2, True, 50)
+
+
+@pytest.mark.parametrize("baseline, runs, performance", [
+    ("median", 3, 90),
+    ("previous", 1, 70),
+    ("first", 1, 95),
+])
+def test_compare_against_each_baseline(history, baseline, runs, performance):
+    for at, score in enumerate((0.95, 0.90, 0.91, 0.70, 0.60)):
+        history.record(URL, "default", single(score, 1000), at=at)
+
+    comparison = history.compare(URL, "default", baseline=baseline, baseline_runs=3)
+    assert comparison["baseline"]["kind"] == baseline
+    assert comparison["baseline"]["runs"] == runs
+    assert comparison["changes"]["scores"]["performance"]["latest"] == 60
+    assert comparison["changes"]["scores"]["performance"]["baseline"] == performance
+
+
+def test_compare_needs_two_runs(history):
+    assert history.compare(URL, "default") is None
+    history.record(URL, "default", single(0.9, 1000), at=1)
+    for baseline in ("median", "previous", "first"):
+        assert history.compare(URL, "default", baseline=baseline) is None
+
+
+def test_regressions_across_urls(history):
+    history.record(URL, "default", single(0.9, 1000), at=1)
+    history.record(URL, "default", single(0.6, 1000), at=2)
+    history.record("https://example.org/", "default", single(0.9, 1000), at=3)
+    history.record("https://example.org/", "default", single(0.9, 1050), at=4)
+
+    assert history.urls("default") == ["https://example.org/", URL]
+    assert history.urls("default", since=3) == ["https://example.org/"]
+    assert [comparison["url"] for comparison in history.regressions("default")] == [URL]
+    assert history.regressions("default", urls=["https://example.org/"]) == []
+    assert history.regressions("seo") == []
+
+
+def test_history_persists_across_connections(tmp_path):
+    path = str(tmp_path / "runs.sqlite3")
+    first = LighthouseHistory(path)
+    first.record(URL, "default", single(0.9, 1000), at=1)
+    first.close()
+    second = LighthouseHistory(path)
+    try:
+        assert second.trend(URL, "default")["count"] == 1
+    finally:
+        second.close()
@@ -0,0 +1,51 @@
+from api.lighthouse.multirun import aggregate, representative_run
+
+
+def run(performance, fcp, tbt=None):
+    fields = {
+        'categories.performance.score': performance,
+        'audits.first-contentful-paint.numericValue': fcp
+    }
+    if tbt is not None:
+        fields['audits.total-blocking-time.numericValue'] = tbt
+    return fields
+
+
+def test_aggregate_takes_the_median_and_spread():
+    result = aggregate([run(0.9, 1200), run(0.7, 1800), run(0.8, 1500)])
+    assert result["categories"]["performance"] == {"median": 80.0, "min": 70.0, "max": 90.0, "stdev": 10.0}
+    assert result["metrics"]["first-contentful-paint"] == {"median": 1500, "min": 1200, "max": 1800, "stdev": 300.0}
+
+
+def test_aggregate_uses_the_runs_that_have_a_value():
+    result = aggregate([run(0.9, 1000, tbt=50), run(0.5, 3000)])
+    assert result["categories"]["performance"]["median"] == 70.0
+    assert result["metrics"]["total-blocking-time"] == {"median": 50, "min": 50, "max": 50, "stdev": 0.0}
+    assert result["categories"]["seo"] is None
+    assert result["metrics"]["speed-index"] is None
+
+
+def test_single_run_has_no_spread():
+    result = aggregate([run(0.75, 900)])
+    assert result["categories"]["performance"] == {"median": 75.0, "min": 75.0, "max": 75.0, "stdev": 0.0}
+
+
+def test_representative_run_is_closest_to_the_medians():
+    runs = [run(0.95, 900), run(0.80, 1500), run(0.60, 2600)]
+    assert representative_run(runs) == 1
+
+
+def test_representative_run_weighs_values_by_their_scale():
+    # FCP differs by hundreds of milliseconds, the score by points: neither dominates
+    runs = [run(0.80, 1000), run(0.50, 1100), run(0.81, 1400)]
+    assert representative_run(runs) == 0
+
+
+def test_representative_run_ignores_values_some_runs_lack():
+    # Only the first run has TBT, far from anything: it must not count
+    runs = [run(0.80, 1500, tbt=90000), run(0.60, 2600), run(0.95, 900)]
+    assert representative_run(runs) == 0
+
+
+def test_representative_run_of_one_run():
+    assert representative_run([run(None, None)]) == 0
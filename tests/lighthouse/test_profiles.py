@@ -0,0 +1,76 @@
+import pytest
+
+from api.lighthouse.profiles import PROFILES, ProfileTimings, RunProfile, resolve_profile
+
+
+def test_default_profile_skips_pwa():
+    profile, error = resolve_profile("default")
+    assert error is None
+    assert profile.flags() == ["--only-categories=accessibility,best-practices,performance,seo"]
+    assert "pwa" not in profile.to_dict()["categories"]
+
+
+def test_all_profile_runs_without_filters():
+    profile, _ = resolve_profile("all")
+    assert profile.flags() == []
+    assert profile.key() == "all"
+    assert "pwa" in profile.to_dict()["categories"]
+
+
+@pytest.mark.parametrize("name", list(PROFILES))
+def test_preset_keys_are_their_names(name):
+    profile, _ = resolve_profile(name)
+    assert profile.key() == name
+
+
+def test_custom_profiles_with_preset_filters_share_the_preset_key():
+    profile, _ = resolve_profile("custom", categories=["seo", "performance", "accessibility", "best-practices"])
+    assert profile.key() == "default"
+    profile, _ = resolve_profile("custom", categories=["seo", "seo"])
+    assert profile.key() == "seo"
+
+
+def test_custom_keys_keep_different_audits_apart():
+    first, _ = resolve_profile("custom", audits=["speed-index", "interactive"])
+    same, _ = resolve_profile("custom", audits=["interactive", "speed-index"])
+    other, _ = resolve_profile("custom", audits=["speed-index"])
+    assert first.key() == same.key() == "--only-audits=interactive,speed-index"
+    assert other.key() != first.key()
+    # With audits only, every category is kept
+    assert first.categories is None
+
+
+@pytest.mark.parametrize("name, categories, audits, message", [
+    ("default", ["seo"], [], "need the 'custom' profile"),
+    ("fastest", [], [], "Invalid profile 'fastest'"),
+    ("custom", [], [], "needs only_categories or only_audits"),
+    ("custom", ["speed"], [], "Unknown categories: speed"),
+    ("custom", [], ["Speed Index"], "Invalid audit ids: Speed Index"),
+])
+def test_invalid_profiles(name, categories, audits, message):
+    profile, error = resolve_profile(name, categories, audits)
+    assert profile is None
+    assert message in error
+
+
+def test_to_dict_lists_categories_in_report_order():
+    profile = RunProfile("custom", ["seo", "performance"], ["b", "a"])
+    assert profile.to_dict() == {
+        "name": "custom",
+        "key": "--only-categories=performance,seo --only-audits=a,b",
+        "categories": ["performance", "seo"],
+        "audits": ["a", "b"]
+    }
+
+
+def test_profile_timings_keep_a_window_per_key():
+    timings = ProfileTimings(window=3)
+    for seconds in (10, 1, 2, 3):
+        timings.record("default", seconds)
+    timings.record("seo", 5)
+    assert timings.median("default") == 2
+    assert timings.median("all") is None
+    assert timings.stats() == {
+        "default": {"runs": 3, "median_run_seconds": 2},
+        "seo": {"runs": 1, "median_run_seconds": 5}
+    }
@@ -0,0 +1,110 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from api.lighthouse.report import accepts_gzip, annotate, extract, full_response, project, summarize
+
+REPORT = {
+    "finalUrl": "https://example.com/",
+    "fetchTime": "2026-01-01T00:00:00.000Z",
+    "categories": {
+        "performance": {"id": "performance", "score": 0.91, "auditRefs": [{"id": "speed-index", "weight": 10}]},
+        "seo": {"id": "seo", "score": None}
+    },
+    "audits": {
+        "speed-index": {"id": "speed-index", "score": 0.87, "displayValue": "1.2 s", "numericValue": 1234.5},
+        "network-requests": {
+            "id": "network-requests",
+            "score": None,
+            "details": {"items": [{"url": "https://example.com/", "size": 10}, {"url": "https://example.com/a.js", "size": 20}]}
+        },
+        "is-on-https": {"id": "is-on-https", "score": 1, "details": {"items": []}}
+    },
+    "notes": ["quote \" and \\ backslash", True, False, 1e-7]
+}
+
+
+def raw(report=REPORT) -> bytes:
+    return json.dumps(report, indent=2).encode()
+
+
+def test_annotate_adds_score_percentages_and_keeps_everything_else():
+    compressed, fields = annotate(raw())
+    annotated = json.loads(gzip.decompress(compressed))
+
+    expected = json.loads(raw())
+    expected["audits"]["speed-index"]["scorePercentage"] = 87
+    expected["audits"]["is-on-https"]["scorePercentage"] = 100
+    assert annotated == expected
+    assert fields["categories.performance.score"] == 0.91
+    assert fields["audits.speed-index.numericValue"] == 1234.5
+
+
+def test_summarize_reads_annotate_fields():
+    _, fields = annotate(raw())
+    summary = summarize(fields, "https://example.com")
+    assert summary["url"] == "https://example.com/"
+    assert summary["scores"]["performance"] == 91
+    assert summary["scores"]["seo"] is None
+    assert summary["metrics"]["speed-index"] == "1.2 s"
+    assert summary["metrics"]["interactive"] is None
+
+
+def test_extract_builds_only_matched_subtrees():
+    found = extract(io.BytesIO(raw()), [
+        "audits.network-requests.details.items.item.url",
+        "categories.performance",
+        "categories.performance.score",
+        "missing.path"
+    ])
+    assert found["audits.network-requests.details.items.item.url"] == ["https://example.com/", "https://example.com/a.js"]
+    assert found["categories.performance"] == [REPORT["categories"]["performance"]]
+    # Paths may nest inside a matched container
+    assert found["categories.performance.score"] == [0.91]
+    assert "missing.path" not in found
+
+
+def test_project():
+    projection = project(
+        io.BytesIO(raw()),
+        categories=["performance", "pwa"],
+        audits=["speed-index"],
+        paths=["fetchTime", "audits.network-requests.details.items.item.size"]
+    )
+    assert projection["categories"] == {"performance": REPORT["categories"]["performance"], "pwa": None}
+    assert projection["audits"] == {"speed-index": REPORT["audits"]["speed-index"]}
+    assert projection["paths"] == {
+        "fetchTime": REPORT["fetchTime"],
+        "audits.network-requests.details.items.item.size": [10, 20]
+    }
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip", True),
+    ("br, GZIP;q=0.5", True),
+    ("deflate, gzip;q=0", False),
+    ("*", True),
+    ("x-gzip", True),
+    ("identity", False),
+    ("", False),
+    ("gzip;q=bad", False),
+])
+def test_accepts_gzip(header, expected):
+    assert accepts_gzip(header) is expected
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_full_response_wraps_the_cached_report(compress):
+    stream = io.BytesIO(raw())
+    body = b"".join(full_response({"source": "cache"}, stream, compress=compress))
+    if compress:
+        body = gzip.decompress(body)
+    assert json.loads(body) == {"source": "cache", "full_report": REPORT}
+    assert stream.closed
+
+
+def test_full_response_with_an_empty_envelope():
+    body = b"".join(full_response({}, io.BytesIO(b"[]"), compress=False))
+    assert json.loads(body) == {"full_report": []}